@@ -0,0 +1,278 @@
+import math
+from collections import defaultdict
+
+import numpy as np
+
+from sketches import HyperLogLog, QuantileSketch, hash64
+from store import NO_CODE
+
+# Constant-memory, mergeable statistics for gateways and devices.
+#
+# RunningStats keeps count / mean / M2 (Welford) so variance can be updated
+# one value at a time, folded in a whole NumPy batch at once, or merged with
+# the stats of another shard or time window (Chan et al.).
+#
+# EntityStats adds a quantile sketch of confidence, RSSI and SNR and, for
+# gateways, a HyperLogLog of the devices heard (see sketches.py); both stay
+# a few KB per entity and merge like the running stats.
+
+QUANTILES = (5, 50, 95)    # percentiles reported by EntityStats.summary
+
+
+class RunningStats:
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, x):
+        if x is None or x != x:
+            return
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    def _combine(self, count, mean, m2, lo, hi):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            self.min, self.max = lo, hi
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+
+    def update_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self._combine(len(values), mean, m2, float(values.min()), float(values.max()))
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class EntityStats:
+    # Per-gateway or per-device accumulator.
+
+    __slots__ = ("event_count", "confidence", "rssi", "snr", "sketches", "devices")
+
+    def __init__(self):
+        self.event_count = 0
+        self.confidence = RunningStats()
+        self.rssi = RunningStats()
+        self.snr = RunningStats()
+        self.sketches = {
+            "confidence": QuantileSketch(),
+            "rssi": QuantileSketch(),
+            "snr": QuantileSketch(),
+        }
+        self.devices = None         # HyperLogLog, once add_devices is called
+
+    def update(self, e):
+        rf = e["rf"]
+        self.event_count += 1
+        confidence = e["confidence"]["confidence_score"]
+        self.confidence.update(confidence)
+        self.rssi.update(rf.get("rssi"))
+        self.snr.update(rf.get("snr"))
+        self.sketches["confidence"].update(confidence)
+        self.sketches["rssi"].update(rf.get("rssi"))
+        self.sketches["snr"].update(rf.get("snr"))
+
+    def update_columns(self, confidence, rssi, snr):
+        self.event_count += len(confidence)
+        self.confidence.update_many(confidence)
+        self.rssi.update_many(rssi)
+        self.snr.update_many(snr)
+        self.sketches["confidence"].update_many(confidence)
+        self.sketches["rssi"].update_many(rssi)
+        self.sketches["snr"].update_many(snr)
+
+    def add_devices(self, dev_euis=(), hashes=None):
+        # Count devEuis (or their sketches.hash64 hashes) as heard; missing
+        # (None / NaN) ids are not counted
+        if self.devices is None:
+            self.devices = HyperLogLog()
+        if hashes is None:
+            hashes = hash64([d for d in dev_euis if _known(d)])
+        self.devices.add_hashes(hashes)
+
+    def merge(self, other):
+        self.event_count += other.event_count
+        self.confidence.merge(other.confidence)
+        self.rssi.merge(other.rssi)
+        self.snr.merge(other.snr)
+        for name, sketch in self.sketches.items():
+            sketch.merge(other.sketches[name])
+        if other.devices is not None:
+            if self.devices is None:
+                self.devices = HyperLogLog(other.devices.p)
+            self.devices.merge(other.devices)
+        return self
+
+    def quantile(self, name, q):
+        # q-quantile (0..1) of "confidence", "rssi" or "snr"; None without data
+        return self.sketches[name].quantile(q)
+
+    def summary(self):
+        # Same shape as analyze_gateways: population stddev, 0 for < 2
+        # values; percentiles are None without data
+        summary = {
+            "avg_confidence": round(self.confidence.mean, 2),
+            "rssi_std": round(self.rssi.std, 2) if self.rssi.count > 1 else 0,
+            "snr_std": round(self.snr.std, 2) if self.snr.count > 1 else 0,
+            "event_count": self.event_count
+        }
+        for name, sketch in self.sketches.items():
+            values = sketch.quantiles([p / 100 for p in QUANTILES])
+            for p, value in zip(QUANTILES, values):
+                summary[f"{name}_p{p}"] = None if value is None else round(value, 2)
+        if self.devices is not None:
+            summary["distinct_devices"] = self.devices.count()
+        return summary
+
+
+def _known(dev_eui):
+    return dev_eui is not None and dev_eui == dev_eui
+
+
+def _group_stats(codes, values, n):
+    # count / mean / M2 / min / max of values grouped by integer code
+    ok = ~np.isnan(values)
+    codes = codes[ok]
+    values = values[ok]
+
+    counts = np.bincount(codes, minlength=n)
+    sums = np.bincount(codes, weights=values, minlength=n)
+    means = np.divide(sums, counts, out=np.zeros(n), where=counts > 0)
+    m2 = np.bincount(codes, weights=(values - means[codes]) ** 2, minlength=n)
+
+    lo = np.full(n, np.inf)
+    hi = np.full(n, -np.inf)
+    np.minimum.at(lo, codes, values)
+    np.maximum.at(hi, codes, values)
+    return counts, means, m2, lo, hi
+
+
+class FleetStats:
+    def __init__(self):
+        self.gateways = defaultdict(EntityStats)
+        self.devices = defaultdict(EntityStats)
+
+    def update(self, e):
+        dev = e["device"]["devEui"]
+        self.devices[dev].update(e)
+        gw = e["rf"].get("gatewayId")
+        if gw:
+            self.gateways[gw].update(e)
+            self.gateways[gw].add_devices([dev])
+
+    def update_store(self, store, start=0):
+        # Fold rows [start:] of an EventStore in one vectorized pass.
+        # Returns the gateway IDs that received new events.
+        dev = store.column("device")[start:].astype(np.int64)
+        gw = store.column("gateway")[start:].astype(np.int64)
+        cols = {
+            name: store.column(name)[start:]
+            for name in ("confidence_score", "rssi", "snr")
+        }
+
+        self._update_groups(self.devices, store.devices, dev, cols)
+
+        has_gw = gw != NO_CODE
+        self._update_groups(
+            self.gateways,
+            store.gateways,
+            gw[has_gw],
+            {name: col[has_gw] for name, col in cols.items()},
+        )
+
+        # devices heard per gateway, one hash per distinct device with an id
+        n_dev = len(store.devices)
+        known = np.array([_known(d) for d in store.devices], dtype=bool)
+        heard = has_gw & known[dev]
+        pairs = np.unique(gw[heard] * n_dev + dev[heard])
+        if len(pairs):
+            pair_gw, pair_dev = pairs // n_dev, pairs % n_dev
+            codes = np.unique(pair_dev)
+            hashes = np.zeros(n_dev, dtype=np.uint64)
+            hashes[codes] = hash64([store.devices[c] for c in codes])
+            bounds = np.flatnonzero(np.diff(pair_gw)) + 1
+            for rows in np.split(np.arange(len(pairs)), bounds):
+                self.gateways[store.gateways[pair_gw[rows[0]]]].add_devices(
+                    hashes=hashes[pair_dev[rows]]
+                )
+        return [store.gateways[c] for c in np.unique(gw[has_gw])]
+
+    def _update_groups(self, target, table, codes, cols):
+        if len(codes) == 0:
+            return
+        n = len(table)
+        event_counts = np.bincount(codes, minlength=n)
+        grouped = {
+            name: _group_stats(codes, col, n)
+            for name, col in cols.items()
+        }
+        order = np.argsort(codes, kind="stable")
+        ends = np.cumsum(event_counts)
+
+        for code in np.flatnonzero(event_counts):
+            s = target[table[code]]
+            s.event_count += int(event_counts[code])
+            rows = order[ends[code] - event_counts[code]:ends[code]]
+            for name, sketch in (
+                ("confidence_score", s.sketches["confidence"]),
+                ("rssi", s.sketches["rssi"]),
+                ("snr", s.sketches["snr"]),
+            ):
+                sketch.update_many(cols[name][rows])
+            for name, acc in (
+                ("confidence_score", s.confidence),
+                ("rssi", s.rssi),
+                ("snr", s.snr),
+            ):
+                counts, means, m2, lo, hi = grouped[name]
+                acc._combine(
+                    int(counts[code]), float(means[code]), float(m2[code]),
+                    float(lo[code]), float(hi[code])
+                )
+
+    def merge(self, other):
+        for gw, s in other.gateways.items():
+            self.gateways[gw].merge(s)
+        for dev, s in other.devices.items():
+            self.devices[dev].merge(s)
+        return self
+
+    def gateway_summary(self):
+        return {gw: s.summary() for gw, s in self.gateways.items()}
+
+    def device_summary(self):
+        return {dev: s.summary() for dev, s in self.devices.items()}
@@ -1,21 +1,26 @@
+import os
+import time
+
 import streamlit as st
 import pandas as pd
 import altair as alt
 
-from engine import (
-    load_events,
-    build_device_index,
-    build_gateway_index,
-    sla_status,
-    maintenance_risk,
-    analyze_gateways,
-    generate_insights,
-    system_summary,
-)
+import instrument
+import rules
+from engine import system_summary
+from enrich import WEIGHTS
+from metrics import DEFAULT_WINDOW, WINDOWS
+from outofcore import OutOfCoreDataset
+from registry import Registry, configured_budget as registry_budget
+from replay import ReplayIndex
+from rescore import Rescorer
+from segments import SegmentLog
 
 # --------------------------------------------------
 # PAGE CONFIG
 # --------------------------------------------------
+rerun_start = time.perf_counter()
+
 st.set_page_config(
     page_title="IoT Trust & Reliability Engine",
     layout="wide"
@@ -48,24 +53,80 @@ st.markdown("<hr style='margin-top: 1rem; margin-bottom: 1.5rem;'>", unsafe_allo
 # --------------------------------------------------
 # LOAD DATA
 # --------------------------------------------------
-events = load_events()
-devices = build_device_index(events)
-gateways = build_gateway_index(events)
+@st.cache_resource
+def dataset_registry():
+    # One registry per process, shared by every session. Sites are opened
+    # on first view from the warm-start cache (see warmstart.py), else from
+    # their snapshot (see snapshot.py) when present, and least recently
+    # viewed ones are dropped beyond SENTINELMESH_REGISTRY_MEMORY. With
+    # SENTINELMESH_MAX_MEMORY set, sites run out-of-core within that budget
+    # instead (see outofcore.py). See registry.py for the site list.
+    return Registry(budget=registry_budget())
+
+@st.cache_resource
+def open_segment_log(path):
+    return SegmentLog(path)
+
+def segment_log(site_config):
+    # The site's segment log (see segments.py), brought up to date with its
+    # event file; None when it has none
+    path = site_config.get("segments")
+    if not path or not os.path.isdir(path):
+        return None
+    log = open_segment_log(path)
+    with instrument.span("app.segments_sync"):
+        log.sync(site_config["path"])
+    return log if len(log) else None
+
+# per session: each rerun runs in its own thread, so the switch is set for
+# this thread only; the recorded numbers are shared by every session
+profiling = st.sidebar.checkbox(
+    "Profile performance",
+    value=instrument.enabled(),
+    help="Record stage timings, counters and memory; see the Performance panel.",
+)
+instrument.enable(profiling, thread=True)
+
+registry = dataset_registry()
+if not registry.names():
+    st.error("No sites found; see SENTINELMESH_SITES in registry.py.")
+    st.stop()
+site = registry.names()[0]
+if len(registry.names()) > 1:
+    site = st.sidebar.selectbox(
+        "Site",
+        registry.names(),
+        help="Datasets are loaded on first view and shared by every session.",
+    )
+
+with instrument.span("app.refresh"):
+    cache = registry.refresh(site)
 
-device_metrics = {
-    dev: evts[0]["device_metrics"]
-    for dev, evts in devices.items()
-}
+if len(registry.names()) > 1:
+    budget = f" of {registry.budget / 2**20:,.0f}" if registry.budget else ""
+    st.sidebar.caption(
+        f"{len(registry.loaded())} of {len(registry.names())} sites loaded, "
+        f"{registry.nbytes() / 2**20:,.0f}{budget} MiB."
+    )
+
+events = cache.data.store
+out_of_core = isinstance(cache.data, OutOfCoreDataset)
+
+metrics_window = st.sidebar.selectbox(
+    "Metrics window",
+    list(WINDOWS),
+    index=list(WINDOWS).index(DEFAULT_WINDOW),
+    help="Device metrics are computed over the events in this trailing window.",
+)
+device_metrics = cache.get(
+    f"device_metrics:{metrics_window}",
+    lambda d: d.metrics.snapshot(metrics_window),
+)
 
 # ----------------------------
 # DEVICE NAME MAP
 # ----------------------------
-device_name_map = {}
-for e in events:
-    dev = e["device"]["devEui"]
-    name = e["device"].get("name")
-    if name:
-        device_name_map[dev] = name
+device_name_map = cache.get("device_name_map", lambda d: dict(d.device_name_map))
 
 def device_label(dev):
     return device_name_map.get(dev, dev)
@@ -73,16 +134,7 @@ def device_label(dev):
 # ----------------------------
 # GATEWAY NAME MAP
 # ----------------------------
-gateway_ids = sorted(set(
-    e["rf"]["gatewayId"]
-    for e in events
-    if e["rf"].get("gatewayId")
-))
-
-gateway_name_map = {
-    gid: f"Gateway-{i+1}"
-    for i, gid in enumerate(gateway_ids)
-}
+gateway_name_map = cache.get("gateway_name_map", lambda d: dict(d.gateway_name_map))
 
 def gateway_label(gid):
     return gateway_name_map.get(gid, gid)
@@ -90,28 +142,58 @@ def gateway_label(gid):
 # ----------------------------
 # ANALYTICS
 # ----------------------------
-gateway_stats = analyze_gateways(gateways)
-summary = system_summary(device_metrics, gateway_stats)
+gateway_stats = cache.get("gateway_stats", lambda d: dict(d.gateway_stats))
+rule_table = cache.get(
+    f"rules:{metrics_window}", lambda d: rules.evaluate(device_metrics)
+)
+LOW_CONFIDENCE = rules.threshold("low_confidence")
+summary = cache.get(
+    f"summary:{metrics_window}",
+    lambda d: system_summary(device_metrics, gateway_stats, rule_table)
+)
 
 # ----------------------------
-# EVENTS DATAFRAME
+# ROLLUPS
 # ----------------------------
-df_events = pd.DataFrame([
-    {
-        "timestamp": e["timestamp"],
-        "device": device_label(e["device"]["devEui"]),
-        "confidence": e["confidence"]["confidence_score"],
-    }
-    for e in events
-])
-
-df_events["timestamp"] = pd.to_datetime(
-    df_events["timestamp"],
-    format="mixed",
-    utc=True,
-    errors="coerce"
-)
-df_events = df_events.dropna(subset=["timestamp"])
+@instrument.timed("app.rollup_frame")
+def rollup_frame(frame, value, label=None):
+    # rollups.Rollups columns -> DataFrame of timestamp / mean / min / max
+    with instrument.span("app.timestamp_coercion"):
+        timestamps = pd.to_datetime(frame["time"], utc=True)
+    df = pd.DataFrame({
+        "timestamp": timestamps,
+        "mean": frame[f"{value}_mean"],
+        "min": frame[f"{value}_min"],
+        "max": frame[f"{value}_max"],
+        "count": frame["count"],
+    })
+    if label is not None:
+        df["entity"] = [label(e) for e in frame["entity"]]
+    return df
+
+
+data_start, data_end = cache.get("time_range", lambda d: d.time_range())
+
+
+def band_chart(df, title, domain=None):
+    scale = alt.Scale(domain=domain) if domain else alt.Scale(zero=False)
+    base = alt.Chart(df).encode(x=alt.X("timestamp:T", title="Time"))
+    band = base.mark_area(opacity=0.25, color="#4C78A8").encode(
+        y=alt.Y("min:Q", title=title, scale=scale),
+        y2="max:Q",
+    )
+    line = base.mark_line(color="#4C78A8").encode(
+        y=alt.Y("mean:Q", title=title, scale=scale),
+        tooltip=["timestamp:T", "mean", "min", "max", "count"],
+    )
+    return band + line
+
+
+def show_chart(chart):
+    # st.altair_chart, timed: this is where the chart spec and its data are
+    # serialized
+    with instrument.span("app.altair_chart"):
+        st.altair_chart(chart, use_container_width=True)
 
 # --------------------------------------------------
 # HEADER
@@ -126,7 +208,7 @@ st.divider()
 # --------------------------------------------------
 # SYSTEM SUMMARY
 # --------------------------------------------------
-with st.expander("System Summary", expanded=False):
+with st.expander("System Summary", expanded=False), instrument.span("app.section.summary"):
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Devices Analyzed", summary["total_devices"])
     c2.metric("High-Risk Devices", summary["high_risk_devices"])
@@ -136,28 +218,21 @@ with st.expander("System Summary", expanded=False):
 # --------------------------------------------------
 # AUTOMATED INSIGHTS (DEVICE NAMES)
 # --------------------------------------------------
-with st.expander("Automated Insights", expanded=False):
+with st.expander("Automated Insights", expanded=False), instrument.span("app.section.insights"):
     st.markdown(
         "Automatically generated insights based on device behavior, "
         "data completeness, and RF conditions."
     )
 
-    for dev, m in device_metrics.items():
-        name = device_label(dev)
-
-        if m["battery_reporting_quality"] < 0.7:
-            st.markdown(f"- **{name}** has poor battery telemetry quality.")
-
-        if m["confidence_trend"] == "degrading":
-            st.markdown(f"- **{name}** shows degrading confidence over time.")
-
-        if m["data_completeness"] < 0.75:
-            st.markdown(f"- **{name}** frequently reports incomplete telemetry.")
+    for insight in rules.fleet_insights(
+        rule_table, lambda d: f"**{device_label(d)}**"
+    ):
+        st.markdown(f"- {insight}")
 
 # --------------------------------------------------
 # FLEET CONFIDENCE BY DEVICE
 # --------------------------------------------------
-with st.expander("Fleet Confidence by Device", expanded=False):
+with st.expander("Fleet Confidence by Device", expanded=False), instrument.span("app.section.fleet_confidence"):
     st.markdown(
         "Each point represents a device. Lower confidence indicates unreliable telemetry."
     )
@@ -185,7 +260,7 @@ with st.expander("Fleet Confidence by Device", expanded=False):
                 title="Device"
             ),
             color=alt.condition(
-                alt.datum.avg_confidence < 70,
+                alt.datum.avg_confidence < LOW_CONFIDENCE,
                 alt.value("#E45756"),
                 alt.value("#4C78A8")
             ),
@@ -195,15 +270,15 @@ with st.expander("Fleet Confidence by Device", expanded=False):
     )
 
     threshold = alt.Chart(
-        pd.DataFrame({"x": [70]})
+        pd.DataFrame({"x": [LOW_CONFIDENCE]})
     ).mark_rule(color="#E45756").encode(x="x:Q")
 
-    st.altair_chart(scatter + threshold, use_container_width=True)
+    show_chart(scatter + threshold)
 
 # --------------------------------------------------
 # CONFIDENCE OVER TIME
 # --------------------------------------------------
-with st.expander("Confidence Over Time (Per Device)", expanded=False):
+with st.expander("Confidence Over Time (Per Device)", expanded=False), instrument.span("app.section.device_confidence"):
     st.markdown(
         "Shows how trust evolves over time for a selected device."
     )
@@ -213,32 +288,40 @@ with st.expander("Confidence Over Time (Per Device)", expanded=False):
         sorted(conf_df["device"])
     )
 
-    ts = df_events[df_events["device"] == selected]
-
-    line = (
-        alt.Chart(ts)
-        .mark_line(color="#4C78A8")
-        .encode(
-            x=alt.X("timestamp:T", title="Time"),
-            y=alt.Y(
-                "confidence:Q",
-                title="Confidence Score",
-                scale=alt.Scale(domain=[0, 100])
-            )
-        )
-        .properties(height=300)
+    label_to_dev = {device_label(d): d for d in device_metrics}
+    visible = st.slider(
+        "Time range",
+        min_value=pd.Timestamp(data_start, tz="UTC").to_pydatetime(),
+        max_value=pd.Timestamp(data_end, tz="UTC").to_pydatetime(),
+        value=(
+            pd.Timestamp(data_start, tz="UTC").to_pydatetime(),
+            pd.Timestamp(data_end, tz="UTC").to_pydatetime(),
+        ),
+        format="YYYY-MM-DD HH:mm",
+        key="device_range",
+    )
+    resolution, frame = cache.data.rollups.series(
+        "device",
+        label_to_dev.get(selected, selected),
+        pd.Timestamp(visible[0]).value,
+        pd.Timestamp(visible[1]).value,
     )
+    st.caption(f"Confidence per {resolution} bucket: mean line, min-max band.")
+
+    line = band_chart(
+        rollup_frame(frame, "confidence"), "Confidence Score", domain=[0, 100]
+    ).properties(height=300)
 
     warn_line = alt.Chart(
-        pd.DataFrame({"y": [70]})
+        pd.DataFrame({"y": [LOW_CONFIDENCE]})
     ).mark_rule(color="#E45756").encode(y="y:Q")
 
-    st.altair_chart(line + warn_line, use_container_width=True)
+    show_chart(line + warn_line)
 
 # --------------------------------------------------
 # GATEWAY RF STABILITY (GATEWAY NAMES)
 # --------------------------------------------------
-with st.expander("Gateway RF Stability", expanded=False):
+with st.expander("Gateway RF Stability", expanded=False), instrument.span("app.section.gateways"):
     st.markdown(
         "RSSI variance per gateway. Higher variance indicates unstable RF conditions."
     )
@@ -258,33 +341,47 @@ with st.expander("Gateway RF Stability", expanded=False):
             x=alt.X("gateway:N", title="Gateway"),
             y=alt.Y("rssi_std:Q", title="RSSI Variance"),
             color=alt.condition(
-                alt.datum.rssi_std > 12,
+                alt.datum.rssi_std > rules.UNSTABLE_GATEWAY_RSSI_STD,
                 alt.value("#E45756"),
                 alt.value("#4C78A8")
             ),
-            tooltip=["gateway", "rssi_std", "avg_confidence", "event_count"]
+            tooltip=[
+                "gateway", "rssi_std", "rssi_p5", "rssi_p50", "snr_p50",
+                "avg_confidence", "event_count", "distinct_devices",
+            ]
         )
         .properties(height=300)
     )
 
-    st.altair_chart(gw_chart, use_container_width=True)
+    show_chart(gw_chart)
+
+    selected_gw = st.selectbox(
+        "Gateway RSSI over time",
+        sorted(gateway_name_map, key=gateway_label),
+        format_func=gateway_label,
+    )
+    if selected_gw is not None:
+        resolution, frame = cache.data.rollups.series(
+            "gateway", selected_gw, data_start, data_end
+        )
+        st.caption(f"RSSI per {resolution} bucket: mean line, min-max band.")
+        show_chart(
+            band_chart(rollup_frame(frame, "rssi"), "RSSI (dBm)").properties(height=300)
+        )
 
 # --------------------------------------------------
 # MAINTENANCE PRIORITY
 # --------------------------------------------------
-with st.expander("Maintenance Priority", expanded=False):
+with st.expander("Maintenance Priority", expanded=False), instrument.span("app.section.maintenance"):
     st.markdown(
         "Devices ranked by maintenance risk."
     )
 
-    maint_df = pd.DataFrame([
-        {
-            "device": device_label(d),
-            "risk": maintenance_risk(m)
-        }
-        for d, m in device_metrics.items()
-        if maintenance_risk(m) > 0
-    ]).sort_values("risk", ascending=False)
+    maint_df = pd.DataFrame({
+        "device": [device_label(d) for d in rule_table["devices"]],
+        "risk": rule_table["risk"],
+    })
+    maint_df = maint_df[maint_df["risk"] > 0].sort_values("risk", ascending=False)
 
     risk_chart = (
         alt.Chart(maint_df)
@@ -297,117 +394,220 @@ with st.expander("Maintenance Priority", expanded=False):
         .properties(height=350)
     )
 
-    st.altair_chart(risk_chart, use_container_width=True)
+    show_chart(risk_chart)
 
 # --------------------------------------------------
 # SLA STATUS
 # --------------------------------------------------
-with st.expander("SLA Status", expanded=False):
-    sla_df = pd.DataFrame([
-        {
-            "device": device_label(d),
-            "sla": sla_status(m),
-            "confidence": m["avg_confidence"],
-            "completeness": m["data_completeness"],
-        }
-        for d, m in device_metrics.items()
-    ])
+with st.expander("SLA Status", expanded=False), instrument.span("app.section.sla"):
+    sla_df = pd.DataFrame({
+        "device": [device_label(d) for d in rule_table["devices"]],
+        "sla": rule_table["sla"],
+        "confidence": rule_table["avg_confidence"],
+        "completeness": rule_table["data_completeness"],
+    })
 
     st.dataframe(sla_df, use_container_width=True)
+
 # --------------------------------------------------
-# TRUST REPLAY (TIME FLOW)
+# WHAT-IF SCORING
 # --------------------------------------------------
-with st.expander("Trust Replay (Time Flow)", expanded=False):
-    st.markdown(
-        "Replay how **trust and reliability evolve over time**. "
-        "Drag the slider to inspect the system state at any moment."
-    )
+with st.expander("What-If Scoring", expanded=False), instrument.span("app.section.rescore"):
+    if out_of_core:
+        st.info(
+            "Rescoring needs every event in memory; it is not available "
+            "while running out-of-core (SENTINELMESH_MAX_MEMORY)."
+        )
+    else:
+        st.markdown(
+            "Re-weight the confidence penalties and compare **fleet SLA** "
+            "against the scores in the events."
+        )
 
-    # Determine replay range
-    min_time = df_events["timestamp"].min()
-    max_time = df_events["timestamp"].max()
+        weight_cols = st.columns(5)
+        what_if = {
+            name: weight_cols[i % 5].number_input(
+                name, min_value=0.0, value=float(value), step=1.0, key=f"weight:{name}"
+            )
+            for i, (name, value) in enumerate(WEIGHTS.items())
+        }
 
-    replay_time = st.slider(
-        "Replay Time",
-        min_value=min_time.to_pydatetime(),
-        max_value=max_time.to_pydatetime(),
-        value=max_time.to_pydatetime(),
-        format="YYYY-MM-DD HH:mm"
-    )
+        rescorer = cache.get("rescorer", lambda d: Rescorer(d.store))
+        comparison = cache.recent(
+            "rescore",
+            (metrics_window, tuple(sorted(what_if.items()))),
+            lambda d: rescorer.compare(what_if, window=metrics_window),
+        )
 
-    # Filter events up to replay time
-    replay_df = df_events[df_events["timestamp"] <= pd.Timestamp(replay_time)]
-    # ----------------------------
-    # CONFIDENCE OVER TIME (ALL DEVICES)
-    # ----------------------------
-    st.markdown("### Fleet Confidence Over Time")
+        counts_df = pd.DataFrame(
+            comparison["counts"].values(),
+            index=list(comparison["counts"]),
+            columns=["current", "what-if"],
+        )
+        st.dataframe(counts_df, use_container_width=True)
+
+        changed = set(comparison["changed"])
+        compare_df = pd.DataFrame({
+            "device": [device_label(d) for d in comparison["devices"]],
+            "sla": comparison["sla_before"],
+            "what-if sla": comparison["sla_after"],
+            "confidence": comparison["confidence_before"],
+            "what-if confidence": comparison["confidence_after"],
+            "changed": [d in changed for d in comparison["devices"]],
+        }).sort_values(["changed", "what-if confidence"], ascending=[False, True])
+        st.caption(f"{len(changed)} devices change SLA status.")
+        st.dataframe(compare_df, use_container_width=True)
 
-    fleet_chart = (
-        alt.Chart(replay_df)
-        .mark_line(opacity=0.5)
-        .encode(
-            x=alt.X("timestamp:T", title="Time"),
-            y=alt.Y(
-                "confidence:Q",
-                title="Confidence Score",
-                scale=alt.Scale(domain=[0, 100])
-            ),
-            color=alt.Color(
-                "device:N",
-                legend=None
-            ),
-            tooltip=["device", "confidence", "timestamp:T"]
+# --------------------------------------------------
+# TRUST REPLAY (TIME FLOW)
+# --------------------------------------------------
+with st.expander("Trust Replay (Time Flow)", expanded=False), instrument.span("app.section.replay"):
+    # With a segment log (see segments.py) the index covers just the
+    # window asked for, reading only the segments overlapping it; without
+    # one it is built over the whole store once per version.
+    log = segment_log(registry.sites[site])
+    if out_of_core and log is None:
+        st.info(
+            "Trust Replay needs every event in memory or a segment log "
+            "(python segments.py); it is not available while running "
+            "out-of-core (SENTINELMESH_MAX_MEMORY) without one."
+        )
+    else:
+        st.markdown(
+            "Replay how **trust and reliability evolve over time**. "
+            "Drag the slider to inspect the system state at any moment."
         )
-        .properties(height=300)
-    )
 
-    threshold = alt.Chart(
-        pd.DataFrame({"y": [70]})
-    ).mark_rule(color="#E45756").encode(y="y:Q")
+        def replay_index(start, end):
+            if log is None:
+                return cache.get("replay", lambda d: ReplayIndex(d.store))
+            return cache.recent(
+                "replay", (start, end), lambda d: ReplayIndex.from_segments(log, start, end)
+            )
 
-    st.altair_chart(fleet_chart + threshold, use_container_width=True)
+        # Determine replay range
+        first_ns, last_ns = (data_start, data_end) if log is None else log.time_range()
+        min_time = pd.Timestamp(first_ns, tz="UTC")
+        max_time = pd.Timestamp(last_ns, tz="UTC")
+
+        replay_time = st.slider(
+            "Replay Time",
+            min_value=min_time.to_pydatetime(),
+            max_value=max_time.to_pydatetime(),
+            value=max_time.to_pydatetime(),
+            format="YYYY-MM-DD HH:mm"
+        )
 
-    # ----------------------------
-    # DEVICE STATE AT REPLAY TIME
-    # ----------------------------
-    st.markdown("### Device State at Selected Time")
+        replay_ns = pd.Timestamp(replay_time).value
+
+        # ----------------------------
+        # CONFIDENCE OVER TIME (ALL DEVICES)
+        # ----------------------------
+        st.markdown("### Fleet Confidence Over Time")
+
+        resolution, frame = cache.data.rollups.fleet("device", first_ns, replay_ns)
+        replay_df = rollup_frame(frame, "confidence", device_label)
+        st.caption(f"Mean confidence per device and {resolution} bucket.")
+
+        fleet_chart = (
+            alt.Chart(replay_df)
+            .mark_line(opacity=0.5)
+            .encode(
+                x=alt.X("timestamp:T", title="Time"),
+                y=alt.Y(
+                    "mean:Q",
+                    title="Confidence Score",
+                    scale=alt.Scale(domain=[0, 100])
+                ),
+                color=alt.Color(
+                    "entity:N",
+                    legend=None
+                ),
+                tooltip=["entity", "mean", "min", "max", "count", "timestamp:T"]
+            )
+            .properties(height=300)
+        )
 
-    latest_state = (
-        replay_df.sort_values("timestamp")
-        .groupby("device")
-        .tail(1)
-    )
+        threshold = alt.Chart(
+            pd.DataFrame({"y": [LOW_CONFIDENCE]})
+        ).mark_rule(color="#E45756").encode(y="y:Q")
+
+        show_chart(fleet_chart + threshold)
+
+        # ----------------------------
+        # DEVICE STATE AT REPLAY TIME
+        # ----------------------------
+        st.markdown("### Device State at Selected Time")
+
+        replay = replay_index(replay_ns, replay_ns)
+        codes, confidence, _ = replay.state_at(replay_ns)
+        state_df = pd.DataFrame({
+            "device": [device_label(replay.devices[c]) for c in codes],
+            "confidence": confidence,
+        })
+        state_df["status"] = state_df["confidence"].apply(
+            lambda x: "At Risk" if x < LOW_CONFIDENCE else "Healthy"
+        )
 
-    state_df = latest_state[["device", "confidence"]].copy()
-    state_df["status"] = state_df["confidence"].apply(
-        lambda x: "At Risk" if x < 70 else "Healthy"
-    )
+        st.dataframe(
+            state_df.sort_values("confidence"),
+            use_container_width=True
+        )
 
-    st.dataframe(
-        state_df.sort_values("confidence"),
-        use_container_width=True
-    )
+        # ----------------------------
+        # ACTIVE WARNINGS AT REPLAY TIME
+        # ----------------------------
+        st.markdown("### Active Warnings")
 
-    # ----------------------------
-    # ACTIVE WARNINGS AT REPLAY TIME
-    # ----------------------------
-    st.markdown("### Active Warnings")
+        warnings = state_df[state_df["confidence"] < LOW_CONFIDENCE]
 
-    warnings = state_df[state_df["confidence"] < 70]
+        if len(warnings) == 0:
+            st.success("No devices below confidence threshold at this time.")
+        else:
+            for _, row in warnings.iterrows():
+                st.markdown(
+                    f"- **{row['device']}** confidence dropped to {row['confidence']}"
+                )
+
+        # ----------------------------
+        # THRESHOLD CROSSINGS
+        # ----------------------------
+        st.markdown("### Threshold Crossings")
+
+        window_start = min_time if log is None else max(
+            min_time, pd.Timestamp(replay_time) - pd.Timedelta(days=1)
+        )
+        window = st.slider(
+            "Crossing Window",
+            min_value=min_time.to_pydatetime(),
+            max_value=max_time.to_pydatetime(),
+            value=(window_start.to_pydatetime(), replay_time),
+            format="YYYY-MM-DD HH:mm"
+        )
 
-    if len(warnings) == 0:
-        st.success("No devices below confidence threshold at this time.")
-    else:
-        for _, row in warnings.iterrows():
-            st.markdown(
-                f"- **{row['device']}** confidence dropped to {row['confidence']}"
+        window_ns = (pd.Timestamp(window[0]).value, pd.Timestamp(window[1]).value)
+        replay = replay_index(*window_ns)
+        crossings = replay.crossings(*window_ns)
+
+        if not crossings:
+            st.info("No devices crossed the confidence threshold in this window.")
+        else:
+            st.dataframe(
+                pd.DataFrame(
+                    [
+                        (device_label(replay.devices[c]), before, after, n)
+                        for c, before, after, n in crossings
+                    ],
+                    columns=["device", "confidence_before", "confidence_after", "crossings"]
+                ),
+                use_container_width=True
             )
 # --------------------------------------------------
 # GUIDED QUERY INTERFACE
 # --------------------------------------------------
 from query_engine import parse_query, handle_query
 
-with st.expander("Interactive Query", expanded=True):
+with st.expander("Interactive Query", expanded=True), instrument.span("app.section.query"):
     st.markdown("### What exists in this system")
 
     c1, c2 = st.columns(2)
@@ -429,7 +629,8 @@ with st.expander("Interactive Query", expanded=True):
         "- What devices are faulty?\n"
         "- Which gateway does **Door Sensor 08** use?\n"
         "- Which devices use **Gateway-1**?\n"
-        "- Which gateways are unstable?"
+        "- Which gateways are unstable?\n"
+        "- p5 RSSI at **Gateway-3**? Median SNR of **Door Sensor 08**?"
     )
 
     st.divider()
@@ -437,14 +638,19 @@ with st.expander("Interactive Query", expanded=True):
     user_q = st.text_input("Ask a question")
 
     if user_q:
-        intent, arg = parse_query(user_q)
-        response = handle_query(
-            intent,
-            arg,
-            events,
-            device_metrics,
-            device_name_map,
-            gateway_name_map,
+        intent, arg = parse_query(user_q, cache.data.query_index.matcher)
+        response = cache.answer(
+            (intent, arg, metrics_window),
+            lambda: handle_query(
+                intent,
+                arg,
+                events,
+                device_metrics,
+                device_name_map,
+                gateway_name_map,
+                index=cache.data.query_index,
+                fleet=cache.data.fleet,
+            )
         )
 
         st.markdown("### Answer")
@@ -456,3 +662,58 @@ with st.expander("Interactive Query", expanded=True):
             st.json(response)
         else:
             st.markdown(response)
+
+# --------------------------------------------------
+# PERFORMANCE
+# --------------------------------------------------
+if profiling:
+    instrument.record("app.rerun", time.perf_counter() - rerun_start)
+
+with st.expander("Performance", expanded=False):
+    if not profiling:
+        st.info("Turn on **Profile performance** in the sidebar to record stage timings.")
+    else:
+        perf = instrument.report()
+
+        c1, c2, c3 = st.columns(3)
+        c1.metric("RSS", f"{perf['rss_bytes'] / 2**20:.0f} MiB")
+        c2.metric("Peak RSS", f"{perf['peak_rss_bytes'] / 2**20:.0f} MiB")
+        c3.metric("Events Loaded", cache.data.event_count)
+
+        st.markdown("**Stages** (totals from every profiling session since the last reset)")
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    (
+                        name,
+                        s["calls"],
+                        s["total_seconds"] * 1000,
+                        s["mean_seconds"] * 1000,
+                        s["max_seconds"] * 1000,
+                        s["peak_rss_growth_bytes"] / 2**20,
+                    )
+                    for name, s in perf["spans"].items()
+                ],
+                columns=["stage", "calls", "total_ms", "mean_ms", "max_ms", "peak_rss_growth_mib"],
+            ).sort_values("total_ms", ascending=False),
+            use_container_width=True,
+        )
+
+        if perf["counters"]:
+            st.markdown("**Counters**")
+            st.dataframe(
+                pd.DataFrame(list(perf["counters"].items()), columns=["counter", "value"]),
+                use_container_width=True,
+            )
+
+        d1, d2, d3 = st.columns(3)
+        d1.download_button(
+            "Download JSON", instrument.to_json(perf),
+            file_name="sentinelmesh-profile.json", mime="application/json",
+        )
+        d2.download_button(
+            "Download Prometheus", instrument.to_prometheus(perf),
+            file_name="sentinelmesh-profile.prom", mime="text/plain",
+        )
+        if d3.button("Reset"):
+            instrument.reset()
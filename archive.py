@@ -0,0 +1,394 @@
+import argparse
+import bz2
+import glob
+import gzip
+import heapq
+import io
+import lzma
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from collections import deque
+
+import numpy as np
+
+from decode import Projection, loads
+from store import NAT, format_timestamp, parse_timestamp
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Streaming reader for rotated, compressed event archives.
+#
+# A spec (a file, a directory, a glob or a list of them) names plain JSONL
+# files and gzip / zstd / bz2 / xz compressed ones, told apart by their
+# magic bytes. Each file is decompressed by its own thread into a bounded
+# queue of line batches, so decompression (which releases the GIL) runs in
+# parallel across files and alongside decoding. The files are k-way merged
+# by timestamp; a file only joins the merge when the merge reaches its
+# first timestamp, and the next `workers` files are decompressed ahead, so
+# time-disjoint rotations are read one after another without waiting.
+#
+# Each file is assumed to be in timestamp order, as enrich.py writes it.
+# zstd needs Python 3.14's compression.zstd, the zstandard package or the
+# zstd command line tool.
+
+CHUNK = 1 << 20            # decompressed bytes per read
+QUEUE_DEPTH = 8            # chunks buffered per file
+WORKERS = 4                # files decompressed ahead of the merge
+BATCH_SIZE = 65536
+
+MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+}
+SUFFIXES = (".jsonl", ".json", ".gz", ".zst", ".zstd", ".bz2", ".xz")
+
+# numeric columns of read_batches; everything else is an object column
+NUMERIC = {"rssi", "snr", "confidence_score"}
+BATCH_FIELDS = ["devEui", "gatewayId", "rssi", "snr", "confidence_score"]
+
+
+# -------------------------
+# FILES
+# -------------------------
+
+def _is_event_file(name):
+    # enriched_events.jsonl, .jsonl.1, .jsonl.2.gz, events-2025-01.jsonl.zst, ...
+    return name.endswith(SUFFIXES) or ".jsonl." in name
+
+
+def archive_files(spec):
+    # The files a spec names, sorted by path within each directory / glob
+    if isinstance(spec, (list, tuple)):
+        return [f for s in spec for f in archive_files(s)]
+    if os.path.isdir(spec):
+        return sorted(
+            os.path.join(spec, name)
+            for name in os.listdir(spec)
+            if _is_event_file(name) and os.path.isfile(os.path.join(spec, name))
+        )
+    if glob.has_magic(spec):
+        return sorted(p for p in glob.glob(spec) if os.path.isfile(p))
+    return [spec]
+
+
+def compression(path):
+    with open(path, "rb") as f:
+        head = f.read(6)
+    for magic, kind in MAGIC.items():
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+class _ZstdProcess(io.RawIOBase):
+    # `zstd -dc path` as a readable file
+    def __init__(self, path):
+        self.proc = subprocess.Popen(
+            ["zstd", "-dcq", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.proc.stdout.readinto(b)
+
+    def close(self):
+        if not self.closed:
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            if self.proc.returncode not in (0, -9):
+                raise OSError(self.proc.stderr.read().decode(errors="replace").strip())
+            self.proc.stderr.close()
+        super().close()
+
+
+def _open_zstd(path):
+    if zstd is not None:
+        return zstd.open(path, "rb")
+    if zstandard is not None:
+        raw = open(path, "rb")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+    if shutil.which("zstd"):
+        return io.BufferedReader(_ZstdProcess(path))
+    raise RuntimeError(f"{path}: reading zstd needs compression.zstd, zstandard or the zstd tool")
+
+
+def open_archive(path):
+    # A binary, decompressing file object for path
+    kind = compression(path)
+    if kind == "gzip":
+        return gzip.open(path, "rb")
+    if kind == "zstd":
+        return _open_zstd(path)
+    if kind == "bz2":
+        return bz2.open(path, "rb")
+    if kind == "xz":
+        return lzma.open(path, "rb")
+    return open(path, "rb")
+
+
+# -------------------------
+# LINES
+# -------------------------
+
+TS_KEY = b'"timestamp"'
+
+
+def line_timestamp(line):
+    # ns since epoch of an event line, without decoding the whole event
+    i = line.find(TS_KEY)
+    if i >= 0:
+        start = line.find(b'"', i + len(TS_KEY) + 1)
+        end = line.find(b'"', start + 1)
+        if start >= 0 and end >= 0:
+            return parse_timestamp(line[start + 1:end].decode())
+    return parse_timestamp(loads(line).get("timestamp"))
+
+
+def first_timestamp(path):
+    # timestamp of the first event in path, None for a file without events
+    with open_archive(path) as f:
+        for line in f:
+            if line.strip():
+                return line_timestamp(line)
+    return None
+
+
+class _Stream:
+    # Lines of one file, decompressed by a background thread
+    def __init__(self, path, first_ts):
+        self.path = path
+        self.first_ts = first_ts
+        self.queue = queue.Queue(QUEUE_DEPTH)
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            with open_archive(self.path) as f:
+                rest = b""
+                while not self.stopped:
+                    data = f.read(CHUNK)
+                    if not data:
+                        break
+                    data = rest + data
+                    end = data.rfind(b"\n") + 1
+                    rest = data[end:]
+                    self._put(data[:end].splitlines())
+                if rest.strip():
+                    self._put([rest])
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def batches(self):
+        # non-empty lists of event lines, in file order
+        self.start()
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            batch = [line for line in batch if line.strip()]
+            if batch:
+                yield batch
+
+    def close(self):
+        self.stopped = True
+
+
+class _Cursor:
+    # read position in a stream's batches
+    def __init__(self, stream):
+        self.batches = stream.batches()
+        self.batch = []
+        self.i = 0
+
+    def advance(self):
+        # False once the stream is exhausted
+        while self.i >= len(self.batch):
+            self.batch = next(self.batches, None)
+            if self.batch is None:
+                return False
+            self.i = 0
+        return True
+
+    def ts(self):
+        return line_timestamp(self.batch[self.i])
+
+
+def read_lines(spec, start=None, end=None, workers=WORKERS):
+    # Raw lines of every event the spec names, in timestamp order; start /
+    # end (ns, inclusive) bound the range. Reading stops as soon as every
+    # remaining event is past end.
+    #
+    # While a single file is being read, a whole decompressed batch that
+    # ends before the next file starts (and inside [start, end]) is passed
+    # through without parsing the timestamps in between.
+    streams = []
+    for path in archive_files(spec):
+        ts = first_timestamp(path)
+        if ts is not None:
+            streams.append(_Stream(path, ts))
+    streams.sort(key=lambda s: s.first_ts)
+    pending = deque(streams)
+    heap = []
+
+    def prefetch():
+        for s in list(pending)[:workers]:
+            s.start()
+
+    def step(c, seq):
+        if c.advance():
+            heapq.heapreplace(heap, (c.ts(), seq, c))
+        else:
+            heapq.heappop(heap)
+
+    try:
+        seq = 0
+        while pending or heap:
+            if pending and (not heap or pending[0].first_ts <= heap[0][0]):
+                c = _Cursor(pending.popleft())
+                if c.advance():
+                    seq += 1
+                    heapq.heappush(heap, (c.ts(), seq, c))
+                prefetch()
+                continue
+
+            ts, key, c = heap[0]
+            if end is not None and ts != NAT and ts > end and (
+                not pending or pending[0].first_ts > end
+            ):
+                return
+
+            if len(heap) == 1 and ts != NAT and (start is None or ts >= start):
+                last = line_timestamp(c.batch[-1])
+                if last != NAT and (not pending or last < pending[0].first_ts) and (
+                    end is None or last <= end
+                ):
+                    yield from c.batch[c.i:]
+                    c.i = len(c.batch)
+                    step(c, key)
+                    continue
+
+            line = c.batch[c.i]
+            c.i += 1
+            step(c, key)
+            if start is None or ts == NAT or ts >= start:
+                if end is None or ts == NAT or ts <= end:
+                    yield line
+    finally:
+        for s in streams:
+            s.close()
+
+
+def read_events(spec, fields=None, start=None, end=None, workers=WORKERS):
+    # Decoded events in timestamp order: full dicts, or decode.Projection
+    # records of fields
+    decode = Projection(fields) if fields is not None else loads
+    for line in read_lines(spec, start, end, workers):
+        yield decode(line)
+
+
+def read_batches(spec, fields=BATCH_FIELDS, batch_size=BATCH_SIZE, start=None,
+                 end=None, workers=WORKERS):
+    # Column batches in timestamp order: {"timestamp": int64 ns, field:
+    # float64 (None -> NaN) for rssi / snr / confidence_score, object
+    # otherwise}, at most batch_size rows each
+    decode = Projection(["timestamp"] + list(fields))
+    records = []
+
+    def batch():
+        columns = {
+            "timestamp": np.array([parse_timestamp(r[0]) for r in records], dtype=np.int64)
+        }
+        for i, field in enumerate(fields, 1):
+            values = [r[i] for r in records]
+            if field in NUMERIC:
+                columns[field] = np.array(
+                    [np.nan if v is None else v for v in values], dtype=np.float64
+                )
+            else:
+                columns[field] = np.array(values + [None], dtype=object)[:-1]
+        return columns
+
+    for line in read_lines(spec, start, end, workers):
+        records.append(decode(line))
+        if len(records) >= batch_size:
+            yield batch()
+            records = []
+    if records:
+        yield batch()
+
+
+if __name__ == "__main__":
+    from segments import SegmentLog
+
+    parser = argparse.ArgumentParser(
+        description="Read rotated / compressed event archives in timestamp order"
+    )
+    parser.add_argument("spec", nargs="+", help="files, directories or globs")
+    parser.add_argument("--start", default=None, help="ISO timestamp")
+    parser.add_argument("--end", default=None, help="ISO timestamp")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--segments", default=None,
+                        help="backfill the events into this segment log (see segments.py)")
+    args = parser.parse_args()
+
+    start = parse_timestamp(args.start) if args.start else None
+    end = parse_timestamp(args.end) if args.end else None
+    log = SegmentLog(args.segments) if args.segments else None
+
+    n = 0
+    first = last = None
+    lines = []
+    for line in read_lines(args.spec, start, end, args.workers):
+        n += 1
+        if first is None:
+            first = line
+        last = line
+        if log is not None:
+            lines.append(line)
+            if len(lines) >= BATCH_SIZE:
+                log.append_lines(lines)
+                lines = []
+    if log is not None:
+        log.append_lines(lines)
+
+    files = len(archive_files(args.spec))
+    span = ""
+    if first is not None:
+        span = (f", {format_timestamp(line_timestamp(first))}"
+                f" .. {format_timestamp(line_timestamp(last))}")
+    print(f"{n} events from {files} files{span}"
+          + (f" -> {args.segments}" if log is not None else ""))
@@ -0,0 +1,300 @@
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+import instrument
+import workload
+from accumulators import FleetStats
+from engine import analyze_gateways, build_device_index, build_gateway_index, load_events
+from metrics import DeviceMetrics
+from query_engine import QueryIndex, handle_query, parse_query
+from replay import ReplayIndex
+from rescore import Rescorer, load_weights
+from store import STORE_FIELDS, load_store
+
+# Benchmark harness.
+#
+# For each scale, a workload.py dataset is generated (and kept in the work
+# directory for later runs), then every stage is timed and memory-profiled:
+# loading, index building, gateway analysis, every handle_query intent and
+# Trust Replay lookups. Each stage runs `repeat` times for timing and once
+# more under tracemalloc for its peak allocation. Results are written as
+# JSON; --compare checks them against an earlier results file.
+#
+# Stages that materialize one dict per event are skipped above --dict-limit
+# events, where they would not fit in memory.
+
+# one question per handle_query intent; {dev} / {gw} are filled in with the
+# names of existing entities
+QUESTIONS = {
+    "list_devices": "what devices exist",
+    "list_gateways": "what gateways exist",
+    "count_devices": "how many devices are there",
+    "count_gateways": "how many gateways are there",
+    "faulty_devices": "what devices are faulty",
+    "maintenance_devices": "which devices needs maintenance",
+    "worst_device": "which device is most unreliable",
+    "device_id": "what is the device id of {dev}",
+    "sensor_type": "what sensor type is {dev}",
+    "last_seen": "when was the last data received from {dev}",
+    "device_location": "where is {dev}",
+    "message_count": "how many messages has {dev} sent",
+    "device_confidence": "what is the average confidence of {dev}",
+    "device_health": "is {dev} healthy",
+    "device_gateway": "which gateway does {dev} use",
+    "gateway_devices": "which devices use {gw}",
+    "gateway_events": "how many events did {gw} handle",
+    "unstable_gateways": "list unstable gateways",
+    "percentile": "p5 rssi at {gw}",
+}
+
+REPLAY_LOOKUPS = 100
+# profile for the rescore stages
+WHAT_IF = load_weights(overrides=["weak_rssi=25", "very_weak_rssi=40", "missing_battery=25"])
+DICT_LIMIT = 10**6
+
+
+def measure(fn, repeat=1, memory=True):
+    # Returns (result of the last call, record) for fn()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+        if len(times) < repeat:
+            result = None
+
+    record = {
+        "seconds": min(times),
+        "median_seconds": statistics.median(times),
+        "runs": repeat,
+    }
+    if memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = fn()
+        record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record["rss_bytes"] = instrument.rss()[0]
+    return result, record
+
+
+def workload_params(events, days=7, interval=600, loss=0.02, seed=0):
+    per_device = days * 86_400 / interval * (1 - loss)
+    devices = max(10, math.ceil(events / per_device))
+    return {
+        "devices": devices,
+        "gateways": max(4, devices // 25),
+        "days": days,
+        "count": events,
+        "interval": interval,
+        "loss": loss,
+        "seed": seed,
+    }
+
+
+def dataset(workdir, events, seed=0):
+    # path of the workload file for this scale, generating it if needed
+    params = workload_params(events, seed=seed)
+    path = os.path.join(workdir, f"workload-{events}-{seed}.jsonl")
+    if not os.path.exists(path):
+        tmp = path + ".tmp"
+        workload.generate(tmp, **params)
+        os.replace(tmp, path)
+    return path, params
+
+
+def name_maps(store):
+    devices = {
+        store.devices[code]: info["name"]
+        for code, info in enumerate(store.device_info)
+        if info.get("name")
+    }
+    gateways = {gid: f"Gateway-{i+1}" for i, gid in enumerate(sorted(store.gateways))}
+    return devices, gateways
+
+
+def run_scale(path, events, repeat=3, memory=True, dict_limit=DICT_LIMIT, log=print):
+    results = []
+
+    def stage(name, fn, runs=1, skip=False):
+        if skip:
+            results.append({"events": events, "stage": name, "status": "skipped"})
+            log(f"  {name:<36} skipped")
+            return None
+        result, record = measure(fn, runs, memory)
+        results.append({"events": events, "stage": name, "status": "ok", **record})
+        log(f"  {name:<36} {record['seconds'] * 1000:10.2f} ms"
+            + (f"  peak {record['peak_bytes'] / 2**20:9.1f} MiB" if memory else ""))
+        return result
+
+    # loading
+    dicts = events > dict_limit
+    event_list = stage("load_events", lambda: load_events(path), skip=dicts)
+    stage("load_events[projected]", lambda: load_events(path, STORE_FIELDS), skip=dicts)
+    store = stage("load_store", lambda: load_store(path))
+
+    # indexes
+    if event_list is not None:
+        stage("build_device_index[dicts]", lambda: build_device_index(event_list), repeat)
+        gw_index = stage("build_gateway_index[dicts]", lambda: build_gateway_index(event_list), repeat)
+        stage("analyze_gateways[dicts]", lambda: analyze_gateways(gw_index), repeat)
+        del event_list, gw_index
+    else:
+        for name in ("build_device_index[dicts]", "build_gateway_index[dicts]",
+                     "analyze_gateways[dicts]"):
+            stage(name, None, skip=True)
+
+    stage("build_device_index", lambda: build_device_index(store), repeat)
+    gw_index = stage("build_gateway_index", lambda: build_gateway_index(store), repeat)
+    stage("analyze_gateways", lambda: analyze_gateways(gw_index), repeat)
+
+    def device_metrics():
+        m = DeviceMetrics()
+        m.update_store(store)
+        return m.snapshot()
+
+    metrics = stage("device_metrics", device_metrics)
+
+    def fleet_stats():
+        fleet = FleetStats()
+        fleet.update_store(store)
+        return fleet
+
+    fleet = stage("fleet_stats", fleet_stats)
+
+    rescorer = stage("rescore[frame_gaps]", lambda: Rescorer(store))
+    stage("rescore[score]", lambda: rescorer.score(WHAT_IF), repeat)
+
+    # queries
+    device_names, gateway_names = name_maps(store)
+
+    def query_index():
+        index = QueryIndex(device_names, gateway_names)
+        index.add_store(store)
+        return index
+
+    index = stage("query_index", query_index)
+    dev = next(iter(device_names.values()), "")
+    gw = next(iter(gateway_names.values()), "")
+    for intent, question in QUESTIONS.items():
+        text = question.format(dev=dev.lower(), gw=gw.lower())
+        parsed, arg = parse_query(text, index.matcher)
+        if parsed != intent:
+            raise ValueError(f"{text!r} parses as {parsed}, not {intent}")
+        stage(
+            f"handle_query[{intent}]",
+            lambda: handle_query(
+                intent, arg, None, metrics, device_names, gateway_names, index, fleet
+            ),
+            repeat,
+        )
+
+    # replay
+    replay = stage("replay_index", lambda: ReplayIndex(store))
+    if len(replay):
+        lo, hi = int(replay.min_time), int(replay.max_time)
+        times = np.linspace(lo, hi, REPLAY_LOOKUPS).astype(np.int64).tolist()
+        stage("replay_state_at", lambda: [replay.state_at(t) for t in times], repeat)
+        stage(
+            "replay_crossings",
+            lambda: [replay.crossings(a, b) for a, b in zip(times, times[1:])],
+            repeat,
+        )
+    return results
+
+
+def meta():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold=1.2):
+    # Stages at least threshold times slower than in baseline, as
+    # (events, stage, baseline seconds, seconds)
+    before = {
+        (r["events"], r["stage"]): r["seconds"]
+        for r in baseline["results"]
+        if r["status"] == "ok"
+    }
+    slower = []
+    for r in results["results"]:
+        old = before.get((r["events"], r["stage"]))
+        if r["status"] == "ok" and old and r["seconds"] >= old * threshold:
+            slower.append((r["events"], r["stage"], old, r["seconds"]))
+    return slower
+
+
+def _sizes(text):
+    return [int(float(s)) for s in text.split(",") if s]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SentinelMesh benchmark suite")
+    parser.add_argument("--sizes", type=_sizes, default=_sizes("1e4,1e5"),
+                        help="comma-separated event counts, e.g. 1e4,1e5,1e6")
+    parser.add_argument("--workdir", default=".bench", help="where generated workloads are kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timing runs of the cheaper stages (best is reported)")
+    parser.add_argument("--dict-limit", type=int, default=DICT_LIMIT,
+                        help="skip event-dict stages above this many events")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc run of each stage")
+    parser.add_argument("-o", "--out", default="bench_results.json")
+    parser.add_argument("--compare", default=None,
+                        help="earlier results file; exit 1 if a stage got slower")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio --compare reports")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    out = {"meta": meta(), "workloads": [], "results": []}
+    for events in args.sizes:
+        t = time.perf_counter()
+        path, params = dataset(args.workdir, events, args.seed)
+        print(f"{events} events ({params['devices']} devices, {params['gateways']} gateways)"
+              f" ready in {time.perf_counter() - t:.1f}s")
+        out["workloads"].append({"events": events, "path": path, **params})
+        out["results"].extend(
+            run_scale(path, events, args.repeat, not args.no_memory, args.dict_limit)
+        )
+
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=1)
+    print(f"Wrote {len(out['results'])} results to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(out, baseline, args.threshold)
+        for events, name, old, new in slower:
+            print(f"SLOWER {events} {name}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms")
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,116 @@
+import math
+import sys
+import threading
+from collections import OrderedDict
+
+import instrument
+
+# Data-version-aware caching for the dashboard.
+#
+# DatasetCache wraps one LiveDataset per process. Derived artifacts are
+# computed at most once per dataset version and shared by every session;
+# they are dropped only when refresh() sees new data land.
+
+RECENT = 4                 # parameterized artifacts kept per name
+
+
+def approx_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, maxbytes=8 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+
+        value = compute()
+        size = approx_size(value)
+        if size > self.maxbytes:
+            return value
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while len(self._data) > self.maxsize or self.nbytes > self.maxbytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.nbytes -= evicted
+        return value
+
+
+class DatasetCache:
+    def __init__(self, data, query_cache_size=256):
+        self.data = data
+        self.version = None
+        self.answers = LRUCache(query_cache_size)
+        self._artifacts = {}
+        self._recent = {}
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        with self._lock:
+            self.data.refresh()
+            if self.data.version != self.version:
+                self.version = self.data.version
+                self._artifacts = {}
+                self._recent = {}
+                self.answers.clear()
+            return self.version
+
+    def get(self, name, compute):
+        # compute(data) runs once per version, even when sessions race
+        with self._lock:
+            if name not in self._artifacts:
+                with instrument.span(f"cache.{name.split(':')[0]}"):
+                    self._artifacts[name] = compute(self.data)
+            return self._artifacts[name]
+
+    def recent(self, name, key, compute, size=RECENT):
+        # Like get() for artifacts that vary with a parameter (a time
+        # window, a weight profile): only the last `size` keys per name are
+        # kept for the current version
+        with self._lock:
+            lru = self._recent.get(name)
+            if lru is None:
+                lru = self._recent[name] = LRUCache(size, maxbytes=math.inf)
+
+            def run():
+                with instrument.span(f"cache.{name}"):
+                    return compute(self.data)
+
+            return lru.get(key, run)
+
+    def answer(self, key, compute):
+        with self._lock:
+            misses = self.answers.misses
+            value = self.answers.get((self.version,) + tuple(key), compute)
+            hit = self.answers.misses == misses
+            instrument.count("cache.answer_hits" if hit else "cache.answer_misses")
+            return value
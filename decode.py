@@ -0,0 +1,142 @@
+import json
+from collections import namedtuple
+from typing import Any, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Projection-aware event decoding.
+#
+# A Projection decodes one JSONL line into a compact namedtuple holding only
+# the requested fields. With msgspec installed, unrequested subtrees are
+# skipped by the decoder instead of being materialized; otherwise the line
+# is decoded with orjson (or json) and only the projected values are kept.
+
+loads = orjson.loads if orjson is not None else json.loads
+
+# Short names for the fields consumers usually read. Any other dotted path
+# (e.g. "network.fCnt") is accepted too, as attribute "network_fCnt".
+FIELDS = {
+    "timestamp": "timestamp",
+    "devEui": "device.devEui",
+    "name": "device.name",
+    "profile": "device.profile",
+    "gatewayId": "rf.gatewayId",
+    "rssi": "rf.rssi",
+    "snr": "rf.snr",
+    "location": "rf.location",
+    "confidence_score": "confidence.confidence_score",
+    "device_metrics": "device_metrics",
+    "measurements": "measurements",
+}
+
+_record_types = {}
+
+
+def record_type(attrs):
+    attrs = tuple(attrs)
+    if attrs not in _record_types:
+        _record_types[attrs] = namedtuple("EventRecord", attrs)
+    return _record_types[attrs]
+
+
+def _resolve(fields):
+    attrs = []
+    paths = []
+    for f in fields:
+        path = FIELDS.get(f, f)
+        attrs.append(f if f in FIELDS else f.replace(".", "_"))
+        paths.append(tuple(path.split(".")))
+    return attrs, paths
+
+
+def _struct_type(paths, name="Event"):
+    # Nested msgspec Structs covering exactly the projected paths. Keys are
+    # mapped to generated attribute names so any JSON key is allowed.
+    children = {}
+    for path in paths:
+        children.setdefault(path[0], []).append(path[1:])
+
+    fields = []
+    rename = {}
+    attr_of = {}
+    nested = {}
+    for i, (key, rest) in enumerate(children.items()):
+        attr = f"f{i}"
+        rename[attr] = key
+        attr_of[key] = attr
+        if any(len(r) == 0 for r in rest):
+            fields.append((attr, Any, None))
+        else:
+            sub, sub_attrs = _struct_type(rest, f"{name}_{i}")
+            nested[key] = sub_attrs
+            fields.append((attr, Optional[sub], None))
+
+    struct = msgspec.defstruct(name, fields, rename=rename)
+    return struct, (attr_of, nested)
+
+
+def _struct_getters(paths, layout):
+    # [(struct attribute or None, JSON key), ...] per path; below a field
+    # decoded as a plain value the remaining keys are looked up in dicts
+    getters = []
+    for path in paths:
+        steps = []
+        attr_of, nested = layout
+        for key in path:
+            steps.append((attr_of.get(key), key))
+            attr_of, nested = nested.get(key, ({}, {}))
+        getters.append(steps)
+    return getters
+
+
+class Projection:
+    def __init__(self, fields):
+        self.fields = list(fields)
+        attrs, self.paths = _resolve(self.fields)
+        self.record = record_type(attrs)
+
+        self._decoder = None
+        if msgspec is not None:
+            struct, layout = _struct_type(self.paths)
+            self._decoder = msgspec.json.Decoder(struct)
+            self._getters = _struct_getters(self.paths, layout)
+
+    def _from_dict(self, obj):
+        values = []
+        for path in self.paths:
+            v = obj
+            for key in path:
+                v = v.get(key) if isinstance(v, dict) else None
+            values.append(v)
+        return self.record(*values)
+
+    def _from_struct(self, obj):
+        values = []
+        for steps in self._getters:
+            v = obj
+            for attr, key in steps:
+                if attr is not None:
+                    v = getattr(v, attr)
+                else:
+                    v = v.get(key) if isinstance(v, dict) else None
+                if v is None:
+                    break
+            values.append(v)
+        return self.record(*values)
+
+    def __call__(self, line):
+        if self._decoder is not None:
+            try:
+                return self._from_struct(self._decoder.decode(line))
+            except msgspec.ValidationError:
+                # e.g. a projected parent that is not an object
+                pass
+        return self._from_dict(loads(line))
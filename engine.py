@@ -1,22 +1,64 @@
-import json
+import os
 from collections import defaultdict
 
-def load_events(path="enriched_events.jsonl"):
+import numpy as np
+
+from accumulators import EntityStats
+from archive import compression, read_events
+from decode import Projection, loads
+import instrument
+import rules
+from segments import CATALOG, SegmentLog
+from store import EventStore, EventSlice
+
+@instrument.timed("engine.load_events")
+def load_events(path="enriched_events.jsonl", fields=None, start=None, end=None, devices=None):
+    # fields: optional projection (see decode.FIELDS), e.g.
+    # ["devEui", "gatewayId", "timestamp", "confidence_score", "rssi"].
+    # Returns compact records instead of full event dicts.
+    #
+    # path may also be a segment directory (see segments.py); start / end
+    # (ns since epoch) and devices then prune segments before reading.
+    #
+    # Any other directory, a glob, a list of paths or a compressed file is
+    # read as a rotated archive (see archive.py): decompressed as a stream
+    # and merged in timestamp order, with start / end bounding the range.
+    decode = Projection(fields) if fields is not None else loads
+    if isinstance(path, str) and os.path.isfile(os.path.join(path, CATALOG)):
+        log = SegmentLog(path)
+        events = list(log.read(start, end, devices, decode=decode))
+        instrument.count("engine.events_loaded", len(events))
+        return events
+    if not isinstance(path, str) or not os.path.isfile(path) or compression(path):
+        events = list(read_events(path, fields, start, end))
+        instrument.count("engine.events_loaded", len(events))
+        return events
+
     events = []
-    with open(path) as f:
+    with open(path, "rb") as f:
         for line in f:
-            events.append(json.loads(line))
+            if line.strip():
+                events.append(decode(line))
+    instrument.count("engine.events_loaded", len(events))
     return events
 
 
+@instrument.timed("engine.build_device_index")
 def build_device_index(events):
+    if isinstance(events, EventStore):
+        return events.device_index()
+
     devices = defaultdict(list)
     for e in events:
         devices[e["device"]["devEui"]].append(e)
     return devices
 
 
+@instrument.timed("engine.build_gateway_index")
 def build_gateway_index(events):
+    if isinstance(events, EventStore):
+        return events.gateway_index()
+
     gateways = defaultdict(list)
     for e in events:
         gw = e["rf"]["gatewayId"]
@@ -25,118 +67,68 @@ def build_gateway_index(events):
     return gateways
 
 def sla_status(m):
-    if m["avg_confidence"] < 70:
-        return "FAIL"
-    if m["data_completeness"] < 0.8:
-        return "WARN"
-    return "PASS"
+    return rules.sla_of(m)
 
 
 def maintenance_risk(m):
-    risk = 0
-    if m["battery_reporting_quality"] < 0.5:
-        risk += 30
-    if m["confidence_trend"] == "degrading":
-        risk += 25
-    if m["rssi_std"] > 10:
-        risk += 20
-    if m["data_completeness"] < 0.75:
-        risk += 15
-    return risk
-
-def generate_insights(device_metrics):
-    insights = []
-
-    for dev, m in device_metrics.items():
-        if "unreliable_despite_good_rssi" in m["flags"]:
-            insights.append(
-                f"Device {dev} is unreliable despite stable RF conditions."
-            )
-        if m["battery_reporting_quality"] < 0.7:
-            insights.append(
-                f"Device {dev} has poor battery telemetry quality."
-            )
-        if m["confidence_trend"] == "degrading":
-            insights.append(
-                f"Device {dev} shows degrading confidence over time."
-            )
-        if m["data_completeness"] < 0.75:
-            insights.append(
-                f"Device {dev} frequently reports incomplete telemetry."
-            )
-
-    return insights
+    return rules.risk_of(m)
 
-import statistics
+@instrument.timed("engine.generate_insights")
+def generate_insights(device_metrics, table=None):
+    # table: a rules.evaluate() result for device_metrics, if already computed
+    if table is None:
+        table = rules.evaluate(device_metrics)
+    return rules.fleet_insights(table)
 
+@instrument.timed("engine.analyze_gateways")
 def analyze_gateways(gateway_index):
     results = {}
 
     for gw, events in gateway_index.items():
-        confidences = [e["confidence"]["confidence_score"] for e in events]
-        rssi_vals = [e["rf"]["rssi"] for e in events if e["rf"]["rssi"] is not None]
-
-        results[gw] = {
-            "avg_confidence": round(sum(confidences) / len(confidences), 2),
-            "rssi_std": round(statistics.pstdev(rssi_vals), 2) if len(rssi_vals) > 1 else 0,
-            "event_count": len(events)
-        }
+        stats = EntityStats()
+        if isinstance(events, EventSlice):
+            store, rows = events.store, events.rows
+            stats.update_columns(
+                store.column("confidence_score")[rows],
+                store.column("rssi")[rows],
+                store.column("snr")[rows],
+            )
+            codes = np.unique(store.column("device")[rows])
+            stats.add_devices([store.devices[c] for c in codes])
+        else:
+            stats.update_columns(
+                np.array([e["confidence"]["confidence_score"] for e in events], dtype=np.float64),
+                np.array([e["rf"].get("rssi") for e in events], dtype=np.float64),
+                np.array([e["rf"].get("snr") for e in events], dtype=np.float64),
+            )
+            stats.add_devices({e["device"]["devEui"] for e in events})
+        results[gw] = stats.summary()
 
     return results
 
-def query_devices(device_metrics, q):
-    if q == "low_confidence":
-        return {d: m for d, m in device_metrics.items() if m["avg_confidence"] < 80}
-
-    if q == "needs_maintenance":
-        return {
-            d: m for d, m in device_metrics.items()
-            if m["battery_reporting_quality"] < 0.5
-            or m["confidence_trend"] == "degrading"
-        }
+@instrument.timed("engine.query_devices")
+def query_devices(device_metrics, q, table=None):
+    if q not in ("low_confidence", "needs_maintenance", "incomplete_data"):
+        return {}
+    if table is None:
+        table = rules.evaluate(device_metrics)
+    return {d: device_metrics[d] for d in rules.select(table, q)}
 
-    if q == "incomplete_data":
-        return {d: m for d, m in device_metrics.items() if m["data_completeness"] < 0.8}
 
-    return {}
-def system_summary(device_metrics, gateway_stats):
-    return {
-        "total_devices": len(device_metrics),
-        "high_risk_devices": sum(
-            1 for m in device_metrics.values()
-            if maintenance_risk(m) >= 60
-        ),
-        "warn_devices": sum(
-            1 for m in device_metrics.values()
-            if sla_status(m) == "WARN"
-        ),
-        "unstable_gateways": [
-            g for g, s in gateway_stats.items()
-            if s["rssi_std"] > 12
-        ]
-    }
-def system_summary(device_metrics, gateway_stats):
+@instrument.timed("engine.system_summary")
+def system_summary(device_metrics, gateway_stats, table=None):
+    if table is None:
+        table = rules.evaluate(device_metrics)
     return {
         "total_devices": len(device_metrics),
-        "high_risk_devices": sum(
-            1 for m in device_metrics.values()
-            if maintenance_risk(m) >= 60
-        ),
-        "warn_devices": sum(
-            1 for m in device_metrics.values()
-            if sla_status(m) == "WARN"
-        ),
+        "high_risk_devices": int((table["risk"] >= rules.HIGH_RISK).sum()),
+        "warn_devices": int((table["sla"] == "WARN").sum()),
         "unstable_gateways": [
             g for g, s in gateway_stats.items()
-            if s["rssi_std"] > 12
+            if s["rssi_std"] > rules.UNSTABLE_GATEWAY_RSSI_STD
         ]
     }
+
+
 def explain_device(dev, m):
-    reasons = []
-    if m["battery_reporting_quality"] < 0.5:
-        reasons.append("Battery telemetry missing")
-    if m["confidence_trend"] == "degrading":
-        reasons.append("Confidence decreasing over time")
-    if m["rssi_std"] > 10:
-        reasons.append("Unstable RF conditions")
-    return reasons
+    return rules.explain(m)
@@ -0,0 +1,461 @@
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from store import EPOCH, NAT, parse_timestamp
+
+# Enrichment pipeline: raw vendor uplinks -> enriched_events.jsonl
+#
+#   dataset/<sensor>/<devEUI>/*.json
+#
+# 1. changed files (per the manifest) are parsed and normalized in a
+#    process pool
+# 2. each touched device gets its events re-sorted, scored and written to
+#    a per-device run file
+# 3. all runs are k-way merged, in timestamp order, into the output
+#
+# Untouched devices keep their runs from the previous run, so re-runs only
+# parse new or changed files.
+
+MANIFEST = "manifest.json"
+
+# Confidence penalties (points off 100)
+WEIGHTS = {
+    "missing_measurements": 30,   # scaled by the fraction of null fields
+    "missing_battery": 10,
+    "weak_rssi": 10,              # rssi < -105
+    "very_weak_rssi": 20,         # rssi < -115
+    "low_snr": 5,                 # snr < 0
+    "very_low_snr": 15,           # snr < -7.5
+    "frame_gap": 5,               # per lost frame, capped at frame_gap_max
+    "frame_gap_max": 20,
+    "frame_reset": 10,            # fCnt went backwards or repeated
+    "adr_disabled": 5,
+}
+
+
+# -------------------------
+# VENDOR NORMALIZATION
+# -------------------------
+
+def _iso(ts):
+    ns = parse_timestamp(ts)
+    if ns == NAT:
+        return None, NAT
+    dt = EPOCH + timedelta(microseconds=ns // 1000)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), ns
+
+
+def _best_rx(rx):
+    rx = [r for r in rx or [] if isinstance(r, dict)]
+    if not rx:
+        return {}
+    return max(rx, key=lambda r: r.get("rssi") if r.get("rssi") is not None else -999)
+
+
+def _normalize_ttn(raw):
+    up = raw["uplink_message"]
+    ids = raw.get("end_device_ids", {})
+    rx = _best_rx(up.get("rx_metadata"))
+    lora = up.get("settings", {}).get("data_rate", {}).get("lora", {})
+
+    return raw.get("received_at") or up.get("received_at"), {
+        "device": {
+            "devEui": ids.get("dev_eui"),
+            "name": ids.get("device_id"),
+            "profile": (up.get("version_ids") or {}).get("model_id"),
+        },
+        "measurements": up.get("decoded_payload") or {},
+        "rf": {
+            "gatewayId": (rx.get("gateway_ids") or {}).get("eui")
+            or (rx.get("gateway_ids") or {}).get("gateway_id"),
+            "rssi": rx.get("rssi"),
+            "snr": rx.get("snr"),
+            "location": rx.get("location"),
+            "frequency": up.get("settings", {}).get("frequency"),
+            "spreadingFactor": lora.get("spreading_factor"),
+        },
+        "network": {
+            "fCnt": up.get("f_cnt"),
+            "fPort": up.get("f_port"),
+            "devAddr": ids.get("dev_addr"),
+            "adr": (up.get("settings") or {}).get("adr"),
+        },
+    }
+
+
+def _normalize_chirpstack(raw):
+    # v4 nests device fields under deviceInfo, v3 keeps them at the top
+    info = raw.get("deviceInfo", raw)
+    rx = _best_rx(raw.get("rxInfo"))
+    tx = raw.get("txInfo", {})
+    lora = tx.get("modulation", {}).get("lora", {})
+
+    return raw.get("time") or raw.get("publishedAt") or rx.get("time"), {
+        "device": {
+            "devEui": info.get("devEui") or info.get("devEUI"),
+            "name": info.get("deviceName"),
+            "profile": info.get("deviceProfileName"),
+        },
+        "measurements": raw.get("object") or {},
+        "rf": {
+            "gatewayId": rx.get("gatewayId") or rx.get("gatewayID"),
+            "rssi": rx.get("rssi"),
+            "snr": rx.get("snr") if "snr" in rx else rx.get("loRaSNR"),
+            "location": rx.get("location"),
+            "frequency": tx.get("frequency"),
+            "spreadingFactor": lora.get("spreadingFactor"),
+        },
+        "network": {
+            "fCnt": raw.get("fCnt"),
+            "fPort": raw.get("fPort"),
+            "devAddr": raw.get("devAddr"),
+            "adr": raw.get("adr"),
+        },
+    }
+
+
+def normalize(raw, sensor, dev_eui):
+    if "uplink_message" in raw:
+        ts, event = _normalize_ttn(raw)
+    elif "deviceInfo" in raw or "rxInfo" in raw:
+        ts, event = _normalize_chirpstack(raw)
+    else:
+        return None
+
+    timestamp, ns = _iso(ts)
+    if ns == NAT:
+        return None
+
+    device = event["device"]
+    device["devEui"] = (device["devEui"] or dev_eui).upper()
+    device["name"] = device["name"] or device["devEui"]
+    device["profile"] = device["profile"] or sensor
+    device["sensor"] = sensor
+
+    return ns, {"timestamp": timestamp, **event}
+
+
+def parse_file(path, sensor, dev_eui):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"[!] Failed to parse {path}: {e}")
+        return []
+
+    uplinks = data if isinstance(data, list) else [data]
+    events = []
+    for raw in uplinks:
+        if isinstance(raw, dict):
+            normalized = normalize(raw, sensor, dev_eui)
+            if normalized:
+                events.append(normalized)
+    return events
+
+
+def _parse_batch(batch):
+    return [(path, parse_file(path, sensor, dev)) for path, sensor, dev in batch]
+
+
+# -------------------------
+# SCORING
+# -------------------------
+
+def score_events(events, weights=WEIGHTS, prev_fcnt=None):
+    # events: one device's normalized events in timestamp order;
+    # prev_fcnt: the device's last frame counter before them, if known.
+    # Returns the last frame counter seen.
+    for e in events:
+        m = e["measurements"]
+        rf = e["rf"]
+        fcnt = e["network"].get("fCnt")
+        penalties = {}
+
+        if m:
+            missing = sum(1 for v in m.values() if v is None) / len(m)
+            if missing:
+                penalties["missing_measurements"] = weights["missing_measurements"] * missing
+        else:
+            penalties["missing_measurements"] = weights["missing_measurements"]
+        if not any("bat" in k.lower() and v is not None for k, v in m.items()):
+            penalties["missing_battery"] = weights["missing_battery"]
+
+        rssi = rf.get("rssi")
+        if rssi is not None and rssi < -115:
+            penalties["rssi"] = weights["very_weak_rssi"]
+        elif rssi is not None and rssi < -105:
+            penalties["rssi"] = weights["weak_rssi"]
+
+        snr = rf.get("snr")
+        if snr is not None and snr < -7.5:
+            penalties["snr"] = weights["very_low_snr"]
+        elif snr is not None and snr < 0:
+            penalties["snr"] = weights["low_snr"]
+
+        if fcnt is not None and prev_fcnt is not None:
+            gap = fcnt - prev_fcnt - 1
+            if gap > 0:
+                penalties["frame_gap"] = min(weights["frame_gap_max"], weights["frame_gap"] * gap)
+            elif gap < 0:
+                penalties["frame_reset"] = weights["frame_reset"]
+        if fcnt is not None:
+            prev_fcnt = fcnt
+
+        if e["network"].get("adr") is False:
+            penalties["adr_disabled"] = weights["adr_disabled"]
+
+        e["confidence"] = {
+            "confidence_score": round(max(0.0, 100 - sum(penalties.values())), 2),
+            "penalties": penalties,
+        }
+    return prev_fcnt
+
+
+# -------------------------
+# RUN FILES
+# -------------------------
+
+# Run lines are "<ns>\t<json source path>\t<event json>"; json.dumps escapes
+# tabs, so the first two tabs always delimit the fields.
+
+def _run_name(sensor, dev):
+    key = hashlib.sha1(f"{sensor}/{dev}".encode()).hexdigest()[:16]
+    return f"{dev}-{key}.run"
+
+
+def _read_run(path):
+    try:
+        with open(path) as f:
+            for line in f:
+                ns, source, event = line.rstrip("\n").split("\t", 2)
+                yield int(ns), json.loads(source), json.loads(event)
+    except FileNotFoundError:
+        return
+
+
+def _write_run(path, rows):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for ns, source, event in rows:
+            f.write(f"{ns}\t{json.dumps(source)}\t{json.dumps(event)}\n")
+    os.replace(tmp, path)
+
+
+def _run_lines(path):
+    with open(path) as f:
+        for line in f:
+            ns, _, rest = line.partition("\t")
+            yield int(ns), rest.partition("\t")[2]
+
+
+def merge_runs(paths, out, fan_in=256, tmpdir=None):
+    # Bounded-memory k-way merge: at most fan_in runs are open at once;
+    # wider merges go through intermediate runs.
+    paths = list(paths)
+    temps = []
+    try:
+        while len(paths) > fan_in:
+            merged = []
+            for i in range(0, len(paths), fan_in):
+                fd, tmp = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+                with os.fdopen(fd, "w") as f:
+                    for ns, event in heapq.merge(
+                        *(_run_lines(p) for p in paths[i:i + fan_in]),
+                        key=lambda r: r[0],
+                    ):
+                        f.write(f"{ns}\t\"\"\t{event}")
+                temps.append(tmp)
+                merged.append(tmp)
+            paths = merged
+
+        count = 0
+        tmp_out = out + ".tmp"
+        with open(tmp_out, "w") as f:
+            for _, event in heapq.merge(
+                *(_run_lines(p) for p in paths), key=lambda r: r[0]
+            ):
+                f.write(event)
+                count += 1
+        return tmp_out, count
+    finally:
+        for tmp in temps:
+            os.remove(tmp)
+
+
+def _publish(tmp_out, out):
+    # When the new output only extends the old one, append the difference
+    # so tail-followers see plain appends; otherwise replace atomically.
+    try:
+        old_size = os.path.getsize(out)
+    except FileNotFoundError:
+        os.replace(tmp_out, out)
+        return "created"
+
+    with open(out, "rb") as old, open(tmp_out, "rb") as new:
+        same_prefix = True
+        remaining = old_size
+        while remaining > 0:
+            a = old.read(min(remaining, 1 << 20))
+            b = new.read(len(a))
+            if not a or a != b:
+                same_prefix = False
+                break
+            remaining -= len(a)
+
+        if same_prefix:
+            with open(out, "ab") as f:
+                while True:
+                    chunk = new.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+
+    if same_prefix:
+        os.remove(tmp_out)
+        return "appended"
+    os.replace(tmp_out, out)
+    return "rewritten"
+
+
+# -------------------------
+# PIPELINE
+# -------------------------
+
+def discover_files(root):
+    # {path: (sensor, devEUI)} for dataset/<sensor>/<devEUI>/*.json
+    files = {}
+    for sensor in sorted(os.listdir(root)):
+        sensor_dir = os.path.join(root, sensor)
+        if not os.path.isdir(sensor_dir):
+            continue
+        for dev in sorted(os.listdir(sensor_dir)):
+            dev_dir = os.path.join(sensor_dir, dev)
+            if not os.path.isdir(dev_dir):
+                continue
+            for name in os.listdir(dev_dir):
+                if name.endswith(".json"):
+                    files[os.path.join(dev_dir, name)] = (sensor, dev)
+    return files
+
+
+def enrich(
+    root="dataset",
+    out="enriched_events.jsonl",
+    workdir=".enrich",
+    workers=None,
+    batch_size=64,
+    fan_in=256,
+):
+    os.makedirs(workdir, exist_ok=True)
+    manifest_path = os.path.join(workdir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    files = discover_files(root)
+    current = {}
+    for path, (sensor, dev) in files.items():
+        st = os.stat(path)
+        current[path] = {
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "run": _run_name(sensor, dev),
+        }
+
+    def _same(a, b):
+        return a and b and a["mtime_ns"] == b["mtime_ns"] and a["size"] == b["size"]
+
+    changed = [p for p in current if not _same(manifest.get(p), current[p])]
+    removed = [p for p in manifest if p not in current]
+    stale = set(changed) | set(removed)
+    touched = {current[p]["run"] for p in changed} | {manifest[p]["run"] for p in removed}
+
+    # 1. parse changed files in parallel
+    parsed = defaultdict(list)
+    batches = [
+        [(p, *files[p]) for p in changed[i:i + batch_size]]
+        for i in range(0, len(changed), batch_size)
+    ]
+    if batches:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for results in pool.map(_parse_batch, batches):
+                for path, events in results:
+                    run = current[path]["run"]
+                    parsed[run].extend((ns, path, e) for ns, e in events)
+
+    # 2. rebuild the runs of touched devices
+    runs_dir = os.path.join(workdir, "runs")
+    os.makedirs(runs_dir, exist_ok=True)
+    live_runs = {meta["run"] for meta in current.values()}
+
+    for run in touched:
+        run_path = os.path.join(runs_dir, run)
+        if run not in live_runs:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+            continue
+
+        rows = [r for r in _read_run(run_path) if r[1] not in stale]
+        rows.extend(parsed.get(run, ()))
+        rows.sort(key=lambda r: r[0])
+
+        events = [e for _, _, e in rows]
+        for e in events:
+            e.pop("device_metrics", None)
+        score_events(events)
+        _write_run(run_path, rows)
+
+    # 3. merge every run into the output, in timestamp order
+    run_paths = [
+        os.path.join(runs_dir, run)
+        for run in sorted(live_runs)
+        if os.path.exists(os.path.join(runs_dir, run))
+    ]
+    tmp_out, count = merge_runs(run_paths, out, fan_in=fan_in, tmpdir=workdir)
+    mode = _publish(tmp_out, out)
+
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(current, f)
+    os.replace(tmp, manifest_path)
+
+    return {
+        "files": len(current),
+        "parsed": len(changed),
+        "removed": len(removed),
+        "devices_rebuilt": len(touched),
+        "events": count,
+        "output": mode,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Normalize raw vendor uplinks into enriched_events.jsonl"
+    )
+    parser.add_argument("root", nargs="?", default="dataset")
+    parser.add_argument("-o", "--out", default="enriched_events.jsonl")
+    parser.add_argument("--workdir", default=".enrich")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--fan-in", type=int, default=256)
+    args = parser.parse_args()
+
+    stats = enrich(
+        args.root,
+        args.out,
+        workdir=args.workdir,
+        workers=args.workers,
+        fan_in=args.fan_in,
+    )
+    print("\n=== ENRICHMENT ===")
+    for k, v in stats.items():
+        print(f"{k}: {v}")
@@ -1,38 +1,92 @@
-import os
+import argparse
 import json
+import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 BASE_DIR = os.getcwd()   # <-- IMPORTANT FIX
 
-def extract_fields(obj, prefix=""):
-    fields = set()
+CACHE_FILE = ".enumerate_cache.json"
 
+
+def _collect(obj, prefix, fields):
     if isinstance(obj, dict):
         for k, v in obj.items():
             path = f"{prefix}.{k}" if prefix else k
             fields.add(path)
-            fields |= extract_fields(v, path)
+            _collect(v, path, fields)
 
     elif isinstance(obj, list):
         path = f"{prefix}[]" if prefix else "[]"
         fields.add(path)
         for item in obj:
-            fields |= extract_fields(item, path)
+            _collect(item, path, fields)
+
 
+def extract_fields(obj, prefix=""):
+    fields = set()
+    _collect(obj, prefix, fields)
     return fields
 
 
-def discover():
-    sensor_fields = defaultdict(set)
-    sensor_counts = defaultdict(int)
+def _parse_batch(paths):
+    results = []
+    for path in paths:
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            results.append((path, None, str(e)))
+            continue
+        results.append((path, sorted(extract_fields(data)), None))
+    return results
+
+
+def _sample(files, n):
+    # n files spread evenly over the (sorted) directory listing; none for
+    # n <= 0
+    files = sorted(files)
+    if n is not None and n <= 0:
+        return []
+    if n is None or len(files) <= n:
+        return files
+    step = len(files) / n
+    return [files[int(i * step)] for i in range(n)]
 
-    for root, _, files in os.walk(BASE_DIR):
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_cache(path, cache):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def discover(base_dir=None, workers=None, sample=None, use_cache=True, batch_size=64,
+             frequencies=False):
+    # Returns (sensor_fields, sensor_counts); with frequencies=True also
+    # field_counts, where field_counts[sensor][field] is the number of
+    # files containing field.
+    base_dir = base_dir or BASE_DIR
+    cache_path = os.path.join(base_dir, CACHE_FILE)
+    cache = _load_cache(cache_path) if use_cache else {}
+
+    tasks = []   # (path, sensor, stat key)
+
+    for root, _, files in os.walk(base_dir):
         json_files = [f for f in files if f.endswith(".json")]
         if not json_files:
             continue
 
         # Expect structure: dataset/<sensor>/<devEUI>/*.json
-        rel = os.path.relpath(root, BASE_DIR)
+        rel = os.path.relpath(root, base_dir)
         parts = rel.split(os.sep)
 
         if len(parts) < 2:
@@ -42,29 +96,79 @@ def discover():
 
         print(f"[+] Found {len(json_files)} JSON files in {root}")
 
-        for jf in json_files:
+        for jf in _sample(json_files, sample):
             path = os.path.join(root, jf)
-            try:
-                with open(path, "r") as f:
-                    data = json.load(f)
-            except Exception as e:
-                print(f"[!] Failed to parse {path}: {e}")
-                continue
+            st = os.stat(path)
+            tasks.append((path, sensor_name, [st.st_mtime_ns, st.st_size]))
+
+    # Files whose (path, mtime, size) is unchanged are served from the cache
+    fields_by_path = {}
+    misses = []
+    for path, _, key in tasks:
+        hit = cache.get(path)
+        if hit and hit["key"] == key:
+            fields_by_path[path] = hit["fields"]
+        else:
+            misses.append(path)
+
+    keys = {path: key for path, _, key in tasks}
+    batches = [misses[i:i + batch_size] for i in range(0, len(misses), batch_size)]
+    if batches:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for results in pool.map(_parse_batch, batches):
+                for path, fields, error in results:
+                    if error is not None:
+                        print(f"[!] Failed to parse {path}: {error}")
+                        continue
+                    fields_by_path[path] = fields
+                    cache[path] = {"key": keys[path], "fields": fields}
+
+    sensor_fields = defaultdict(set)
+    sensor_counts = defaultdict(int)
+    field_counts = defaultdict(lambda: defaultdict(int))
+
+    for path, sensor_name, _ in tasks:
+        fields = fields_by_path.get(path)
+        if fields is None:
+            continue
+        sensor_counts[sensor_name] += 1
+        sensor_fields[sensor_name].update(fields)
+        counts = field_counts[sensor_name]
+        for field in fields:
+            counts[field] += 1
 
-            sensor_counts[sensor_name] += 1
-            sensor_fields[sensor_name] |= extract_fields(data)
+    if use_cache and misses:
+        _save_cache(cache_path, cache)
 
+    if frequencies:
+        return sensor_fields, sensor_counts, field_counts
     return sensor_fields, sensor_counts
 
 
 if __name__ == "__main__":
-    fields, counts = discover()
+    parser = argparse.ArgumentParser(description="Discover the JSON schema of raw uplinks")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--sample", type=int, default=None,
+                        help="only read N files per sensor/devEUI directory")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+
+    fields, counts, freqs = discover(
+        workers=args.workers,
+        sample=args.sample,
+        use_cache=not args.no_cache,
+        frequencies=True,
+    )
 
     print("\n\n=== SUMMARY ===")
     for sensor in sorted(fields):
+        total = counts[sensor]
         print("=" * 80)
         print(f"SENSOR: {sensor}")
-        print(f"Total JSON files: {counts[sensor]}")
+        print(f"Total JSON files: {total}")
         print("Fields:")
         for field in sorted(fields[sensor]):
-            print(f"  - {field}")
+            n = freqs[sensor][field]
+            print(f"  - {field}  ({n}/{total}, {100 * n / total:.0f}%)")
@@ -0,0 +1,187 @@
+import threading
+
+import instrument
+from accumulators import FleetStats
+from decode import Projection
+from metrics import DEFAULT_WINDOW, DeviceMetrics
+from query_engine import QueryIndex
+from rollups import Rollups
+from snapshot import open_snapshot
+from store import NAT, STORE_FIELDS, EventStore
+from tail import TailReader
+from warmstart import WarmCache
+
+# Tail-follow ingestion of enriched_events.jsonl.
+#
+# LiveDataset feeds the lines a TailReader returns into an EventStore and
+# keeps the device / gateway indexes and the downstream aggregates up to
+# date in place.
+#
+# With a warm-start cache (see warmstart.py) a restart on unchanged or
+# appended-to data loads the store and the aggregates instead of rebuilding
+# them, and only parses the lines appended since they were saved.
+
+
+class LiveDataset:
+    def __init__(self, path="enriched_events.jsonl", checkpoint=None, snapshot=None,
+                 metrics_window=DEFAULT_WINDOW, cache=None):
+        # snapshot: directory written by snapshot.py. When it was compiled
+        # from this file, the store is opened from it and only the tail
+        # appended since is parsed.
+        # metrics_window: the metrics.WINDOWS entry device_metrics covers
+        # cache: warm-start cache directory, read here and written as new
+        # data is indexed
+        self.metrics_window = metrics_window
+        self._lock = threading.Lock()
+        self.generation = 0
+        self._reset()
+
+        self.cache = WarmCache(cache, path) if cache else None
+        warm = self.cache.load() if self.cache else None
+        opened = None
+        if warm is not None:
+            self.store, state, rows, checkpoint = warm
+            self._restore(state, rows)
+        else:
+            opened = open_snapshot(snapshot) if snapshot else None
+        if opened is not None:
+            self.store, header = opened
+            checkpoint = header["source"]
+
+        self.reader = TailReader(path, checkpoint, decode=Projection(STORE_FIELDS))
+        if opened is not None:
+            self._index(0)
+
+    @property
+    def version(self):
+        # Changes whenever the file or the data derived from it may have
+        # changed: (resets, inode, mtime, size, consumed offset)
+        r = self.reader
+        return (self.generation, r.inode, r.mtime_ns, r.size, r.offset)
+
+    @property
+    def event_count(self):
+        return len(self.store)
+
+    @property
+    def nbytes(self):
+        # approximate memory held: the store and the per-event aggregates
+        # (the per-entity ones are small next to them)
+        return self.store.nbytes + self.metrics.nbytes + self.rollups.nbytes
+
+    def time_range(self):
+        # (first, last) event timestamp in ns, (0, 0) without events
+        ts = self.store.column("timestamp")
+        ts = ts[ts != NAT]
+        return (int(ts.min()), int(ts.max())) if len(ts) else (0, 0)
+
+    def _reset(self):
+        self.store = EventStore()
+        self.devices = {}
+        self.gateways = {}
+        self.device_metrics = {}
+        self.metrics = DeviceMetrics()
+        self.rollups = Rollups()
+        self.gateway_stats = {}
+        self.fleet = FleetStats()
+        self.device_name_map = {}
+        self.gateway_name_map = {}
+        self.query_index = QueryIndex()
+
+    def refresh(self):
+        with self._lock, instrument.span("follow.refresh"):
+            with instrument.span("follow.parse"):
+                events, reset = self.reader.poll()
+            if reset:
+                self.generation += 1
+                self._reset()
+            if not events:
+                return 0
+
+            first = len(self.store)
+            with instrument.span("follow.append"):
+                for r in events:
+                    self.store.append_record(r)
+            instrument.count("follow.events", len(events))
+            self._index(first)
+            if self.cache is not None:
+                with instrument.span("follow.save_cache"):
+                    self.cache.save(self)
+
+            return len(events)
+
+    def _restore(self, state, rows):
+        # Aggregates loaded from a warm-start cache, covering the first rows
+        # of self.store; the rest are indexed again
+        store = self.store
+        for name, value in state.items():
+            setattr(self, name, value)
+        # codes are handed out in order of first appearance
+        dev = store.column("device")[:rows]
+        gw = store.column("gateway")[:rows]
+        for code in range(int(dev.max()) + 1 if rows else 0):
+            self.devices[store.devices[code]] = store.device_slice(code)
+        for code in range(int(gw.max()) + 1 if rows else 0):
+            self.gateways[store.gateways[code]] = store.gateway_slice(code)
+        self.rollups.names = {"device": store.devices, "gateway": store.gateways}
+        self.device_metrics = self.metrics.snapshot(self.metrics_window)
+        if rows < len(store):
+            self._index(rows)
+
+    def save_cache(self):
+        # Write the warm-start cache now (refresh() does it at most every
+        # warmstart.SAVE_INTERVAL seconds)
+        if self.cache is not None:
+            with self._lock:
+                return self.cache.save(self, force=True)
+        return False
+
+    def _name(self, new_devices, new_gateways):
+        # Name maps (and the query matcher) for newly interned device /
+        # gateway codes
+        store = self.store
+        for code in new_devices:
+            name = store.device_info[code].get("name")
+            if name:
+                self.device_name_map[store.devices[code]] = name
+        if new_gateways:
+            # labels are never reassigned: new gateways take the next
+            # numbers, in ID order
+            for gid in sorted(store.gateways[code] for code in new_gateways):
+                self.gateway_name_map[gid] = f"Gateway-{len(self.gateway_name_map) + 1}"
+
+        if new_devices or new_gateways:
+            self.query_index.set_names(
+                self.device_name_map, self.gateway_name_map
+            )
+
+    def _index(self, first):
+        # Fold store rows [first:] into the indexes and aggregates
+        store = self.store
+
+        new_devices = range(len(self.devices), len(store.devices))
+        for code in new_devices:
+            self.devices[store.devices[code]] = store.device_slice(code)
+        new_gateways = range(len(self.gateways), len(store.gateways))
+        for code in new_gateways:
+            self.gateways[store.gateways[code]] = store.gateway_slice(code)
+
+        self._name(new_devices, new_gateways)
+        self.query_index.add_store(store, first)
+
+        with instrument.span("follow.rollups"):
+            self.rollups.update_store(store, first)
+
+        with instrument.span("follow.device_metrics"):
+            touched = self.metrics.update_store(store, first)
+            if self.metrics.windows[self.metrics_window] is None:
+                self.device_metrics.update(
+                    self.metrics.snapshot(self.metrics_window, touched)
+                )
+            else:
+                # the window moved for every device, not only the touched ones
+                self.device_metrics = self.metrics.snapshot(self.metrics_window)
+
+        with instrument.span("follow.gateway_stats"):
+            for gw in self.fleet.update_store(store, first):
+                self.gateway_stats[gw] = self.fleet.gateways[gw].summary()
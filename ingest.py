@@ -0,0 +1,487 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from enrich import WEIGHTS, normalize, score_events
+from follow import LiveDataset
+from store import NO_FCNT, EventStore, load_store
+
+# Uplink ingestion service.
+#
+#   network server --POST /uplink--> IngestService.submit
+#                  --NDJSON socket-->      |  normalize + score
+#                                          v
+#                                  bounded asyncio.Queue
+#                                          |  writer task: batch by size or
+#                                          v  flush interval
+#                         enriched_events.jsonl (one write per batch)
+#                                          |
+#                                          v
+#                         LiveDataset.refresh() (store + live indexes)
+#
+# A submitter is answered only once its batch is committed, and submit()
+# blocks while the queue is full, so a slow disk slows the senders down
+# instead of growing memory. This process should be the only writer of the
+# output file (do not run enrich.py against it at the same time). Frame
+# counters carry over a restart: they are read back from the output file.
+# Uplinks whose scored fields have the wrong JSON type (a string fCnt or
+# RSSI, a non-object payload) are rejected before anything is scored.
+#
+# `python ingest.py loadgen` stands in for the network server and reports
+# sustained uplinks/sec and ingest latency percentiles.
+
+
+class IngestService:
+    def __init__(
+        self,
+        out="enriched_events.jsonl",
+        queue_size=10_000,
+        batch_size=500,
+        flush_interval=0.005,
+        fsync=False,
+        weights=WEIGHTS,
+        dataset=True,
+    ):
+        self.out = out
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.weights = weights
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dataset = LiveDataset(out) if dataset else None
+        if self.dataset is not None:
+            self.dataset.refresh()
+
+        # devEui -> last frame counter, carried over from the output file
+        self.fcnt = _frame_counters(
+            self.dataset.store if self.dataset is not None
+            else load_store(out) if os.path.exists(out) else EventStore()
+        )
+        self.stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "committed": 0,
+            "batches": 0,
+            "max_batch": 0,
+            "commit_seconds": 0.0,
+        }
+        self._writer = None
+
+    # -------------------------
+    # SUBMIT / COMMIT
+    # -------------------------
+
+    def _enrich(self, raw, sensor):
+        if not isinstance(raw, dict):
+            return None
+        try:
+            normalized = normalize(raw, sensor, None)
+        except (AttributeError, TypeError, KeyError, ValueError):
+            # e.g. no devEui anywhere in the uplink
+            return None
+        if normalized is None:
+            return None
+        _, event = normalized
+        if not _well_typed(event):
+            return None
+        dev = event["device"]["devEui"]
+        prev = self.fcnt.get(dev)
+        self.fcnt[dev] = score_events([event], self.weights, prev)
+        return event, (dev, prev, self.fcnt[dev])
+
+    def _rollback(self, changes):
+        # undo the frame counters of events that were never committed, last
+        # first; a device a later event has moved on since is left alone
+        for dev, prev, fcnt in reversed(changes):
+            if self.fcnt.get(dev) != fcnt:
+                continue
+            if prev is None:
+                del self.fcnt[dev]
+            else:
+                self.fcnt[dev] = prev
+
+    async def submit(self, uplinks, sensor=None):
+        # Normalize, score and enqueue uplinks; returns the number accepted
+        # once they are committed
+        loop = asyncio.get_running_loop()
+        futures = []
+        for raw in uplinks:
+            enriched = self._enrich(raw, sensor)
+            if enriched is None:
+                self.stats["rejected"] += 1
+                continue
+            event, change = enriched
+            fut = loop.create_future()
+            try:
+                await self.queue.put((json.dumps(event).encode(), fut, change))
+            except BaseException:
+                self._rollback([change])
+                raise
+            self.stats["accepted"] += 1
+            futures.append(fut)
+        if futures:
+            await asyncio.gather(*futures)
+        return len(futures)
+
+    def _commit(self, lines):
+        with open(self.out, "ab") as f:
+            f.write(b"".join(line + b"\n" for line in lines))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self._commit, [line for line, _, _ in batch])
+            except Exception as e:
+                # not written: the next uplinks of these devices are scored
+                # against the frame counters from before them
+                self._rollback([change for _, _, change in batch])
+                _fail(batch, e)
+                continue
+            try:
+                if self.dataset is not None:
+                    await loop.run_in_executor(None, self.dataset.refresh)
+            except Exception as e:
+                _fail(batch, e)
+                continue
+            self.stats["commit_seconds"] += time.perf_counter() - start
+            self.stats["batches"] += 1
+            self.stats["committed"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_result(None)
+
+    def start(self):
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def status(self):
+        status = dict(self.stats, queued=self.queue.qsize())
+        if self.dataset is not None:
+            status["events"] = len(self.dataset.store)
+            status["devices"] = len(self.dataset.devices)
+            status["gateways"] = len(self.dataset.gateways)
+        return status
+
+    # -------------------------
+    # ENDPOINTS
+    # -------------------------
+
+    async def handle_http(self, reader, writer):
+        # POST /uplink[?sensor=...] with one uplink or a JSON array of them;
+        # GET /stats. Connections are kept alive.
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError:
+                    # bad request line or Content-Length: where the next
+                    # request starts is unknown, so answer and hang up
+                    _write_response(writer, 400, {"error": "malformed request"})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, body = request
+                url = urlsplit(target)
+
+                if method == "POST" and url.path == "/uplink":
+                    try:
+                        payload = json.loads(body)
+                    except ValueError:
+                        _write_response(writer, 400, {"error": "invalid JSON"})
+                    else:
+                        sensor = parse_qs(url.query).get("sensor", [None])[0]
+                        uplinks = payload if isinstance(payload, list) else [payload]
+                        accepted = await self.submit(uplinks, sensor)
+                        _write_response(writer, 200, {
+                            "accepted": accepted,
+                            "rejected": len(uplinks) - accepted,
+                        })
+                elif method == "GET" and url.path == "/stats":
+                    _write_response(writer, 200, self.status())
+                else:
+                    _write_response(writer, 404, {"error": "not found"})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_socket(self, reader, writer):
+        # One uplink JSON per line; one {"accepted": n} line back per uplink
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    raw = json.loads(line)
+                except ValueError:
+                    raw = None
+                accepted = await self.submit([raw])
+                writer.write(json.dumps({"accepted": accepted}).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _number(value):
+    return value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
+def _well_typed(event):
+    # the fields scoring and the store compute with, as JSON types; checked
+    # before anything is scored so a bad uplink is rejected, not half-taken
+    fcnt = event["network"].get("fCnt")
+    return (
+        isinstance(event["device"]["devEui"], str)
+        and isinstance(event["measurements"], dict)
+        and _number(event["rf"].get("rssi"))
+        and _number(event["rf"].get("snr"))
+        and (fcnt is None or (isinstance(fcnt, int) and not isinstance(fcnt, bool)))
+        and event["network"].get("adr") in (None, True, False)
+    )
+
+
+def _frame_counters(store):
+    # devEui -> frame counter of its last event that has one
+    fcnt = store.column("fcnt")
+    rows = np.flatnonzero(fcnt != NO_FCNT)[::-1]
+    codes, first = np.unique(store.column("device")[rows], return_index=True)
+    return {
+        store.devices[code]: int(fcnt[row])
+        for code, row in zip(codes.tolist(), rows[first].tolist())
+    }
+
+
+def _fail(batch, e):
+    for _, fut, _ in batch:
+        if not fut.done():
+            fut.set_exception(e)
+
+
+async def _read_request(reader):
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = header.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length < 0:
+        raise ValueError(f"negative Content-Length: {length}")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, body
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+
+def _write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "\r\n".encode() + body
+    )
+
+
+async def serve(service, host="127.0.0.1", port=8080, socket_port=None):
+    service.start()
+    servers = [await asyncio.start_server(service.handle_http, host, port)]
+    print(f"[+] HTTP  http://{host}:{port}/uplink")
+    if socket_port:
+        servers.append(await asyncio.start_server(service.handle_socket, host, socket_port))
+        print(f"[+] NDJSON {host}:{socket_port}")
+    await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+# -------------------------
+# LOAD GENERATOR
+# -------------------------
+
+def synthetic_uplink(rng, dev, fcnt, gateways=4):
+    # ChirpStack v4 style uplink
+    rx = [
+        {
+            "gatewayId": f"00800000A00000{g:02X}",
+            "rssi": rng.randint(-120, -60),
+            "snr": round(rng.uniform(-12, 10), 1),
+        }
+        for g in rng.sample(range(gateways), rng.randint(1, min(3, gateways)))
+    ]
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "deviceInfo": {
+            "devEui": f"A84041{dev:010X}",
+            "deviceName": f"Load Sensor {dev:05d}",
+            "deviceProfileName": "loadgen",
+        },
+        "fCnt": fcnt,
+        "adr": True,
+        "object": {
+            "temperature": round(rng.uniform(15, 30), 2),
+            "battery": None if rng.random() < 0.05 else 3.6,
+        },
+        "rxInfo": rx,
+    }
+
+
+async def _load_worker(host, port, rng, devices, per_request, interval, stop_at, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    fcnt = {}
+    next_send = time.perf_counter()
+    sent = 0
+    try:
+        while time.perf_counter() < stop_at:
+            uplinks = []
+            for _ in range(per_request):
+                dev = rng.choice(devices)
+                fcnt[dev] = fcnt.get(dev, -1) + 1
+                uplinks.append(synthetic_uplink(rng, dev, fcnt[dev]))
+            body = json.dumps(uplinks).encode()
+
+            start = time.perf_counter()
+            writer.write(
+                f"POST /uplink HTTP/1.1\r\nHost: {host}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            await _read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            sent += per_request
+
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+    finally:
+        writer.close()
+    return sent
+
+
+async def _read_response(reader):
+    await reader.readline()
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = header.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return await reader.readexactly(length)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def loadgen(host="127.0.0.1", port=8080, rate=None, duration=10.0,
+                  connections=16, devices=1000, per_request=1, seed=0):
+    # rate: total uplinks/sec to aim for (None: as fast as the server takes)
+    rng = random.Random(seed)
+    device_ids = list(range(devices))
+    interval = connections * per_request / rate if rate else 0
+    latencies = []
+    start = time.perf_counter()
+    stop_at = start + duration
+    sent = await asyncio.gather(*(
+        _load_worker(host, port, random.Random(rng.random()), device_ids,
+                     per_request, interval, stop_at, latencies)
+        for _ in range(connections)
+    ))
+    elapsed = time.perf_counter() - start
+    return {
+        "uplinks": sum(sent),
+        "seconds": round(elapsed, 3),
+        "uplinks_per_sec": round(sum(sent) / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1e3, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1e3, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1e3, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uplink ingestion service")
+    sub = parser.add_subparsers(dest="command")
+
+    srv = sub.add_parser("serve", help="accept uplinks and append them to the event file")
+    srv.add_argument("-o", "--out", default="enriched_events.jsonl")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8080)
+    srv.add_argument("--socket-port", type=int, default=None,
+                     help="also accept newline-delimited JSON uplinks on this port")
+    srv.add_argument("--queue-size", type=int, default=10_000)
+    srv.add_argument("--batch-size", type=int, default=500)
+    srv.add_argument("--flush-interval", type=float, default=0.005,
+                     help="seconds to wait for a batch to fill")
+    srv.add_argument("--fsync", action="store_true")
+
+    gen = sub.add_parser("loadgen", help="send synthetic uplinks to a running service")
+    gen.add_argument("--host", default="127.0.0.1")
+    gen.add_argument("--port", type=int, default=8080)
+    gen.add_argument("--rate", type=float, default=None, help="target uplinks/sec")
+    gen.add_argument("--duration", type=float, default=10.0)
+    gen.add_argument("--connections", type=int, default=16)
+    gen.add_argument("--devices", type=int, default=1000)
+    gen.add_argument("--per-request", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == "loadgen":
+        result = asyncio.run(loadgen(
+            args.host, args.port, args.rate, args.duration,
+            args.connections, args.devices, args.per_request,
+        ))
+        print(json.dumps(result, indent=2))
+    else:
+        if args.command is None:
+            args = srv.parse_args([])
+        service = IngestService(
+            args.out,
+            queue_size=args.queue_size,
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval,
+            fsync=args.fsync,
+        )
+        try:
+            asyncio.run(serve(service, args.host, args.port, args.socket_port))
+        except KeyboardInterrupt:
+            pass
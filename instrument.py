@@ -0,0 +1,237 @@
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not on Windows; peak RSS reads as 0 there
+    resource = None
+
+# Lightweight stage instrumentation.
+#
+# span(name) (a context manager) and timed(name) (a decorator) record the
+# call count, total / max wall time and peak-RSS growth of a stage; count()
+# bumps a named counter. The numbers are process-wide and thread-safe.
+#
+# Off by default (or set SENTINELMESH_PROFILE=1): span() then returns a
+# shared no-op context and timed() / count() return after one flag check,
+# so instrumented code pays almost nothing. enable(on, thread=True) sets
+# the switch for the calling thread only, e.g. one dashboard session, over
+# the process-wide one.
+#
+# report() / to_json() / to_prometheus() expose the numbers; dump(path)
+# writes Prometheus text for *.prom / *.txt and JSON otherwise.
+
+ENV = "SENTINELMESH_PROFILE"
+PREFIX = "sentinelmesh"
+
+_enabled = os.environ.get(ENV, "") not in ("", "0")
+_lock = threading.Lock()
+_spans = {}        # name -> [calls, total s, max s, peak RSS growth bytes]
+_counters = {}
+
+
+class _Local(threading.local):
+    on = None      # this thread's switch; None follows _enabled
+
+
+_local = _Local()
+
+
+def _peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss():
+    # (current, peak) resident set size in bytes
+    peak = _peak_rss()
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        current = peak
+    return current, peak
+
+
+def enabled():
+    on = _local.on
+    return _enabled if on is None else on
+
+
+def enable(on=True, thread=False):
+    global _enabled
+    if thread:
+        _local.on = bool(on)
+    else:
+        _enabled = bool(on)
+
+
+def disable():
+    enable(False)
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def record(name, seconds, rss_growth=0):
+    with _lock:
+        s = _spans.get(name)
+        if s is None:
+            s = _spans[name] = [0, 0.0, 0.0, 0]
+        s[0] += 1
+        s[1] += seconds
+        if seconds > s[2]:
+            s[2] = seconds
+        s[3] += rss_growth
+
+
+def count(name, n=1):
+    if not enabled():
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start", "peak")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.peak = _peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        record(self.name, seconds, _peak_rss() - self.peak)
+        return False
+
+
+def span(name):
+    if not enabled():
+        return _NO_SPAN
+    return _Span(name)
+
+
+def timed(name=None):
+    # Decorator; the span is named after the function unless name is given
+    def wrap(fn):
+        label = name or f"{fn.__module__}.{fn.__qualname__}"
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return fn(*args, **kwargs)
+            with _Span(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+# -------------------------
+# REPORTING
+# -------------------------
+
+def report():
+    with _lock:
+        spans = {
+            name: {
+                "calls": calls,
+                "total_seconds": total,
+                "mean_seconds": total / calls,
+                "max_seconds": longest,
+                "peak_rss_growth_bytes": growth,
+            }
+            for name, (calls, total, longest, growth) in sorted(_spans.items())
+        }
+        counters = dict(sorted(_counters.items()))
+    current, peak = rss()
+    return {
+        "enabled": enabled(),
+        "spans": spans,
+        "counters": counters,
+        "rss_bytes": current,
+        "peak_rss_bytes": peak,
+    }
+
+
+def to_json(r=None):
+    return json.dumps(r or report(), indent=1)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(r=None):
+    r = r or report()
+    lines = []
+
+    def family(metric, kind, help_text, samples):
+        lines.append(f"# HELP {PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PREFIX}_{metric}{labels} {value}")
+
+    spans = r["spans"].items()
+    family("span_calls_total", "counter", "Calls of an instrumented stage.",
+           [(f'{{span="{_label(n)}"}}', s["calls"]) for n, s in spans])
+    family("span_seconds_total", "counter", "Wall time spent in a stage.",
+           [(f'{{span="{_label(n)}"}}', repr(s["total_seconds"])) for n, s in spans])
+    family("span_max_seconds", "gauge", "Longest single call of a stage.",
+           [(f'{{span="{_label(n)}"}}', repr(s["max_seconds"])) for n, s in spans])
+    family("span_peak_rss_growth_bytes_total", "counter",
+           "Growth of the process peak RSS while inside a stage.",
+           [(f'{{span="{_label(n)}"}}', s["peak_rss_growth_bytes"]) for n, s in spans])
+    family("events_total", "counter", "Instrumentation counters.",
+           [(f'{{name="{_label(n)}"}}', v) for n, v in r["counters"].items()])
+    family("rss_bytes", "gauge", "Resident set size.", [("", r["rss_bytes"])])
+    family("peak_rss_bytes", "gauge", "Peak resident set size.", [("", r["peak_rss_bytes"])])
+    return "\n".join(lines) + "\n"
+
+
+def dump(path, r=None):
+    text = to_prometheus(r) if path.endswith((".prom", ".txt")) else to_json(r)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def format_table(r=None):
+    r = r or report()
+    mib = 2**20
+    lines = [f"{'stage':<36} {'calls':>7} {'total ms':>11} {'mean ms':>10} {'max ms':>10} {'RSS+ MiB':>9}"]
+    for name, s in sorted(r["spans"].items(), key=lambda kv: -kv[1]["total_seconds"]):
+        lines.append(
+            f"{name:<36} {s['calls']:>7} {s['total_seconds'] * 1000:>11.2f} "
+            f"{s['mean_seconds'] * 1000:>10.3f} {s['max_seconds'] * 1000:>10.2f} "
+            f"{s['peak_rss_growth_bytes'] / mib:>9.1f}"
+        )
+    for name, value in r["counters"].items():
+        lines.append(f"{name:<36} {value:>7}")
+    lines.append(f"RSS {r['rss_bytes'] / mib:.1f} MiB, peak {r['peak_rss_bytes'] / mib:.1f} MiB")
+    return "\n".join(lines)
@@ -0,0 +1,107 @@
+from collections import deque
+
+# Aho-Corasick multi-pattern matcher for entity names in questions.
+#
+# Patterns are matched case-insensitively and only on word boundaries, so
+# "temp sensor 1" does not fire inside "temp sensor 10". New patterns are
+# inserted into the trie as they arrive; failure links are recomputed lazily
+# on the next search.
+
+
+def _is_word(ch):
+    return ch.isalnum() or ch == "_"
+
+
+class EntityMatcher:
+    def __init__(self, patterns=None):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]      # (length, value) of the pattern ending here
+        self._dict = [0]        # nearest proper suffix node with an output
+        self._dirty = False
+        self.patterns = {}
+
+        for pattern, value in (patterns or {}).items():
+            self.add(pattern, value)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern.lower() in self.patterns
+
+    def add(self, pattern, value):
+        key = pattern.lower()
+        if not key:
+            return
+        self.patterns[key] = value
+
+        node = 0
+        for ch in key:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+                self._dict.append(0)
+                self._goto[node][ch] = nxt
+            node = nxt
+        self._out[node] = (len(key), value)
+        # a new output on an existing node changes the dict links too
+        self._dirty = True
+
+    def _build(self):
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            self._dict[child] = 0
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(ch, 0)
+                self._fail[child] = f
+                self._dict[child] = f if self._out[f] else self._dict[f]
+                queue.append(child)
+
+        self._dirty = False
+
+    def find_all(self, text):
+        # Returns non-overlapping (start, end, value) mentions, choosing the
+        # leftmost-longest pattern wherever candidates overlap.
+        if self._dirty:
+            self._build()
+
+        text = text.lower()
+        candidates = []
+        node = 0
+
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+
+            out = node if self._out[node] else self._dict[node]
+            while out:
+                length, value = self._out[out]
+                start = i + 1 - length
+                if (start == 0 or not _is_word(text[start - 1])) and (
+                    i + 1 == len(text) or not _is_word(text[i + 1])
+                ):
+                    candidates.append((start, i + 1, value))
+                out = self._dict[out]
+
+        candidates.sort(key=lambda c: (c[0], c[0] - c[1]))
+
+        matches = []
+        end = 0
+        for c in candidates:
+            if c[0] >= end:
+                matches.append(c)
+                end = c[1]
+        return matches
@@ -0,0 +1,297 @@
+import math
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+import rules
+from store import NAT
+
+# Device metrics derived from the event stream.
+#
+# For every device the engine keeps its event timestamps and running
+# (prefix) sums of confidence, RSSI, RSSI^2, completeness and battery
+# presence, in arrival order. Folding in an event appends one value per
+# array. The metrics over any trailing window are then differences of two
+# prefix sums: the window start is found by binary search from the previous
+# start (windows only move forward) and the first / last thirds used for
+# the trend are a fixed number of events from either end.
+#
+# Windows are measured back from the newest timestamp seen fleet-wide, and
+# assume each device's events arrive in timestamp order (as enrich.py
+# writes them).
+#
+# Events older than the widest finite window can never enter one again, so
+# a device's arrays are cut down to that window once at least half of them
+# is stale. The prefix sums stay absolute, which keeps the "all" totals
+# exact; for the "all" trend the first third may lie in the dropped part,
+# so the confidence prefix sum is also sampled every `stride` events (at
+# most MAX_MARKS samples per device) and interpolated there.
+#
+# A device with no events in a window is still reported, with NaN metrics,
+# event_count 0 and trend "no_data", so rules can flag it.
+
+NS = 10**9
+WINDOWS = {
+    "1h": 3600 * NS,
+    "24h": 86_400 * NS,
+    "7d": 7 * 86_400 * NS,
+    "all": None,
+}
+DEFAULT_WINDOW = "all"
+
+TREND_DELTA = 5            # mean(last third) - mean(first third)
+GOOD_RSSI_MEAN = -100      # "unreliable despite good RSSI": mean above,
+STABLE_RSSI_STD = 5        # and std below
+
+# RSSI is summed relative to this, keeping the squares small
+RSSI_SHIFT = -100.0
+
+MARK_STRIDE = 64           # events per confidence sample, to start with
+MAX_MARKS = 256            # samples kept per device before halving
+
+_SUMS = ("confidence", "rssi_n", "rssi", "rssi_sq", "completeness", "battery")
+
+
+def summarize(n, totals, head, tail):
+    # The device_metrics dict of n events, from the totals of _SUMS over
+    # them and the confidence sums of their first / last third
+    if n == 0:
+        return {
+            "avg_confidence": math.nan,
+            "confidence_trend": "no_data",
+            "rssi_std": math.nan,
+            "data_completeness": math.nan,
+            "battery_reporting_quality": math.nan,
+            "flags": [],
+            "event_count": 0,
+        }
+    avg = totals["confidence"] / n
+    third = max(1, n // 3)
+    delta = (tail - head) / third
+    if delta < -TREND_DELTA:
+        trend = "degrading"
+    elif delta > TREND_DELTA:
+        trend = "improving"
+    else:
+        trend = "stable"
+
+    k = round(totals["rssi_n"])
+    rssi_mean = rssi_std = 0
+    if k:
+        mean = totals["rssi"] / k
+        rssi_mean = mean + RSSI_SHIFT
+        if k > 1:
+            rssi_std = round(math.sqrt(max(totals["rssi_sq"] / k - mean * mean, 0.0)), 2)
+
+    m = {
+        "avg_confidence": round(avg, 2),
+        "confidence_trend": trend,
+        "rssi_std": rssi_std,
+        "data_completeness": round(totals["completeness"] / n, 3),
+        "battery_reporting_quality": round(totals["battery"] / n, 3),
+        "flags": [],
+        "event_count": n,
+    }
+    if (
+        m["avg_confidence"] < rules.threshold("low_confidence")
+        and k
+        and rssi_mean > GOOD_RSSI_MEAN
+        and m["rssi_std"] < STABLE_RSSI_STD
+    ):
+        m["flags"].append("unreliable_despite_good_rssi")
+    return m
+
+
+class _Device:
+    __slots__ = ("ts", "sums", "starts", "trimmed", "marks", "stride")
+
+    def __init__(self, windows):
+        self.ts = array("q")
+        self.sums = {name: array("d", [0.0]) for name in _SUMS}
+        self.starts = dict.fromkeys(windows, 0)
+        self.trimmed = 0            # events dropped from the front
+        self.marks = array("d", [0.0])  # confidence sum of the first i * stride
+        self.stride = MARK_STRIDE
+
+    def __len__(self):
+        return self.trimmed + len(self.ts)
+
+    def prefix(self, name, i):
+        # sum of name over the first i events; for confidence only, i may
+        # fall among the dropped ones
+        j = i - self.trimmed
+        if j >= 0:
+            return self.sums[name][j]
+        if i == 0:
+            return 0.0
+        k, _ = divmod(i, self.stride)
+        lo = k * self.stride
+        hi = min(lo + self.stride, self.trimmed)
+        a = self.marks[k]
+        b = self.marks[k + 1] if hi == lo + self.stride else self.sums[name][0]
+        return a + (b - a) * (i - lo) / (hi - lo)
+
+
+class DeviceMetrics:
+    def __init__(self, windows=WINDOWS):
+        self.windows = dict(windows)
+        self.now = NAT
+        self.devices = {}
+        # events older than now - retain are dropped; None keeps everything
+        self.retain = max((w for w in self.windows.values() if w is not None), default=None)
+
+    def _device(self, dev):
+        d = self.devices.get(dev)
+        if d is None:
+            d = self.devices[dev] = _Device(self.windows)
+        return d
+
+    def _mark(self, d, first, prefix):
+        # sample the confidence prefix sums of events first+1.. (prefix)
+        at = np.arange(len(d.marks) * d.stride, first + len(prefix) + 1, d.stride)
+        if len(at):
+            d.marks.frombytes(np.ascontiguousarray(prefix[at - first - 1]).tobytes())
+        while len(d.marks) > MAX_MARKS:
+            d.marks = d.marks[::2]
+            d.stride *= 2
+
+    def _trim(self, d):
+        if self.retain is None or not d.ts or d.ts[0] >= self.now - self.retain:
+            return
+        cut = bisect_left(d.ts, self.now - self.retain)
+        if 2 * cut < len(d.ts):
+            return
+        d.ts = d.ts[cut:]
+        for name in _SUMS:
+            d.sums[name] = d.sums[name][cut:]
+        d.trimmed += cut
+        for window, start in d.starts.items():
+            d.starts[window] = max(0, start - cut)
+
+    def trim(self):
+        # drop the events every finite window has moved past
+        for d in self.devices.values():
+            self._trim(d)
+
+    def _extend(self, d, ts, values):
+        first = len(d)
+        d.ts.frombytes(np.ascontiguousarray(ts, dtype=np.int64).tobytes())
+        for name in _SUMS:
+            sums = d.sums[name]
+            prefix = np.cumsum(values[name], dtype=np.float64) + sums[-1]
+            sums.frombytes(prefix.tobytes())
+            if name == "confidence":
+                self._mark(d, first, prefix)
+        if len(ts):
+            self.now = max(self.now, int(ts.max()))
+
+    def update(self, dev, ts, confidence, rssi=None, completeness=0.0, battery=False):
+        # one event; ts in ns since epoch
+        if ts == NAT:
+            return
+        d = self._device(dev)
+        has_rssi = rssi is not None and rssi == rssi
+        r = rssi - RSSI_SHIFT if has_rssi else 0.0
+        d.ts.append(ts)
+        for name, value in (
+            ("confidence", confidence),
+            ("rssi_n", 1.0 if has_rssi else 0.0),
+            ("rssi", r),
+            ("rssi_sq", r * r),
+            ("completeness", completeness),
+            ("battery", 1.0 if battery else 0.0),
+        ):
+            sums = d.sums[name]
+            sums.append(sums[-1] + value)
+        if len(d) == len(d.marks) * d.stride:
+            self._mark(d, len(d) - 1, np.array([d.sums["confidence"][-1]]))
+        if ts > self.now:
+            self.now = ts
+        self._trim(d)
+
+    def update_store(self, store, start=0, confidence=None):
+        # Fold rows [start:] of an EventStore; returns the touched devEuis.
+        # confidence, aligned with the store's rows, replaces its scores.
+        ts = store.column("timestamp")[start:]
+        dev = store.column("device")[start:]
+        keep = ts != NAT
+        rows = np.flatnonzero(keep) + start
+        if len(rows) == 0:
+            return []
+
+        dev = dev[keep]
+        order = np.argsort(dev, kind="stable")
+        rows, dev = rows[order], dev[order]
+        codes, bounds = np.unique(dev, return_index=True)
+        bounds = np.append(bounds, len(dev))
+
+        rssi = store.column("rssi")
+        cols = {
+            "confidence": store.column("confidence_score") if confidence is None else confidence,
+            "completeness": store.column("completeness"),
+            "battery": store.column("battery"),
+        }
+        touched = []
+        for i, code in enumerate(codes):
+            r = rows[bounds[i]:bounds[i + 1]]
+            x = rssi[r]
+            has = ~np.isnan(x)
+            shifted = np.where(has, x - RSSI_SHIFT, 0.0)
+            values = {name: col[r] for name, col in cols.items()}
+            values.update(rssi_n=has, rssi=shifted, rssi_sq=shifted * shifted)
+            dev_eui = store.devices[code]
+            self._extend(self._device(dev_eui), store.column("timestamp")[r], values)
+            touched.append(dev_eui)
+        self.trim()
+        return touched
+
+    @property
+    def nbytes(self):
+        total = 0
+        for d in self.devices.values():
+            total += d.ts.itemsize * len(d.ts)
+            total += sum(s.itemsize * len(s) for s in d.sums.values())
+            total += d.marks.itemsize * len(d.marks)
+        return total
+
+    def _bounds(self, d, window):
+        # first and end event of window, counted from the device's first
+        width = self.windows[window]
+        hi = len(d.ts)
+        if width is None:
+            return 0, len(d)
+        lo = bisect_left(d.ts, self.now - width, d.starts[window], hi)
+        d.starts[window] = lo
+        return d.trimmed + lo, len(d)
+
+    def metrics(self, dev, window=DEFAULT_WINDOW):
+        # The device_metrics dict over window (no-data when the device has
+        # no events in it), or None for a device never seen
+        d = self.devices.get(dev)
+        if d is None:
+            return None
+        lo, hi = self._bounds(d, window)
+        n = hi - lo
+        if n == 0:
+            return summarize(0, None, 0.0, 0.0)
+
+        def total(name, a=lo, b=hi):
+            return d.prefix(name, b) - d.prefix(name, a)
+
+        third = max(1, n // 3)
+        return summarize(
+            n,
+            {name: total(name) for name in _SUMS},
+            total("confidence", lo, lo + third),
+            total("confidence", hi - third, hi),
+        )
+
+    def snapshot(self, window=DEFAULT_WINDOW, devices=None):
+        # {devEui: metrics} for devices (default: all seen so far)
+        out = {}
+        for dev in self.devices if devices is None else devices:
+            m = self.metrics(dev, window)
+            if m is not None:
+                out[dev] = m
+        return out
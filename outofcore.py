@@ -0,0 +1,635 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import weakref
+from itertools import islice
+
+import numpy as np
+
+import instrument
+from accumulators import FleetStats
+from archive import compression, read_lines
+from decode import Projection
+from follow import LiveDataset
+from metrics import _SUMS, DEFAULT_WINDOW, RSSI_SHIFT, WINDOWS, summarize
+from query_engine import QueryIndex
+from rollups import RESOLUTIONS, Rollups
+from store import NAT, STORE_FIELDS, EventStore
+from tail import TailReader
+
+# Out-of-core, memory-bounded analytics.
+#
+# OutOfCoreDataset is a LiveDataset that never holds the history in memory.
+# Events are streamed once, in batches of about budget / READ_SHARE bytes
+# of JSONL, through a scratch EventStore that is cleared after every batch
+# (its interned device / gateway codes survive). Each batch is folded into
+# state that is bounded by the number of devices and gateways: FleetStats,
+# the QueryIndex, the name maps and daily rollups.
+#
+# Device metrics need each device's events in time order (windows and the
+# confidence trend), so every batch also contributes fixed-width records
+# to an external sort. A record carries its device's running sums of the
+# metric inputs, as metrics.DeviceMetrics keeps them in memory. Records are
+# sorted by (device, timestamp, arrival) into runs, kept in memory up to
+# budget / RUN_SHARE bytes and then spilled to a run file; FAN_IN run files
+# of about the same size are merged into one, so every record is rewritten
+# a logarithmic number of times.
+#
+# While a device's events arrive in time order, its window is a stretch of
+# its records in run order and the metrics are differences of the running
+# sums at a few positions, located by binary search in each run. A refresh
+# recomputes the devices that received events and, for every window whose
+# cut moved, the devices that had events in it; it reads a handful of
+# records per device and run instead of the history. A device that ever
+# receives an event older than its newest is recomputed from all of its
+# records instead.
+#
+# Per-event views (Trust Replay, 1m / 1h rollups, snapshots and the
+# warm-start cache) are not available in this mode.
+
+ENV = "SENTINELMESH_MAX_MEMORY"
+BUDGET = 512 * 2**20
+
+READ_SHARE = 16            # budget / READ_SHARE bytes of JSONL per batch
+RUN_SHARE = 8              # budget / RUN_SHARE bytes of records per sorted run
+MERGE_SHARE = 8            # budget / MERGE_SHARE bytes of records merged at once
+FAN_IN = 16                # run files of one size class merged at a time
+
+ROLLUPS = {"1d": RESOLUTIONS["1d"]}
+
+RECORD = np.dtype([
+    ("device", np.int32),
+    ("timestamp", np.int64),
+    ("seq", np.int64),             # arrival order, breaks timestamp ties
+    ("confidence", np.float64),
+    ("rssi", np.float64),
+    ("completeness", np.float64),
+    ("battery", np.int8),
+] + [
+    # the device's running sums through this event, in arrival order
+    ("sum_" + name, np.float64) for name in _SUMS
+])
+
+_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def parse_size(text):
+    # "512M", "2g", "1.5G", "1048576" -> bytes
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", str(text).lower())
+    if m is None:
+        raise ValueError(f"not a size: {text!r}")
+    return int(float(m.group(1)) * _UNITS[m.group(2)])
+
+
+def configured_budget():
+    # The budget from $SENTINELMESH_MAX_MEMORY, None when unset
+    text = os.environ.get(ENV, "")
+    return parse_size(text) if text else None
+
+
+# -------------------------
+# EXTERNAL SORT
+# -------------------------
+
+def _order(records):
+    return np.lexsort((records["seq"], records["timestamp"], records["device"]))
+
+
+def _le(records, key):
+    # records <= key in (device, timestamp, seq) order
+    dev, ts, seq = key
+    d, t = records["device"], records["timestamp"]
+    return (d < dev) | ((d == dev) & ((t < ts) | ((t == ts) & (records["seq"] <= seq))))
+
+
+def _key(record):
+    return int(record["device"]), int(record["timestamp"]), int(record["seq"])
+
+
+class SortedRuns:
+    # RECORD rows in runs sorted by (device, timestamp, seq), oldest first:
+    # recent rows in memory, spilled to a run file once there are run_rows
+    # of them
+
+    def __init__(self, run_rows, merge_rows, directory=None):
+        self.run_rows = max(1, run_rows)
+        self.merge_rows = max(1, merge_rows)
+        self.path = tempfile.mkdtemp(prefix="sentinelmesh-runs-", dir=directory)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.path, True)
+        self.runs = []
+        self.sizes = []             # rows per run file
+        self._maps = {}             # run file -> read-only memmap
+        self.rows = 0
+        self.peak = 0               # largest merge block so far, in bytes
+        self._buffer = []           # sorted runs in memory, halving in size
+        self._buffered = 0
+        self._next = 0
+
+    def close(self):
+        self._maps.clear()
+        self._cleanup()
+
+    def __len__(self):
+        # runs on disk and in memory
+        return len(self.runs) + len(self._buffer)
+
+    @property
+    def nbytes(self):
+        return self._buffered * RECORD.itemsize + self.peak
+
+    def add(self, records):
+        self._buffer.append(records[_order(records)])
+        self._buffered += len(records)
+        self.rows += len(records)
+        while len(self._buffer) > 1 and len(self._buffer[-2]) <= len(self._buffer[-1]):
+            merged = np.concatenate(self._buffer[-2:])
+            self._buffer[-2:] = [merged[_order(merged)]]
+        if self._buffered >= self.run_rows:
+            self.flush()
+
+    def flush(self):
+        # spill the buffered rows as a run
+        if not self._buffered:
+            return
+        records = np.concatenate(self._buffer)
+        self._buffer, self._buffered = [], 0
+        self._write(records[_order(records)])
+        while len(self.runs) >= FAN_IN and len({self._level(n) for n in self.sizes[-FAN_IN:]}) == 1:
+            with instrument.span("outofcore.compact"):
+                self.runs[-FAN_IN:] = [self._compact(self.runs[-FAN_IN:])]
+            self.sizes[-FAN_IN:] = [sum(self.sizes[-FAN_IN:])]
+
+    def _level(self, rows):
+        # size class: below FAN_IN * run_rows rows is 0, below FAN_IN times
+        # that 1, ...
+        level, cap = 0, self.run_rows * FAN_IN
+        while rows >= cap:
+            level, cap = level + 1, cap * FAN_IN
+        return level
+
+    def _new_path(self):
+        self._next += 1
+        return os.path.join(self.path, f"run-{self._next:06d}.npy")
+
+    def _write(self, records):
+        path = self._new_path()
+        np.save(path, records)
+        self.runs.append(path)
+        self.sizes.append(len(records))
+
+    def _open(self, paths):
+        for p in paths:
+            if p not in self._maps:
+                self._maps[p] = np.load(p, mmap_mode="r")
+        return [self._maps[p] for p in paths]
+
+    def _merge(self, runs):
+        # k-way merge of sorted runs: from each run's next block, take the
+        # rows up to the smallest last key among blocks that do not end
+        # their run; everything taken sorts before anything left behind
+        step = max(1, self.merge_rows // max(1, len(runs)))
+        pos = [0] * len(runs)
+        while True:
+            heads = [
+                (i, run[pos[i]:pos[i] + step])
+                for i, run in enumerate(runs)
+                if pos[i] < len(run)
+            ]
+            if not heads:
+                return
+            open_ends = [
+                _key(block[-1]) for i, block in heads if pos[i] + len(block) < len(runs[i])
+            ]
+            limit = min(open_ends) if open_ends else None
+
+            parts = []
+            for i, block in heads:
+                take = len(block) if limit is None else int(np.count_nonzero(_le(block, limit)))
+                if take:
+                    parts.append(np.array(block[:take]))
+                    pos[i] += take
+            merged = np.concatenate(parts)
+            self.peak = max(self.peak, 2 * merged.nbytes)
+            yield merged[_order(merged)]
+
+    def _compact(self, paths):
+        # merge paths into one new run file
+        runs = self._open(paths)
+        out_path = self._new_path()
+        out = np.lib.format.open_memmap(
+            out_path, mode="w+", dtype=RECORD, shape=(sum(len(r) for r in runs),)
+        )
+        i = 0
+        for block in self._merge(runs):
+            out[i:i + len(block)] = block
+            i += len(block)
+        out.flush()
+        del out, runs
+        for p in paths:
+            del self._maps[p]
+            os.remove(p)
+        return out_path
+
+    def segments(self, codes):
+        # every run, oldest first, with where the rows of each device in
+        # codes start in it and how many there are
+        runs = self._open(self.runs) + self._buffer
+        first = np.empty((len(runs), len(codes)), dtype=np.int64)
+        size = np.empty_like(first)
+        for i, run in enumerate(runs):
+            dev = run["device"]
+            first[i] = np.searchsorted(dev, codes)
+            size[i] = np.searchsorted(dev, codes, side="right") - first[i]
+        return runs, first, size
+
+    def rows_of(self, codes):
+        # every row of the devices in codes, in sorted order
+        runs, first, size = self.segments(codes)
+        parts = [
+            np.array(run[f:f + n])
+            for run, starts, sizes in zip(runs, first.tolist(), size.tolist())
+            for f, n in zip(starts, sizes)
+            if n
+        ]
+        records = np.concatenate(parts) if parts else np.empty(0, dtype=RECORD)
+        self.peak = max(self.peak, 2 * records.nbytes)
+        return records[_order(records)]
+
+
+def _bisect(ts, lo, hi, value):
+    # per pair: the first index in [lo, hi) of the sorted stretch
+    # ts[lo:hi] whose timestamp is >= value
+    lo, hi = lo.copy(), hi.copy()
+    while True:
+        active = np.flatnonzero(lo < hi)
+        if not len(active):
+            return lo
+        mid = (lo[active] + hi[active]) // 2
+        below = ts[mid] < value
+        lo[active[below]] = mid[below] + 1
+        hi[active[~below]] = mid[~below]
+
+
+def _inputs(records):
+    # per-event values summed into the _SUMS, as metrics.DeviceMetrics does
+    rssi = records["rssi"]
+    has = ~np.isnan(rssi)
+    shifted = np.where(has, rssi - RSSI_SHIFT, 0.0)
+    return {
+        "confidence": records["confidence"],
+        "rssi_n": has.astype(np.float64),
+        "rssi": shifted,
+        "rssi_sq": shifted * shifted,
+        "completeness": records["completeness"],
+        "battery": records["battery"].astype(np.float64),
+    }
+
+
+# -------------------------
+# DEVICE METRICS
+# -------------------------
+
+class ExternalMetrics:
+    # metrics.DeviceMetrics computed from SortedRuns instead of per-device
+    # prefix sums in memory; finish() must run before metrics / snapshot
+    # see rows added since the last call
+
+    def __init__(self, run_rows, merge_rows, directory=None, windows=WINDOWS):
+        self.windows = dict(windows)
+        self.now = NAT
+        self.runs = SortedRuns(run_rows, merge_rows, directory)
+        self.names = None
+        self._seq = 0
+        # per device code: events, running sums and newest timestamp so far
+        self._count = np.zeros(0, dtype=np.int64)
+        self._sums = {name: np.zeros(0) for name in _SUMS}
+        self._newest = np.zeros(0, dtype=np.int64)
+        self._unordered = np.zeros(0, dtype=bool)   # got an event older than _newest
+        self._dirty = np.zeros(0, dtype=bool)       # got events since finish()
+        # per window and device code: events inside at the last finish()
+        self._inside = {window: np.zeros(0, dtype=np.int64) for window in self.windows}
+        self._cuts = dict.fromkeys(self.windows, NAT)
+        self._snapshots = {window: {} for window in self.windows}
+
+    @property
+    def nbytes(self):
+        total = self.runs.nbytes + self._count.nbytes + self._newest.nbytes
+        total += self._unordered.nbytes + self._dirty.nbytes
+        total += sum(a.nbytes for a in self._sums.values())
+        total += sum(a.nbytes for a in self._inside.values())
+        return total
+
+    def _grow(self, n):
+        have = len(self._count)
+        if n <= have:
+            return
+
+        def grow(a, fill=0):
+            return np.concatenate([a, np.full(n - have, fill, dtype=a.dtype)])
+
+        self._count = grow(self._count)
+        self._sums = {name: grow(a) for name, a in self._sums.items()}
+        self._newest = grow(self._newest, NAT)
+        self._unordered = grow(self._unordered)
+        self._dirty = grow(self._dirty)
+        self._inside = {window: grow(a) for window, a in self._inside.items()}
+
+    def update_store(self, store, start=0):
+        # Fold rows [start:] of an EventStore
+        self.names = store.devices
+        ts = store.column("timestamp")[start:]
+        keep = np.flatnonzero(ts != NAT)
+        seq = self._seq
+        self._seq += len(ts)
+        if not len(keep):
+            return
+        self._grow(len(store.devices))
+
+        # by device, in arrival order
+        keep = keep[np.argsort(store.column("device")[start:][keep], kind="stable")]
+        records = np.empty(len(keep), dtype=RECORD)
+        records["device"] = dev = store.column("device")[start:][keep]
+        records["timestamp"] = ts = ts[keep]
+        records["seq"] = keep + seq
+        records["confidence"] = store.column("confidence_score")[start:][keep]
+        records["rssi"] = store.column("rssi")[start:][keep]
+        records["completeness"] = store.column("completeness")[start:][keep]
+        records["battery"] = store.column("battery")[start:][keep]
+
+        starts = np.flatnonzero(np.r_[True, dev[1:] != dev[:-1]])
+        lengths = np.diff(np.r_[starts, len(dev)])
+        codes = dev[starts]
+        for name, values in _inputs(records).items():
+            running = np.cumsum(values)
+            before = self._sums[name][codes] - np.r_[0.0, running[starts[1:] - 1]]
+            records["sum_" + name] = running + np.repeat(before, lengths)
+            self._sums[name][codes] = records["sum_" + name][starts + lengths - 1]
+
+        previous = np.r_[NAT, ts[:-1]]
+        previous[starts] = self._newest[codes]
+        self._unordered[dev[ts < previous]] = True
+        self._newest[codes] = np.maximum(self._newest[codes], np.maximum.reduceat(ts, starts))
+        self._count[codes] += lengths
+        self._dirty[codes] = True
+
+        self.runs.add(records)
+        self.now = max(self.now, int(ts.max()))
+
+    def finish(self):
+        if self.names is None:
+            return
+        self._grow(len(self.names))
+        cuts = {
+            window: NAT if width is None else self.now - width
+            for window, width in self.windows.items()
+        }
+        stale = {
+            window: self._dirty | ((cut != self._cuts[window]) & (self._inside[window] > 0))
+            for window, cut in cuts.items()
+        }
+        codes = np.flatnonzero(np.logical_or.reduce(list(stale.values())))
+
+        exact = codes[self._unordered[codes]]
+        codes = codes[~self._unordered[codes]]
+        # keep the (runs x devices) position tables within a merge block
+        step = max(1, self.runs.merge_rows // (len(self.runs) + 1))
+        for i in range(0, len(codes), step):
+            self._from_sums(codes[i:i + step], cuts, stale)
+        while len(exact):
+            rows = np.cumsum(self._count[exact])
+            n = max(1, int(np.searchsorted(rows, self.runs.merge_rows, side="right")))
+            self._from_rows(exact[:n], cuts, stale)
+            exact = exact[n:]
+
+        self._dirty[:] = False
+        self._cuts = cuts
+
+    def _from_sums(self, codes, cuts, stale):
+        # devices whose events arrived in time order: windows from the
+        # running sums at the window start, the end of its first third and
+        # the start of its last third
+        runs, first, size = self.runs.segments(codes)
+        ends = np.cumsum(size, axis=0)
+
+        def running(pos, sel):
+            # RECORD running sums through the pos-th event (zero for none)
+            out = np.zeros(len(pos), dtype=RECORD)
+            i = pos - 1
+            run = np.count_nonzero(ends[:, sel] <= i, axis=0)
+            for r, records in enumerate(runs):
+                hit = np.flatnonzero((run == r) & (i >= 0))
+                if len(hit):
+                    at = sel[hit]
+                    out[hit] = records[first[r, at] + i[hit] - ends[r, at] + size[r, at]]
+            return out
+
+        for window, cut in cuts.items():
+            sel = np.flatnonzero(stale[window][codes])
+            if not len(sel):
+                continue
+            end = self._count[codes[sel]]
+            lo = np.zeros(len(sel), dtype=np.int64)
+            if cut != NAT:
+                for r, records in enumerate(runs):
+                    f, n = first[r, sel], size[r, sel]
+                    lo += _bisect(records["timestamp"], f, f + n, cut) - f
+            k = end - lo
+            third = np.maximum(1, k // 3)
+            start = running(lo, sel)
+            head = running(np.minimum(lo + third, end), sel)["sum_confidence"]
+            tail = running(np.maximum(end - third, 0), sel)["sum_confidence"]
+            sums = {
+                name: self._sums[name][codes[sel]] - start["sum_" + name]
+                for name in _SUMS
+            }
+            self._publish(
+                window, codes[sel], k, sums,
+                head - start["sum_confidence"],
+                self._sums["confidence"][codes[sel]] - tail,
+            )
+
+    def _from_rows(self, codes, cuts, stale):
+        # devices with out-of-order events: every window from their rows
+        records = self.runs.rows_of(codes)
+        dev = records["device"]
+        starts = np.searchsorted(dev, codes)
+        lengths = np.diff(np.r_[starts, len(dev)])
+        local = np.repeat(np.arange(len(codes)), lengths)
+        # position of each row among its device's events
+        pos = np.arange(len(dev)) - np.repeat(starts, lengths)
+        end = np.repeat(lengths, lengths)
+        values = _inputs(records)
+        n = len(codes)
+
+        for window, cut in cuts.items():
+            inside = records["timestamp"] >= cut
+            k = np.bincount(local[inside], minlength=n)
+            lo = end - k[local]
+            third = np.maximum(1, k // 3)[local]
+            sums = {
+                name: np.bincount(local[inside], weights=v[inside], minlength=n)
+                for name, v in values.items()
+            }
+            head = inside & (pos < lo + third)
+            tail = pos >= end - third
+            sel = np.flatnonzero(stale[window][codes])
+            self._publish(
+                window, codes[sel], k[sel],
+                {name: s[sel] for name, s in sums.items()},
+                np.bincount(local[head], weights=values["confidence"][head], minlength=n)[sel],
+                np.bincount(local[tail], weights=values["confidence"][tail], minlength=n)[sel],
+            )
+
+    def _publish(self, window, codes, k, sums, head, tail):
+        self._inside[window][codes] = k
+        snapshot = self._snapshots[window]
+        sums = {name: s.tolist() for name, s in sums.items()}
+        for i, (code, n, h, t) in enumerate(zip(codes.tolist(), k.tolist(), head.tolist(), tail.tolist())):
+            snapshot[self.names[code]] = summarize(
+                n, {name: s[i] for name, s in sums.items()}, h, t
+            )
+
+    def metrics(self, dev, window=DEFAULT_WINDOW):
+        return self._snapshots[window].get(dev)
+
+    def snapshot(self, window=DEFAULT_WINDOW, devices=None):
+        snapshot = self._snapshots[window]
+        if devices is None:
+            return dict(snapshot)
+        return {dev: snapshot[dev] for dev in devices if dev in snapshot}
+
+
+# -------------------------
+# DATASET
+# -------------------------
+
+class _ArchiveReader:
+    # TailReader stand-in over a rotated / compressed archive (see
+    # archive.py): read once, in batches of `rows` events
+    def __init__(self, spec, decode, rows):
+        self.path = spec
+        self.decode = decode
+        self.rows = rows
+        self.offset = 0
+        self.inode = self.mtime_ns = self.size = None
+        self._lines = None
+
+    def checkpoint(self):
+        return None
+
+    def poll(self):
+        if self._lines is None:
+            self._lines = read_lines(self.path)
+        events = [self.decode(line) for line in islice(self._lines, self.rows)]
+        self.offset += len(events)
+        return events, False
+
+
+class OutOfCoreDataset(LiveDataset):
+    def __init__(self, path="enriched_events.jsonl", budget=BUDGET,
+                 metrics_window=DEFAULT_WINDOW, spill_dir=None):
+        # budget: bytes of working memory to stay within (roughly: the
+        # bounded per-device / per-gateway state comes on top)
+        # spill_dir: where sorted runs go (default: the system temp dir)
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.metrics_window = metrics_window
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.cache = None
+        self._reset()
+
+        decode = Projection(STORE_FIELDS)
+        batch_bytes = max(1 << 16, budget // READ_SHARE)
+        if isinstance(path, str) and os.path.isfile(path) and not compression(path):
+            self.reader = TailReader(path, decode=decode, max_bytes=batch_bytes)
+        else:
+            # ~1 KiB of JSONL per event
+            self.reader = _ArchiveReader(path, decode, max(1, batch_bytes // 1024))
+
+    @property
+    def event_count(self):
+        return self._events
+
+    @property
+    def nbytes(self):
+        # the scratch batch, the in-memory runs, the largest merge block so
+        # far and the per-device state; gateway and query state come on top
+        return self.store.nbytes + self.metrics.nbytes + self.rollups.nbytes
+
+    def time_range(self):
+        if self._first == NAT:
+            return (0, 0)
+        return (self._first, self._last)
+
+    def _reset(self):
+        self.store = EventStore()
+        self.devices = {}
+        self.gateways = {}
+        self.device_metrics = {}
+        self.metrics = ExternalMetrics(
+            self.budget // RUN_SHARE // RECORD.itemsize,
+            self.budget // MERGE_SHARE // RECORD.itemsize,
+            self.spill_dir,
+        )
+        self.rollups = Rollups(ROLLUPS)
+        self.gateway_stats = {}
+        self.fleet = FleetStats()
+        self.device_name_map = {}
+        self.gateway_name_map = {}
+        self.query_index = QueryIndex()
+        self._events = 0
+        self._first = self._last = NAT
+        self._named = (0, 0)
+
+    def refresh(self):
+        with self._lock, instrument.span("outofcore.refresh"):
+            added = 0
+            while True:
+                with instrument.span("outofcore.parse"):
+                    events, reset = self.reader.poll()
+                if reset:
+                    self.generation += 1
+                    self._reset()
+                if not events:
+                    break
+
+                self.store.clear()
+                with instrument.span("outofcore.append"):
+                    for r in events:
+                        self.store.append_record(r)
+                added += len(events)
+                del events
+                self._index(0)
+
+            if added:
+                instrument.count("outofcore.events", added)
+                with instrument.span("outofcore.device_metrics"):
+                    self.metrics.finish()
+                    self.device_metrics = self.metrics.snapshot(self.metrics_window)
+            return added
+
+    def _index(self, first):
+        store = self.store
+        devices, gateways = self._named
+        self._named = (len(store.devices), len(store.gateways))
+        self._name(range(devices, len(store.devices)), range(gateways, len(store.gateways)))
+
+        ts = store.column("timestamp")
+        ts = ts[ts != NAT]
+        if len(ts):
+            lo, hi = int(ts.min()), int(ts.max())
+            self._first = lo if self._first == NAT else min(self._first, lo)
+            self._last = max(self._last, hi)
+        self._events += len(store)
+
+        self.query_index.add_store(store)
+        with instrument.span("outofcore.rollups"):
+            self.rollups.update_store(store)
+        with instrument.span("outofcore.spill"):
+            self.metrics.update_store(store)
+        with instrument.span("outofcore.gateway_stats"):
+            for gw in self.fleet.update_store(store):
+                self.gateway_stats[gw] = self.fleet.gateways[gw].summary()
@@ -1,12 +1,64 @@
-import pandas as pd
+import re
+
+import numpy as np
+
+import instrument
+import rules
+from accumulators import FleetStats
+from matcher import EntityMatcher
+from store import EventStore, NAT, format_timestamp, parse_timestamp
 
 # -------------------------
 # QUERY PARSING
 # -------------------------
 
-def parse_query(text):
-    q = text.lower().strip()
-
+DEVICE_INTENTS = {
+    "device_id",
+    "sensor_type",
+    "last_seen",
+    "device_location",
+    "message_count",
+    "device_confidence",
+    "device_health",
+    "device_gateway",
+}
+
+GATEWAY_INTENTS = {"gateway_devices", "gateway_events"}
+
+# "p5 rssi", "median snr", "95th percentile confidence", ...
+PERCENTILE = re.compile(
+    r"\b(?:p(100|\d{1,2}(?:\.\d+)?)|(100|\d{1,2}(?:\.\d+)?)(?:st|nd|rd|th)? percentile(?: of)?|(median))"
+    r"\s+(rssi|snr|confidence)\b"
+)
+
+# metric -> (label, unit) in answers
+METRICS = {
+    "rssi": ("RSSI", " dBm"),
+    "snr": ("SNR", " dB"),
+    "confidence": ("confidence", ""),
+}
+
+
+@instrument.timed("query.parse")
+def parse_query(text, matcher=None):
+    intent, arg = _match_intent(text.lower().strip())
+
+    # With an entity matcher, narrow the argument down to the mentioned
+    # device or gateway name
+    if matcher is not None and intent == "percentile":
+        p, metric, q = arg
+        arg = (p, metric, next((q[start:end] for start, end, _ in matcher.find_all(q)), None))
+    elif matcher is not None and arg is not None:
+        kind = "gateway" if intent in GATEWAY_INTENTS else "device"
+        arg = next(
+            (arg[start:end] for start, end, (k, _) in matcher.find_all(arg) if k == kind),
+            None,
+        )
+
+    return intent, arg
+
+
+def _match_intent(q):
     # Inventory
     if q in ["what devices exist", "list devices"]:
         return ("list_devices", None)
@@ -25,6 +77,12 @@ def parse_query(text):
     if "most unreliable" in q:
         return ("worst_device", None)
 
+    # Distributions: arg is (percentile, metric, question)
+    m = PERCENTILE.search(q)
+    if m:
+        p = 50.0 if m.group(3) else float(m.group(1) or m.group(2))
+        return ("percentile", (p, m.group(4), q))
+
     # Device-specific
     if "device id" in q:
         return ("device_id", q)
@@ -54,10 +112,160 @@ def parse_query(text):
     return ("unknown", None)
 
 
+# -------------------------
+# QUERY INDEX
+# -------------------------
+
+class QueryIndex:
+    # Per-device and per-gateway facts needed by handle_query, built once
+    # and kept current with add_events / add_store as data arrives.
+
+    def __init__(self, device_name_map=None, gateway_name_map=None):
+        self.devices = {}
+        self.gateways = {}
+        self.set_names(device_name_map or {}, gateway_name_map or {})
+
+    def set_names(self, device_name_map, gateway_name_map):
+        self.device_name_map = device_name_map
+        self.gateway_name_map = gateway_name_map
+
+        names = {v.lower(): ("device", k) for k, v in device_name_map.items()}
+        names.update(
+            {v.lower(): ("gateway", k) for k, v in gateway_name_map.items()}
+        )
+
+        matcher = getattr(self, "matcher", None)
+        if matcher is None or any(p not in names for p in matcher.patterns):
+            self.matcher = EntityMatcher(names)
+            return
+        for name, value in names.items():
+            if matcher.patterns.get(name) != value:
+                matcher.add(name, value)
+
+    def _find(self, q, kind):
+        for _, _, (k, entity) in self.matcher.find_all(q):
+            if k == kind:
+                return entity
+        return None
+
+    def find_device(self, q):
+        return self._find(q, "device")
+
+    def find_gateway(self, q):
+        return self._find(q, "gateway")
+
+    def _device(self, dev, profile):
+        d = self.devices.get(dev)
+        if d is None:
+            d = self.devices[dev] = {
+                "count": 0,
+                "last_ts": NAT,
+                "last_seen": None,
+                "profile": profile,
+                "location": None,
+                "gateways": set(),
+            }
+        return d
+
+    def _gateway(self, gw):
+        g = self.gateways.get(gw)
+        if g is None:
+            g = self.gateways[gw] = {
+                "count": 0,
+                "min_confidence": np.inf,
+                "devices": set(),
+            }
+        return g
+
+    def add(self, e):
+        dev = e["device"]["devEui"]
+        rf = e["rf"]
+
+        d = self._device(dev, e["device"].get("profile"))
+        d["count"] += 1
+        ts = parse_timestamp(e["timestamp"])
+        if d["last_seen"] is None or ts > d["last_ts"]:
+            d["last_ts"] = ts
+            d["last_seen"] = e["timestamp"]
+        if rf.get("location"):
+            d["location"] = rf["location"]
+
+        gw = rf.get("gatewayId")
+        if gw:
+            d["gateways"].add(gw)
+            g = self._gateway(gw)
+            g["count"] += 1
+            g["devices"].add(dev)
+            g["min_confidence"] = min(
+                g["min_confidence"], e["confidence"]["confidence_score"]
+            )
+
+    def add_events(self, events):
+        if isinstance(events, EventStore):
+            self.add_store(events)
+            return
+        for e in events:
+            self.add(e)
+
+    @instrument.timed("query.index_add_store")
+    def add_store(self, store, start=0):
+        # Vectorized fold of rows [start:] of an EventStore
+        dev = store.column("device")[start:].astype(np.int64)
+        if len(dev) == 0:
+            return
+        gw = store.column("gateway")[start:].astype(np.int64)
+        ts = store.column("timestamp")[start:]
+        loc = store.column("location")[start:]
+        conf = store.column("confidence_score")[start:]
+
+        n_dev = len(store.devices)
+        counts = np.bincount(dev, minlength=n_dev)
+        last_ts = np.full(n_dev, NAT, dtype=np.int64)
+        np.maximum.at(last_ts, dev, ts)
+
+        has_loc = np.flatnonzero(loc >= 0)[::-1]
+        _, first = np.unique(dev[has_loc], return_index=True)
+        last_loc = {int(dev[i]): int(loc[i]) for i in has_loc[first]}
+
+        for code in np.flatnonzero(counts):
+            d = self._device(
+                store.devices[code], store.device_info[code].get("profile")
+            )
+            d["count"] += int(counts[code])
+            if d["last_seen"] is None or last_ts[code] > d["last_ts"]:
+                d["last_ts"] = int(last_ts[code])
+                d["last_seen"] = format_timestamp(last_ts[code])
+            if code in last_loc:
+                d["location"] = store.location_values[last_loc[code]]
+
+        has_gw = gw >= 0
+        dev, gw, conf = dev[has_gw], gw[has_gw], conf[has_gw]
+        if len(gw) == 0:
+            return
+
+        n_gw = len(store.gateways)
+        gw_counts = np.bincount(gw, minlength=n_gw)
+        min_conf = np.full(n_gw, np.inf)
+        np.minimum.at(min_conf, gw, conf)
+
+        for code in np.flatnonzero(gw_counts):
+            g = self._gateway(store.gateways[code])
+            g["count"] += int(gw_counts[code])
+            g["min_confidence"] = min(g["min_confidence"], float(min_conf[code]))
+
+        pairs = np.unique(dev * n_gw + gw)
+        for d_code, g_code in zip(pairs // n_gw, pairs % n_gw):
+            dev_id = store.devices[d_code]
+            gw_id = store.gateways[g_code]
+            self.devices[dev_id]["gateways"].add(gw_id)
+            self.gateways[gw_id]["devices"].add(dev_id)
+
+
 # -------------------------
 # QUERY HANDLER
 # -------------------------
 
+@instrument.timed("query.handle")
 def handle_query(
     intent,
     arg,
@@ -65,24 +273,15 @@ def handle_query(
     device_metrics,
     device_name_map,
     gateway_name_map,
+    index=None,
+    fleet=None,
 ):
-    import pandas as pd
-
-    df = pd.DataFrame(events)
-    name_to_dev = {v.lower(): k for k, v in device_name_map.items()}
-    name_to_gw = {v.lower(): k for k, v in gateway_name_map.items()}
-
-    def find_device(q):
-        for name, dev in name_to_dev.items():
-            if name in q:
-                return dev
-        return None
-
-    def find_gateway(q):
-        for name, gid in name_to_gw.items():
-            if name in q:
-                return gid
-        return None
+    # fleet: accumulators.FleetStats of the events, for percentile
+    # questions; built from events when not given
+    instrument.count(f"query.intent.{intent}")
+    if index is None:
+        index = QueryIndex(device_name_map, gateway_name_map)
+        index.add_events(events)
 
     # Inventory
     if intent == "list_devices":
@@ -98,102 +297,112 @@ def handle_query(
         return f"There are {len(gateway_name_map)} gateways."
 
     # Fleet health
+    if intent in ("faulty_devices", "maintenance_devices", "worst_device"):
+        table = rules.evaluate(device_metrics)
+
     if intent == "faulty_devices":
         return [
-            device_name_map[d]
-            for d, m in device_metrics.items()
-            if m["avg_confidence"] < 70
+            device_name_map[d] for d in rules.select(table, "faulty")
         ] or ["No faulty devices detected"]
 
     if intent == "maintenance_devices":
         return [
-            device_name_map[d]
-            for d, m in device_metrics.items()
-            if m["battery_reporting_quality"] < 0.5
-            or m["confidence_trend"] == "degrading"
+            device_name_map[d] for d in rules.select(table, "needs_maintenance")
         ]
 
     if intent == "worst_device":
-        d = min(device_metrics, key=lambda x: device_metrics[x]["avg_confidence"])
+        confidence = table["avg_confidence"]
+        if np.isnan(confidence).all():
+            return "No device data in this window"
+        d = table["devices"][int(np.nanargmin(confidence))]
         return device_name_map[d]
 
+    if intent == "percentile":
+        return _percentile(arg, events, device_name_map, gateway_name_map, index, fleet)
+
     # Device-specific
-    dev = find_device(arg or "")
+    dev = index.find_device(arg or "")
 
-    if dev:
+    if dev and dev in index.devices:
         name = device_name_map[dev]
+        info = index.devices[dev]
 
         if intent == "device_id":
             return f"{name} device ID is {dev}"
 
         if intent == "sensor_type":
-            profile = next(
-                e["device"]["profile"]
-                for e in events
-                if e["device"]["devEui"] == dev
-            )
-            return f"{name} is a {profile} sensor"
+            return f"{name} is a {info['profile']} sensor"
 
         if intent == "last_seen":
-            last = max(
-                e["timestamp"]
-                for e in events
-                if e["device"]["devEui"] == dev
-            )
-            return f"Last data received at {last}"
+            return f"Last data received at {info['last_seen']}"
 
         if intent == "device_location":
-            locs = [
-                e["rf"]["location"]
-                for e in events
-                if e["device"]["devEui"] == dev and e["rf"].get("location")
-            ]
-            return locs[-1] if locs else "No location data available"
+            return info["location"] or "No location data available"
 
         if intent == "message_count":
-            count = sum(1 for e in events if e["device"]["devEui"] == dev)
-            return f"{name} has sent {count} messages"
+            return f"{name} has sent {info['count']} messages"
+
+        if intent in ("device_confidence", "device_health"):
+            m = device_metrics.get(dev)
+            if m is None or rules.holds(m, "no_data"):
+                return f"No data from {name} in this window"
 
         if intent == "device_confidence":
-            return f"{name} average confidence is {device_metrics[dev]['avg_confidence']}"
+            return f"{name} average confidence is {m['avg_confidence']}"
 
         if intent == "device_health":
-            m = device_metrics[dev]
-            return "Healthy" if m["avg_confidence"] >= 70 else "At risk"
+            return "At risk" if rules.holds(m, "low_confidence") else "Healthy"
 
         if intent == "device_gateway":
-            gws = {
-                gateway_name_map[e["rf"]["gatewayId"]]
-                for e in events
-                if e["device"]["devEui"] == dev and e["rf"].get("gatewayId")
-            }
-            return list(gws)
+            return sorted(gateway_name_map[g] for g in info["gateways"])
 
     # Gateway
-    gw = find_gateway(arg or "")
+    gw = index.find_gateway(arg or "")
 
-    if gw:
+    if gw and gw in index.gateways:
         name = gateway_name_map[gw]
+        info = index.gateways[gw]
 
         if intent == "gateway_devices":
             return sorted({
-                device_name_map[e["device"]["devEui"]]
-                for e in events
-                if e["rf"].get("gatewayId") == gw
+                device_name_map.get(d, d)
+                for d in info["devices"]
             })
 
         if intent == "gateway_events":
-            count = sum(1 for e in events if e["rf"].get("gatewayId") == gw)
-            return f"{name} handled {count} events"
+            return f"{name} handled {info['count']} events"
 
     if intent == "unstable_gateways":
         return [
             gateway_name_map[g]
             for g in gateway_name_map
-            if any(
-                e["rf"]["gatewayId"] == g and e["confidence"]["confidence_score"] < 70
-                for e in events
-            )
+            if g in index.gateways and index.gateways[g]["min_confidence"] < rules.UNSTABLE_GATEWAY_MIN_CONFIDENCE
         ] or ["No unstable gateways"]
 
     return "Unsupported question."
+
+
+def _percentile(arg, events, device_name_map, gateway_name_map, index, fleet):
+    p, metric, q = arg
+    if fleet is None:
+        fleet = FleetStats()
+        if isinstance(events, EventStore):
+            fleet.update_store(events)
+        else:
+            for e in events:
+                fleet.update(e)
+
+    gw = index.find_gateway(q or "")
+    dev = index.find_device(q or "")
+    if gw and gw in fleet.gateways:
+        name, stats = gateway_name_map[gw], fleet.gateways[gw]
+    elif dev and dev in fleet.devices:
+        name, stats = device_name_map[dev], fleet.devices[dev]
+    else:
+        return "Unsupported question."
+
+    label, unit = METRICS[metric]
+    value = stats.quantile(metric, p / 100)
+    if value is None:
+        return f"No {label} data for {name}"
+    return f"{name} p{p:g} {label} is {value:.1f}{unit}"
@@ -0,0 +1,177 @@
+import itertools
+import json
+import os
+import threading
+
+import instrument
+import outofcore
+from cache import DatasetCache
+from follow import LiveDataset
+from outofcore import OutOfCoreDataset, parse_size
+
+# Registry of named datasets, one per site or tenant.
+#
+# Sites come from $SENTINELMESH_SITES (default sites.json):
+#
+#   a JSON file   {"<site>": "<events path>" | {"path": ..., "snapshot": ...,
+#                 "cache": ..., "segments": ..., "max_memory": "512M",
+#                 "spill_dir": ...}}
+#   a directory   one site per subdirectory holding enriched_events.jsonl
+#
+# Without either, the only site is enriched_events.jsonl in the current
+# directory. Snapshot, warm-start cache and segment log paths default to
+# the events path with .snapshot / .warm / .segments in place of .jsonl;
+# the segment log, when present, serves Trust Replay; max_memory (or
+# $SENTINELMESH_MAX_MEMORY) runs the site out-of-core.
+#
+# A site is opened on first access and its DatasetCache is shared by every
+# session. Looking up a loaded site takes no lock: entries live in a dict
+# that is replaced, never mutated, and recency is a number from a shared
+# counter. Loads and evictions are serialized. When the loaded sites hold
+# more than $SENTINELMESH_REGISTRY_MEMORY, the least recently used ones are
+# saved to their warm-start cache and dropped, so reopening them is cheap;
+# sessions still holding one keep a working dataset until they let go.
+
+SITES_ENV = "SENTINELMESH_SITES"
+BUDGET_ENV = "SENTINELMESH_REGISTRY_MEMORY"
+SITES = "sites.json"
+EVENTS = "enriched_events.jsonl"
+DEFAULT_SITE = "default"
+
+
+def _site(path, **options):
+    base = path[:-len(".jsonl")] if path.endswith(".jsonl") else path
+    site = {
+        "path": path,
+        "snapshot": base + ".snapshot",
+        "cache": base + ".warm",
+        "segments": base + ".segments",
+    }
+    site.update(options)
+    return site
+
+
+def load_sites(spec=None):
+    # {name: site config} from spec, $SENTINELMESH_SITES or sites.json
+    spec = spec or os.environ.get(SITES_ENV) or SITES
+    if os.path.isdir(spec):
+        return {
+            name: _site(os.path.join(spec, name, EVENTS))
+            for name in sorted(os.listdir(spec))
+            if os.path.isfile(os.path.join(spec, name, EVENTS))
+        }
+    if not os.path.isfile(spec):
+        return {DEFAULT_SITE: _site(EVENTS)}
+
+    with open(spec) as f:
+        config = json.load(f)
+    root = os.path.dirname(os.path.abspath(spec))
+    sites = {}
+    for name, entry in config.items():
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        entry = {
+            key: os.path.join(root, value) if key in ("path", "snapshot", "cache", "segments", "spill_dir") else value
+            for key, value in entry.items()
+        }
+        sites[name] = _site(entry.pop("path"), **entry)
+    return sites
+
+
+def configured_budget():
+    # The registry budget from $SENTINELMESH_REGISTRY_MEMORY, None when unset
+    text = os.environ.get(BUDGET_ENV, "")
+    return parse_size(text) if text else None
+
+
+def open_dataset(site):
+    budget = site.get("max_memory") or outofcore.configured_budget()
+    if budget:
+        return OutOfCoreDataset(
+            site["path"], budget=parse_size(budget), spill_dir=site.get("spill_dir")
+        )
+    return LiveDataset(site["path"], snapshot=site.get("snapshot"), cache=site.get("cache"))
+
+
+class _Entry:
+    __slots__ = ("cache", "used")
+
+    def __init__(self, cache, used):
+        self.cache = cache
+        self.used = used
+
+
+class Registry:
+    def __init__(self, sites=None, budget=None, open_dataset=open_dataset):
+        self.sites = load_sites() if sites is None else dict(sites)
+        self.budget = budget
+        self.open_dataset = open_dataset
+        self.loads = 0
+        self.evictions = 0
+        self._entries = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def names(self):
+        return list(self.sites)
+
+    def loaded(self):
+        # loaded site names, most recently used first
+        entries = self._entries
+        return sorted(entries, key=lambda name: entries[name].used, reverse=True)
+
+    def get(self, name):
+        # The site's DatasetCache, opened (and refreshed once) on first use
+        entry = self._entries.get(name)
+        if entry is None:
+            if name not in self.sites:
+                raise KeyError(name)
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    with instrument.span("registry.load"):
+                        cache = DatasetCache(self.open_dataset(self.sites[name]))
+                        cache.refresh()
+                    entry = _Entry(cache, next(self._clock))
+                    self._entries = {**self._entries, name: entry}
+                    self.loads += 1
+                    instrument.count("registry.loads")
+                    self._evict(keep=name)
+        entry.used = next(self._clock)
+        return entry.cache
+
+    def refresh(self, name):
+        # Fold new events into the site and evict others if it grew
+        cache = self.get(name)
+        cache.refresh()
+        if self.budget is not None and self.nbytes() > self.budget:
+            with self._lock:
+                self._evict(keep=name)
+        return cache
+
+    def nbytes(self):
+        return sum(entry.cache.data.nbytes for entry in self._entries.values())
+
+    def _drop(self, name):
+        entries = dict(self._entries)
+        data = entries.pop(name).cache.data
+        self._entries = entries
+        data.save_cache()
+        self.evictions += 1
+        instrument.count("registry.evictions")
+
+    def _evict(self, keep):
+        # drop least recently used sites until the rest fit the budget;
+        # the site being served is always kept
+        if self.budget is None:
+            return
+        while self.nbytes() > self.budget and len(self._entries) > 1:
+            self._drop(min(
+                (name for name in self._entries if name != keep),
+                key=lambda name: self._entries[name].used,
+            ))
+
+    def evict(self, name):
+        with self._lock:
+            if name in self._entries:
+                self._drop(name)
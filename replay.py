@@ -0,0 +1,106 @@
+import numpy as np
+
+import rules
+from store import NAT
+
+# As-of state index for Trust Replay.
+#
+# Events are regrouped once into per-device, timestamp-sorted runs, and
+# each event gets one sortable int64 key: the device's index times the
+# number of distinct timestamps, plus the rank of its timestamp among them.
+# The state of every device at time T is then a single vectorized binary
+# search for all devices instead of a filter + sort + groupby over the
+# whole history.
+#
+# from_segments builds the index for one time window of a segmented log,
+# so replaying a day does not read the rest of the history.
+
+
+class ReplayIndex:
+    def __init__(self, store, threshold=None):
+        # threshold: confidence below which a device counts as low; the
+        # rules' low_confidence cutoff by default
+        if threshold is None:
+            threshold = rules.threshold("low_confidence")
+        self.threshold = threshold
+        self.devices = store.devices
+
+        ts = store.column("timestamp")
+        rows = np.flatnonzero(ts != NAT)
+        dev = store.column("device")[rows]
+        order = np.lexsort((ts[rows], dev))
+        rows = rows[order]
+        dev = dev[order]
+
+        self.ts = ts[rows]
+        self.confidence = store.column("confidence_score")[rows]
+        self.device_codes = np.unique(dev)
+        self.starts = np.searchsorted(dev, self.device_codes, side="left")
+        self.ends = np.searchsorted(dev, self.device_codes, side="right")
+
+        self._times, rank = np.unique(self.ts, return_inverse=True)
+        index = np.repeat(np.arange(len(self.device_codes)), self.ends - self.starts)
+        self._keys = index * len(self._times) + rank
+
+        # running count of threshold crossings along each device's run
+        below = self.confidence < threshold
+        flips = np.zeros(len(below), dtype=np.int64)
+        flips[1:] = below[1:] != below[:-1]
+        flips[self.starts] = 0
+        self._crossings = np.cumsum(flips)
+
+    @classmethod
+    def from_segments(cls, log, start, end, threshold=None):
+        # Replay window [start, end] over a segments.SegmentLog. Only the
+        # segments overlapping the window are read, plus, per device, the
+        # newest older segment holding its state at start. Device codes
+        # refer to self.devices.
+        return cls(log.store(start, end, lookback=True), threshold)
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def min_time(self):
+        return self.ts.min() if len(self.ts) else NAT
+
+    @property
+    def max_time(self):
+        return self.ts.max() if len(self.ts) else NAT
+
+    def _positions(self, t):
+        # index of each device's last event at or before t, -1 if none
+        rank = np.searchsorted(self._times, t, side="right") - 1
+        keys = np.arange(len(self.device_codes)) * len(self._times) + rank
+        pos = np.searchsorted(self._keys, keys, side="right") - 1
+        pos[pos < self.starts] = -1
+        return pos
+
+    def state_at(self, t):
+        # Returns (device codes, confidence, timestamp) of every device that
+        # has reported by time t (ns since epoch)
+        pos = self._positions(t)
+        seen = pos >= 0
+        pos = pos[seen]
+        return self.device_codes[seen], self.confidence[pos], self.ts[pos]
+
+    def crossings(self, t1, t2):
+        # Devices whose confidence crossed the threshold in (t1, t2].
+        # Returns a list of (device code, confidence at t1 or None,
+        # confidence at t2, number of crossings).
+        p1 = self._positions(t1)
+        p2 = self._positions(t2)
+
+        base = np.where(p1 >= 0, self._crossings[p1], self._crossings[self.starts])
+        counts = np.where(p2 >= 0, self._crossings[p2] - base, 0)
+
+        results = []
+        for i in np.flatnonzero(counts > 0):
+            before = float(self.confidence[p1[i]]) if p1[i] >= 0 else None
+            results.append((
+                int(self.device_codes[i]),
+                before,
+                float(self.confidence[p2[i]]),
+                int(counts[i]),
+            ))
+        return results
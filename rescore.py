@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import rules
+from enrich import WEIGHTS
+from metrics import DEFAULT_WINDOW, WINDOWS, DeviceMetrics
+from store import NO_FCNT, load_store
+
+# What-if confidence rescoring.
+#
+# Rescorer recomputes confidence_score for every event of an EventStore
+# from the raw fields the store keeps (measurement completeness, battery
+# presence, RSSI, SNR, frame counter, ADR), with the rules of
+# enrich.score_events but as whole-column NumPy operations over batches of
+# rows. The only per-device state, the frame counter gap to the device's
+# previous event, does not depend on the weights: it is found once, with
+# one sort by (device, timestamp), and every weight profile after that is
+# a handful of vectorized comparisons.
+#
+# compare() folds the rescored history into device metrics and the fleet
+# rules, and lines up every device's SLA status and risk under the baseline
+# (the scores in the events, or another weight profile) and the what-if
+# weights.
+
+BATCH_SIZE = 1 << 20       # rows scored at a time
+
+
+def load_weights(path=None, overrides=()):
+    # WEIGHTS updated from a JSON object at path and "name=value" overrides
+    updates = {}
+    if path:
+        with open(path) as f:
+            updates.update(json.load(f))
+    for item in overrides:
+        name, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"not a name=value weight: {item!r}")
+        updates[name.strip()] = float(value)
+    unknown = sorted(set(updates) - set(WEIGHTS))
+    if unknown:
+        raise ValueError(f"unknown weights: {', '.join(unknown)}")
+    return {**WEIGHTS, **updates}
+
+
+def frame_gaps(store):
+    # fCnt - previous fCnt - 1 of every row against the same device's last
+    # event with a frame counter, in timestamp order; 0 without one
+    n = len(store)
+    dev = store.column("device")
+    order = np.lexsort((store.column("timestamp"), dev))
+    fcnt = store.column("fcnt")[order]
+    positions = np.arange(n)
+
+    # last position at or before each one with a frame counter, and the
+    # first position of each device's run
+    last = np.maximum.accumulate(np.where(fcnt != NO_FCNT, positions, -1))
+    first = np.zeros(n, dtype=np.int64)
+    if n:
+        d = dev[order]
+        new = np.ones(n, dtype=bool)
+        new[1:] = d[1:] != d[:-1]
+        first = np.maximum.accumulate(np.where(new, positions, 0))
+
+    prev = np.full(n, -1, dtype=np.int64)
+    prev[1:] = last[:-1]
+    known = (fcnt != NO_FCNT) & (prev >= first)
+    gaps = np.zeros(n, dtype=np.int64)
+    gaps[order[known]] = fcnt[known] - fcnt[prev[known]] - 1
+    return gaps
+
+
+def score_columns(completeness, battery, rssi, snr, gap, adr, weights=WEIGHTS):
+    # confidence_score of each row, as enrich.score_events computes it;
+    # penalties are added in its order so the sums round the same way
+    w = weights
+    total = w["missing_measurements"] * (1.0 - completeness)
+    total = total + np.where(battery == 0, w["missing_battery"], 0.0)
+    total = total + np.where(
+        rssi < -115, w["very_weak_rssi"], np.where(rssi < -105, w["weak_rssi"], 0.0)
+    )
+    total = total + np.where(
+        snr < -7.5, w["very_low_snr"], np.where(snr < 0, w["low_snr"], 0.0)
+    )
+    total = total + np.where(
+        gap > 0,
+        np.minimum(w["frame_gap_max"], w["frame_gap"] * gap),
+        np.where(gap < 0, w["frame_reset"], 0.0),
+    )
+    total = total + np.where(adr == 0, w["adr_disabled"], 0.0)
+    return np.round(np.maximum(0.0, 100 - total), 2)
+
+
+class Rescorer:
+    def __init__(self, store, batch_size=BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        self.gaps = frame_gaps(store)
+
+    def __len__(self):
+        return len(self.gaps)
+
+    def score(self, weights=WEIGHTS):
+        # float64 confidence_score per store row
+        n = len(self)
+        out = np.empty(n, dtype=np.float64)
+        cols = [
+            self.store.column(name)[:n]
+            for name in ("completeness", "battery", "rssi", "snr")
+        ]
+        adr = self.store.column("adr")[:n]
+        for lo in range(0, n, self.batch_size):
+            hi = min(n, lo + self.batch_size)
+            out[lo:hi] = score_columns(
+                *(c[lo:hi] for c in cols), self.gaps[lo:hi], adr[lo:hi], weights
+            )
+        return out
+
+    def evaluate(self, weights=None, window=DEFAULT_WINDOW):
+        # (device metrics, rules.evaluate table) with the scores of weights,
+        # or the scores stored in the events for None
+        confidence = None if weights is None else self.score(weights)
+        dm = DeviceMetrics()
+        dm.update_store(self.store, confidence=confidence)
+        device_metrics = dm.snapshot(window)
+        return device_metrics, rules.evaluate(device_metrics)
+
+    def compare(self, weights, baseline=None, window=DEFAULT_WINDOW):
+        # Every device's SLA status, risk and average confidence under the
+        # baseline and under weights, side by side
+        _, before = self.evaluate(baseline, window)
+        _, after = self.evaluate(weights, window)
+        devices = before["devices"]
+        changed = np.flatnonzero(before["sla"] != after["sla"])
+        statuses = [status for status, _ in rules.SLA] + [rules.SLA_DEFAULT]
+        return {
+            "devices": devices,
+            "sla_before": before["sla"],
+            "sla_after": after["sla"],
+            "risk_before": before["risk"],
+            "risk_after": after["risk"],
+            "confidence_before": before["avg_confidence"],
+            "confidence_after": after["avg_confidence"],
+            "changed": [devices[i] for i in changed],
+            "counts": {
+                status: (
+                    int(np.count_nonzero(before["sla"] == status)),
+                    int(np.count_nonzero(after["sla"] == status)),
+                )
+                for status in statuses
+            },
+        }
+
+
+if __name__ == "__main__":
+    from snapshot import compile_snapshot, open_snapshot
+
+    parser = argparse.ArgumentParser(
+        description="Rescore every event under what-if confidence weights and compare fleet SLA"
+    )
+    parser.add_argument("path", nargs="?", default="enriched_events.jsonl")
+    parser.add_argument("--weights", default=None, metavar="JSON",
+                        help="file with the weights to change (see enrich.WEIGHTS)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="change one weight; may be repeated")
+    parser.add_argument("--baseline", default=None, metavar="JSON",
+                        help="compare against these weights instead of the scores in the events")
+    parser.add_argument("--window", choices=list(WINDOWS), default=DEFAULT_WINDOW)
+    parser.add_argument("--snapshot", default=None,
+                        help="load through this snapshot directory (see snapshot.py)")
+    parser.add_argument("--limit", type=int, default=20,
+                        help="changed devices to list")
+    args = parser.parse_args()
+
+    try:
+        weights = load_weights(args.weights, args.set)
+        baseline = load_weights(args.baseline) if args.baseline else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    t0 = time.perf_counter()
+    if args.snapshot:
+        compile_snapshot(args.path, args.snapshot)
+        store, _ = open_snapshot(args.snapshot)
+    else:
+        store = load_store(args.path)
+    t1 = time.perf_counter()
+    rescorer = Rescorer(store)
+    t2 = time.perf_counter()
+    scores = rescorer.score(weights)
+    t3 = time.perf_counter()
+    result = rescorer.compare(weights, baseline, args.window)
+    t4 = time.perf_counter()
+
+    print(f"{len(store)} events from {os.path.basename(args.path)} loaded in {t1 - t0:.2f}s")
+    print(f"frame counters {t2 - t1:.2f}s, rescoring {t3 - t2:.2f}s, "
+          f"metrics and rules {t4 - t3:.2f}s")
+    stored = store.column("confidence_score")
+    print(f"mean confidence {stored.mean():.2f} -> {scores.mean():.2f}"
+          f" ({np.count_nonzero(scores != stored)} events rescored differently)"
+          if len(store) else "no events")
+
+    before = "baseline" if baseline is not None else "stored"
+    print(f"\n=== SLA STATUS ({before} -> what-if) ===")
+    for status, (a, b) in result["counts"].items():
+        print(f"{status:<5} {a:>6} -> {b:<6}")
+
+    print(f"\n=== CHANGED DEVICES ({len(result['changed'])}) ===")
+    index = {dev: i for i, dev in enumerate(result["devices"])}
+    for dev in result["changed"][:args.limit]:
+        i = index[dev]
+        print(
+            dev,
+            f"{result['sla_before'][i]} -> {result['sla_after'][i]}",
+            f"confidence {result['confidence_before'][i]:.2f} -> {result['confidence_after'][i]:.2f}",
+            f"risk {result['risk_before'][i]} -> {result['risk_after'][i]}",
+        )
@@ -0,0 +1,232 @@
+import numpy as np
+
+from store import NAT, NO_CODE
+
+# Multi-resolution confidence / RSSI rollups for charts.
+#
+# Per resolution (1m / 1h / 1d) and entity kind (device / gateway), every
+# (entity, time bucket) pair is one row of a columnar table holding the
+# event count and the sum / min / max of confidence and RSSI. Folding in a
+# batch of events is one np.unique over the batch's (entity, bucket) keys,
+# one np.searchsorted against the table's keys and ufunc.at updates; only
+# new keys append rows.
+#
+# The table keeps its keys (entity << 32 | bucket) sorted with the row of
+# each, so one entity's buckets are a contiguous, time-ordered slice, and a
+# bucket range per appended batch, so a fleet query only touches the
+# batches overlapping the requested time range.
+
+NS = 10**9
+RESOLUTIONS = {
+    "1m": 60 * NS,
+    "1h": 3600 * NS,
+    "1d": 86_400 * NS,
+}
+MAX_POINTS = 1500
+SPAN = 1 << 32                  # buckets per entity in a table key
+
+KINDS = ("device", "gateway")
+
+_SUMS = ("count", "confidence_sum", "rssi_count", "rssi_sum")
+_MINS = ("confidence_min", "rssi_min")
+_MAXS = ("confidence_max", "rssi_max")
+
+
+def _key(entity, bucket):
+    return np.asarray(entity, dtype=np.int64) * SPAN + bucket
+
+
+class _Table:
+    def __init__(self):
+        self.n = 0
+        self.entity = np.empty(0, dtype=np.int32)
+        self.bucket = np.empty(0, dtype=np.int64)
+        self.cols = {name: np.empty(0) for name in _SUMS + _MINS + _MAXS}
+        self.keys = np.empty(0, dtype=np.int64)      # sorted entity << 32 | bucket
+        self.key_rows = np.empty(0, dtype=np.int64)  # row of each key
+        self.batches = []               # (first row, min bucket, max bucket)
+
+    def _reserve(self, n):
+        capacity = len(self.bucket)
+        if n <= capacity:
+            return
+        capacity = max(capacity * 2, n, 1024)
+
+        def grow(col, fill=0):
+            grown = np.full(capacity, fill, dtype=col.dtype)
+            grown[:self.n] = col[:self.n]
+            return grown
+
+        self.entity = grow(self.entity)
+        self.bucket = grow(self.bucket)
+        for name in _SUMS:
+            self.cols[name] = grow(self.cols[name])
+        for name in _MINS:
+            self.cols[name] = grow(self.cols[name], np.inf)
+        for name in _MAXS:
+            self.cols[name] = grow(self.cols[name], -np.inf)
+
+    def add(self, entity, bucket, confidence, rssi):
+        keys, first, inverse = np.unique(
+            _key(entity, bucket), return_index=True, return_inverse=True
+        )
+
+        pos = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.keys):
+            found = self.keys[np.minimum(pos, len(self.keys) - 1)] == keys
+        rows = np.empty(len(keys), dtype=np.int64)
+        rows[found] = self.key_rows[pos[found]]
+
+        new = np.flatnonzero(~found)
+        if len(new):
+            start = self.n
+            self._reserve(start + len(new))
+            self.n += len(new)
+            rows[new] = np.arange(start, self.n)
+            self.entity[start:self.n] = entity[first[new]]
+            self.bucket[start:self.n] = bucket[first[new]]
+            self.keys = np.insert(self.keys, pos[new], keys[new])
+            self.key_rows = np.insert(self.key_rows, pos[new], rows[new])
+            new_buckets = self.bucket[start:self.n]
+            self.batches.append((start, int(new_buckets.min()), int(new_buckets.max())))
+
+        target = rows[inverse]
+        has_rssi = ~np.isnan(rssi)
+        cols = self.cols
+        np.add.at(cols["count"], target, 1)
+        np.add.at(cols["confidence_sum"], target, confidence)
+        np.minimum.at(cols["confidence_min"], target, confidence)
+        np.maximum.at(cols["confidence_max"], target, confidence)
+        np.add.at(cols["rssi_count"], target, has_rssi)
+        np.add.at(cols["rssi_sum"], target, np.where(has_rssi, rssi, 0.0))
+        np.fmin.at(cols["rssi_min"], target, rssi)
+        np.fmax.at(cols["rssi_max"], target, rssi)
+
+    def _frame(self, rows, res):
+        cols = self.cols
+        count = cols["count"][rows]
+        rssi_count = cols["rssi_count"][rows]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rssi_mean = np.where(rssi_count > 0, cols["rssi_sum"][rows] / rssi_count, np.nan)
+        rssi_min = cols["rssi_min"][rows]
+        rssi_max = cols["rssi_max"][rows]
+        return {
+            "time": self.bucket[rows] * res,
+            "entity": self.entity[rows],
+            "count": count.astype(np.int64),
+            "confidence_mean": cols["confidence_sum"][rows] / count,
+            "confidence_min": cols["confidence_min"][rows],
+            "confidence_max": cols["confidence_max"][rows],
+            "rssi_mean": rssi_mean,
+            "rssi_min": np.where(np.isinf(rssi_min), np.nan, rssi_min),
+            "rssi_max": np.where(np.isinf(rssi_max), np.nan, rssi_max),
+        }
+
+
+class Rollups:
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = dict(resolutions)
+        self.tables = {
+            (res, kind): _Table()
+            for res in self.resolutions
+            for kind in KINDS
+        }
+        self.names = {kind: None for kind in KINDS}
+
+    def update_store(self, store, start=0):
+        # Fold rows [start:] of an EventStore
+        self.names = {"device": store.devices, "gateway": store.gateways}
+
+        ts = store.column("timestamp")[start:]
+        keep = ts != NAT
+        if not keep.any():
+            return
+        ts = ts[keep]
+        confidence = store.column("confidence_score")[start:][keep]
+        rssi = store.column("rssi")[start:][keep]
+        entities = {
+            "device": store.column("device")[start:][keep],
+            "gateway": store.column("gateway")[start:][keep],
+        }
+
+        for res, width in self.resolutions.items():
+            bucket = ts // width
+            for kind, codes in entities.items():
+                sel = codes != NO_CODE
+                if not sel.all():
+                    self.tables[res, kind].add(codes[sel], bucket[sel], confidence[sel], rssi[sel])
+                else:
+                    self.tables[res, kind].add(codes, bucket, confidence, rssi)
+
+    @property
+    def nbytes(self):
+        total = 0
+        for table in self.tables.values():
+            total += table.entity.nbytes + table.bucket.nbytes
+            total += sum(col.nbytes for col in table.cols.values())
+            total += table.keys.nbytes + table.key_rows.nbytes
+        return total
+
+    def resolution_for(self, start, end, max_points=MAX_POINTS):
+        # finest resolution showing [start, end] in at most max_points buckets
+        for res, width in sorted(self.resolutions.items(), key=lambda r: r[1]):
+            if (end - start) // width <= max_points:
+                return res
+        return max(self.resolutions, key=self.resolutions.get)
+
+    def _pick(self, start, end, resolution):
+        if resolution is None:
+            if start is None or end is None:
+                resolution = max(self.resolutions, key=self.resolutions.get)
+            else:
+                resolution = self.resolution_for(start, end)
+        return resolution, self.resolutions[resolution]
+
+    def _in_range(self, table, rows, width, start, end):
+        buckets = table.bucket[rows]
+        keep = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            keep &= buckets >= start // width
+        if end is not None:
+            keep &= buckets <= end // width
+        rows = rows[keep]
+        return rows[np.argsort(table.bucket[rows], kind="stable")]
+
+    def series(self, kind, entity, start=None, end=None, resolution=None):
+        # Buckets of one device / gateway (by id) overlapping [start, end],
+        # in time order. Returns (resolution, columns) with "time" the
+        # bucket start in ns since epoch.
+        resolution, width = self._pick(start, end, resolution)
+        table = self.tables[resolution, kind]
+        names = self.names[kind]
+        code = names.code_of(entity) if names is not None else NO_CODE
+        if code == NO_CODE:
+            rows = np.empty(0, dtype=np.int64)
+        else:
+            lo = _key(code, 0 if start is None else min(max(start // width, 0), SPAN))
+            hi = _key(code, SPAN if end is None else min(max(end // width + 1, 0), SPAN))
+            rows = table.key_rows[np.searchsorted(table.keys, lo):np.searchsorted(table.keys, hi)]
+        frame = table._frame(rows, width)
+        del frame["entity"]
+        return resolution, frame
+
+    def fleet(self, kind, start=None, end=None, resolution=None):
+        # Buckets of every device / gateway overlapping [start, end];
+        # columns as in series() plus "entity" (the id)
+        resolution, width = self._pick(start, end, resolution)
+        table = self.tables[resolution, kind]
+        lo = None if start is None else start // width
+        hi = None if end is None else end // width
+
+        bounds = [b[0] for b in table.batches] + [table.n]
+        parts = [
+            np.arange(bounds[i], bounds[i + 1])
+            for i, (_, b_lo, b_hi) in enumerate(table.batches)
+            if (hi is None or b_lo <= hi) and (lo is None or b_hi >= lo)
+        ]
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        frame = table._frame(self._in_range(table, rows, width, start, end), width)
+        names = self.names[kind]
+        frame["entity"] = [names[c] for c in frame["entity"]] if names is not None else []
+        return resolution, frame
@@ -0,0 +1,200 @@
+import operator
+
+import numpy as np
+
+import instrument
+
+# Declarative device rules.
+#
+# Every threshold used to judge a device lives in CONDITIONS. SLA status,
+# maintenance risk, insights, explanations and the named device queries are
+# built from those conditions, either for one metrics dict (holds, sla_of,
+# risk_of, ...) or for the whole fleet at once (evaluate), where each
+# condition is one vectorized comparison over a column of the metrics table.
+
+OPS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+}
+
+# name -> (metric, op, value); op "contains" tests membership in a list
+CONDITIONS = {
+    "no_data": ("confidence_trend", "==", "no_data"),
+    "low_confidence": ("avg_confidence", "<", 70),
+    "below_target_confidence": ("avg_confidence", "<", 80),
+    "incomplete_data": ("data_completeness", "<", 0.8),
+    "very_incomplete_data": ("data_completeness", "<", 0.75),
+    "battery_missing": ("battery_reporting_quality", "<", 0.5),
+    "battery_poor": ("battery_reporting_quality", "<", 0.7),
+    "degrading": ("confidence_trend", "==", "degrading"),
+    "rf_unstable": ("rssi_std", ">", 10),
+    "unreliable_despite_good_rssi": ("flags", "contains", "unreliable_despite_good_rssi"),
+}
+
+# first matching status wins, PASS otherwise
+SLA = [
+    ("NO_DATA", "no_data"),
+    ("FAIL", "low_confidence"),
+    ("WARN", "incomplete_data"),
+]
+SLA_DEFAULT = "PASS"
+
+RISK = [
+    ("battery_missing", 30),
+    ("degrading", 25),
+    ("rf_unstable", 20),
+    ("very_incomplete_data", 15),
+]
+HIGH_RISK = 60
+
+INSIGHTS = [
+    ("unreliable_despite_good_rssi", "Device {dev} is unreliable despite stable RF conditions."),
+    ("battery_poor", "Device {dev} has poor battery telemetry quality."),
+    ("degrading", "Device {dev} shows degrading confidence over time."),
+    ("very_incomplete_data", "Device {dev} frequently reports incomplete telemetry."),
+]
+
+EXPLANATIONS = [
+    ("battery_missing", "Battery telemetry missing"),
+    ("degrading", "Confidence decreasing over time"),
+    ("rf_unstable", "Unstable RF conditions"),
+]
+
+# named device selections: any of the listed conditions
+QUERIES = {
+    "faulty": ["low_confidence"],
+    "low_confidence": ["below_target_confidence"],
+    "needs_maintenance": ["battery_missing", "degrading"],
+    "incomplete_data": ["incomplete_data"],
+}
+
+# gateways
+UNSTABLE_GATEWAY_RSSI_STD = 12
+UNSTABLE_GATEWAY_MIN_CONFIDENCE = 70
+
+
+# -------------------------
+# ONE DEVICE
+# -------------------------
+
+def threshold(name):
+    return CONDITIONS[name][2]
+
+
+def holds(m, name):
+    field, op, value = CONDITIONS[name]
+    if op == "contains":
+        return value in m[field]
+    return OPS[op](m[field], value)
+
+
+def sla_of(m):
+    for status, name in SLA:
+        if holds(m, name):
+            return status
+    return SLA_DEFAULT
+
+
+def risk_of(m):
+    return sum(points for name, points in RISK if holds(m, name))
+
+
+def insights_of(dev, m):
+    return [text.format(dev=dev) for name, text in INSIGHTS if holds(m, name)]
+
+
+def explain(m):
+    return [text for name, text in EXPLANATIONS if holds(m, name)]
+
+
+def matches(m, query):
+    return any(holds(m, name) for name in QUERIES[query])
+
+
+# -------------------------
+# WHOLE FLEET
+# -------------------------
+
+def metrics_table(device_metrics):
+    # {"devices": [...], metric: column} for the metrics the rules read
+    table = {"devices": list(device_metrics)}
+    values = list(device_metrics.values())
+    for field, op, _ in CONDITIONS.values():
+        if field in table:
+            continue
+        column = [m[field] for m in values]
+        if op in ("==", "contains"):
+            table[field] = np.array(column + [None], dtype=object)[:-1]
+        else:
+            table[field] = np.array(column, dtype=np.float64)
+    return table
+
+
+def _condition(table, name):
+    field, op, value = CONDITIONS[name]
+    column = table[field]
+    if op == "contains":
+        return np.fromiter((value in v for v in column), dtype=bool, count=len(column))
+    return np.asarray(OPS[op](column, value), dtype=bool)
+
+
+def _hits(table, pairs):
+    # (device index, rule index) of every hit, device-major in rule order
+    n = len(table["devices"])
+    if not pairs or n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    hits = np.column_stack([table["conditions"][name] for name, _ in pairs])
+    return np.nonzero(hits)
+
+
+@instrument.timed("rules.evaluate")
+def evaluate(device_metrics):
+    # Rules over every device in one pass. Returns the metrics table with
+    # "conditions" (name -> bool column), "sla" and "risk" aligned with
+    # "devices"; insights / explanations are rendered from it on demand.
+    table = metrics_table(device_metrics)
+    n = len(table["devices"])
+    table["conditions"] = conditions = {
+        name: _condition(table, name) for name in CONDITIONS
+    }
+
+    sla = np.full(n, SLA_DEFAULT, dtype=object)
+    for status, name in reversed(SLA):
+        sla[conditions[name]] = status
+    table["sla"] = sla
+
+    risk = np.zeros(n, dtype=np.int64)
+    for name, points in RISK:
+        risk += np.where(conditions[name], points, 0)
+    table["risk"] = risk
+    return table
+
+
+def fleet_insights(table, label=str):
+    # insight strings of every device, device by device in rule order;
+    # label(devEui) is what the text calls the device
+    rows, cols = _hits(table, INSIGHTS)
+    parts = [text.split("{dev}", 1) for _, text in INSIGHTS]
+    prefix = np.array([p[0] for p in parts], dtype=object)
+    suffix = np.array([p[1] for p in parts], dtype=object)
+    devices = np.array([label(d) for d in table["devices"]], dtype=object)
+    return list(prefix[cols] + devices[rows] + suffix[cols])
+
+
+def explanations(table):
+    # {device: [reason, ...]} for the devices with at least one reason
+    rows, cols = _hits(table, EXPLANATIONS)
+    out = {}
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        out.setdefault(table["devices"][i], []).append(EXPLANATIONS[j][1])
+    return out
+
+
+def select(table, query):
+    mask = np.zeros(len(table["devices"]), dtype=bool)
+    for name in QUERIES[query]:
+        mask |= table["conditions"][name]
+    return [table["devices"][i] for i in np.flatnonzero(mask)]
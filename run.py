@@ -1,39 +1,125 @@
+import argparse
+import time
+
+import numpy as np
+
+import instrument
+import outofcore
+import registry
+import rules
 from engine import *
+from follow import LiveDataset
+from metrics import DEFAULT_WINDOW, WINDOWS
+from outofcore import OutOfCoreDataset
+
+
+def report(device_metrics, gw_stats):
+    table = rules.evaluate(device_metrics)
+
+    print("\n=== AUTOMATED INSIGHTS ===")
+    for i in generate_insights(device_metrics, table):
+        print("-", i)
+
+    print("\n=== SLA STATUS ===")
+    for dev, status in zip(table["devices"], table["sla"]):
+        print(dev, status)
+
+    print("\n=== MAINTENANCE PRIORITY ===")
+    ranked = np.argsort(-table["risk"], kind="stable")
+    for i in ranked[:5]:
+        print(table["devices"][i], "risk =", table["risk"][i])
+
+    print("\n=== GATEWAY HEALTH ===")
+    for gw, s in gw_stats.items():
+        print(gw, s)
+
+    print("\n=== SYSTEM SUMMARY ===")
+    print(system_summary(device_metrics, gw_stats, table))
+
+    print("\n=== QUERY: NEEDS MAINTENANCE ===")
+    for dev in query_devices(device_metrics, "needs_maintenance", table):
+        print(dev)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("path", nargs="?", default="enriched_events.jsonl")
+parser.add_argument("--follow", action="store_true",
+                    help="keep running and report again whenever new events are appended")
+parser.add_argument("--interval", type=float, default=5.0,
+                    help="seconds between polls in --follow mode")
+parser.add_argument("--snapshot", default="enriched_events.snapshot",
+                    help="binary snapshot to start from, if present (see snapshot.py)")
+parser.add_argument("--cache", default="enriched_events.warm",
+                    help="warm-start cache directory (see warmstart.py)")
+parser.add_argument("--no-cache", action="store_true",
+                    help="neither read nor write the warm-start cache")
+parser.add_argument("--window", choices=list(WINDOWS), default=DEFAULT_WINDOW,
+                    help="trailing window the device metrics are computed over")
+parser.add_argument("--max-memory", default=outofcore.configured_budget(), type=outofcore.parse_size,
+                    metavar="SIZE",
+                    help="out-of-core mode within this memory budget, e.g. 512M (see outofcore.py)")
+parser.add_argument("--spill-dir", default=None,
+                    help="where --max-memory spills sorted runs (default: the temp directory)")
+parser.add_argument("--site", default=None,
+                    help="report on this site of the registry instead of path (see registry.py)")
+parser.add_argument("--sites", default=None, metavar="SPEC",
+                    help="sites.json or a directory of sites (default: $SENTINELMESH_SITES, sites.json)")
+parser.add_argument("--profile", action="store_true",
+                    help="print stage timings, counters and memory after each report")
+parser.add_argument("--profile-dump", default=None, metavar="PATH",
+                    help="also write them to PATH (Prometheus text for .prom/.txt, else JSON)")
+args = parser.parse_args()
+
+if args.site:
+    sites = registry.load_sites(args.sites)
+    if args.site not in sites:
+        parser.error(f"unknown site {args.site!r} (sites: {', '.join(sites) or 'none'})")
+    site = sites[args.site]
+    args.path, args.snapshot, args.cache = site["path"], site["snapshot"], site["cache"]
+    if site.get("max_memory"):
+        args.max_memory = outofcore.parse_size(site["max_memory"])
+    args.spill_dir = site.get("spill_dir", args.spill_dir)
+
+profiling = args.profile or args.profile_dump is not None
+instrument.enable(profiling)
+
+
+def profile():
+    if not profiling:
+        return
+    r = instrument.report()
+    if args.profile:
+        print("\n=== PROFILE ===")
+        print(instrument.format_table(r))
+    if args.profile_dump:
+        instrument.dump(args.profile_dump, r)
+
+
+if args.max_memory:
+    data = OutOfCoreDataset(
+        args.path,
+        budget=args.max_memory,
+        metrics_window=args.window,
+        spill_dir=args.spill_dir,
+    )
+else:
+    data = LiveDataset(
+        args.path,
+        snapshot=args.snapshot,
+        metrics_window=args.window,
+        cache=None if args.no_cache else args.cache,
+    )
+data.refresh()
+with instrument.span("run.report"):
+    report(data.device_metrics, data.gateway_stats)
+profile()
 
-events = load_events()
-devices = build_device_index(events)
-gateways = build_gateway_index(events)
-
-device_metrics = {
-    dev: evts[0]["device_metrics"]
-    for dev, evts in devices.items()
-}
-
-print("\n=== AUTOMATED INSIGHTS ===")
-for i in generate_insights(device_metrics):
-    print("-", i)
-
-print("\n=== SLA STATUS ===")
-for dev, m in device_metrics.items():
-    print(dev, sla_status(m))
-
-print("\n=== MAINTENANCE PRIORITY ===")
-ranked = sorted(
-    device_metrics.items(),
-    key=lambda x: maintenance_risk(x[1]),
-    reverse=True
-)
-for dev, m in ranked[:5]:
-    print(dev, "risk =", maintenance_risk(m))
-
-print("\n=== GATEWAY HEALTH ===")
-gw_stats = analyze_gateways(gateways)
-for gw, s in gw_stats.items():
-    print(gw, s)
-
-print("\n=== SYSTEM SUMMARY ===")
-print(system_summary(device_metrics, gw_stats))
-
-print("\n=== QUERY: NEEDS MAINTENANCE ===")
-for dev in query_devices(device_metrics, "needs_maintenance"):
-    print(dev)
+try:
+    while args.follow:
+        time.sleep(args.interval)
+        if data.refresh():
+            with instrument.span("run.report"):
+                report(data.device_metrics, data.gateway_stats)
+            profile()
+finally:
+    data.save_cache()
@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+from cache import LRUCache
+from decode import Projection
+from store import NAT, STORE_FIELDS, EventStore, parse_timestamp
+from tail import TailReader
+
+# Time-partitioned event segments.
+#
+#   <dir>/catalog.json     bucket width, source checkpoint and one footer per
+#                          segment: min/max timestamp, row and byte counts,
+#                          per-device row count and timestamp range, gateways
+#   <dir>/<bucket>.jsonl   the enriched events of one time bucket, verbatim
+#
+# Only the newest (active) segment is appended to. An event for a bucket
+# older than the active one (a late arrival) goes to the active segment; its
+# footer still covers the real min/max, so pruning stays exact. Sealed
+# segments never change, so their decoded rows are cached.
+#
+# Readers consult the footers first and only open the segments that can
+# contain matching rows.
+
+SCHEMA_VERSION = 1
+CATALOG = "catalog.json"
+DAY_NS = 86_400 * 10**9
+
+ROUTING_FIELDS = ["timestamp", "devEui", "gatewayId"]
+
+
+def _segment_name(bucket, bucket_ns):
+    start = np.datetime64(bucket * bucket_ns, "ns")
+    if bucket_ns % DAY_NS == 0:
+        return str(start.astype("datetime64[D]"))
+    return str(start.astype("datetime64[s]")).replace(":", "")
+
+
+def _footer(name, bucket):
+    return {
+        "name": name,
+        "file": f"{name}.jsonl",
+        "bucket": bucket,
+        "sealed": False,
+        "rows": 0,
+        "bytes": 0,
+        "min_ts": None,
+        "max_ts": None,
+        "devices": {},     # devEui -> [rows, min_ts, max_ts]
+        "gateways": [],
+    }
+
+
+def _overlaps(footer, start, end):
+    if start is None and end is None:
+        return True
+    if footer["min_ts"] is None:
+        return False
+    if start is not None and footer["max_ts"] < start:
+        return False
+    if end is not None and footer["min_ts"] > end:
+        return False
+    return True
+
+
+def _covers(footer, start, end):
+    # every row of the segment lies in [start, end]
+    if start is None and end is None:
+        return True
+    if footer["min_ts"] is None:
+        return False
+    return (
+        (start is None or footer["min_ts"] >= start)
+        and (end is None or footer["max_ts"] <= end)
+    )
+
+
+class SegmentLog:
+    def __init__(self, path="enriched_events.segments", bucket_ns=DAY_NS, cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.bucket_ns = bucket_ns
+        self.source = None
+        self.segments = {}       # name -> footer, in bucket order
+        self.active = None
+        self.generation = 0
+        self._route = Projection(ROUTING_FIELDS)
+        self._decode = Projection(STORE_FIELDS)
+        self._rows = LRUCache(maxsize=64, maxbytes=cache_bytes)
+        self._lock = threading.RLock()
+        self._recovered = False
+        self._load()
+
+    @property
+    def version(self):
+        return (self.generation, sum(f["rows"] for f in self.segments.values()))
+
+    def __len__(self):
+        return sum(f["rows"] for f in self.segments.values())
+
+    # -------------------------
+    # CATALOG
+    # -------------------------
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, CATALOG)) as f:
+                catalog = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if catalog.get("schema_version") != SCHEMA_VERSION:
+            return
+
+        self.bucket_ns = catalog["bucket_ns"]
+        self.source = catalog["source"]
+        self.generation = catalog["generation"]
+        self.segments = {f["name"]: f for f in catalog["segments"]}
+        self.active = catalog["active"]
+
+    def _recover(self):
+        # Before this process first writes: drop a tail written after the
+        # last catalog update (crash). Readers never truncate, since the
+        # tail may be a concurrent writer's rows not yet in the catalog;
+        # they only read up to each footer's byte count.
+        if self._recovered:
+            return
+        self._recovered = True
+        footer = self.segments.get(self.active)
+        if footer is not None and os.path.exists(self._file(footer)):
+            with open(self._file(footer), "ab") as f:
+                f.truncate(footer["bytes"])
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+        catalog = {
+            "schema_version": SCHEMA_VERSION,
+            "bucket_ns": self.bucket_ns,
+            "generation": self.generation,
+            "source": self.source,
+            "active": self.active,
+            "segments": list(self.segments.values()),
+        }
+        tmp = os.path.join(self.path, CATALOG + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(catalog, f)
+        os.replace(tmp, os.path.join(self.path, CATALOG))
+
+    def _file(self, footer):
+        return os.path.join(self.path, footer["file"])
+
+    def clear(self):
+        with self._lock:
+            for footer in self.segments.values():
+                try:
+                    os.remove(self._file(footer))
+                except FileNotFoundError:
+                    pass
+            self.segments = {}
+            self.active = None
+            self.source = None
+            self.generation += 1
+            self._rows.clear()
+            self._save()
+
+    # -------------------------
+    # APPEND
+    # -------------------------
+
+    def _target(self, ts):
+        # name of the segment an event with timestamp ts is written to
+        if ts != NAT:
+            bucket = ts // self.bucket_ns
+            active = self.segments.get(self.active)
+            if active is None or bucket > active["bucket"]:
+                if active is not None:
+                    active["sealed"] = True
+                name = _segment_name(bucket, self.bucket_ns)
+                self.segments[name] = _footer(name, bucket)
+                self.active = name
+        elif self.active is None:
+            # undated events before anything else: open bucket 0
+            self.active = _segment_name(0, self.bucket_ns)
+            self.segments[self.active] = _footer(self.active, 0)
+        return self.active
+
+    def append_lines(self, lines):
+        # lines: raw JSONL lines (bytes, without the newline)
+        if not lines:
+            return 0
+
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            self._recover()
+            pending = {}
+            for line in lines:
+                r = self._route(line)
+                ts = parse_timestamp(r.timestamp)
+                name = self._target(ts)
+                pending.setdefault(name, []).append((line, r, ts))
+
+            for name, batch in pending.items():
+                footer = self.segments[name]
+                data = b"".join(line + b"\n" for line, _, _ in batch)
+                with open(self._file(footer), "ab") as f:
+                    f.write(data)
+                footer["bytes"] += len(data)
+                footer["rows"] += len(batch)
+
+                gateways = set(footer["gateways"])
+                for _, r, ts in batch:
+                    if r.gatewayId:
+                        gateways.add(r.gatewayId)
+                    d = footer["devices"].setdefault(r.devEui, [0, None, None])
+                    d[0] += 1
+                    if ts == NAT:
+                        continue
+                    d[1] = ts if d[1] is None else min(d[1], ts)
+                    d[2] = ts if d[2] is None else max(d[2], ts)
+                    footer["min_ts"] = ts if footer["min_ts"] is None else min(footer["min_ts"], ts)
+                    footer["max_ts"] = ts if footer["max_ts"] is None else max(footer["max_ts"], ts)
+                footer["gateways"] = sorted(gateways)
+
+            self._save()
+        return len(lines)
+
+    def sync(self, source="enriched_events.jsonl"):
+        # Append the lines added to source since the last sync. A truncated
+        # or replaced source rebuilds the log. Returns the number of rows.
+        with self._lock:
+            reader = TailReader(source, self.source, decode=lambda line: line)
+            lines, reset = reader.poll()
+            reader.close()
+            if reset:
+                self.clear()
+            if not lines:
+                return 0
+            # saved with the rows, by append_lines
+            self.source = reader.checkpoint()
+            return self.append_lines(lines)
+
+    # -------------------------
+    # READ
+    # -------------------------
+
+    def select(self, start=None, end=None, devices=None, gateways=None):
+        # Footers of the segments that can hold rows in [start, end] (ns,
+        # inclusive) for any of devices / gateways
+        selected = []
+        for footer in self.segments.values():
+            if not footer["rows"] or not _overlaps(footer, start, end):
+                continue
+            if devices is not None and not any(d in footer["devices"] for d in devices):
+                continue
+            if gateways is not None and not set(gateways) & set(footer["gateways"]):
+                continue
+            selected.append(footer)
+        return selected
+
+    def _lines(self, footer):
+        with open(self._file(footer), "rb") as f:
+            data = f.read(footer["bytes"])
+        return [line for line in data.splitlines() if line.strip()]
+
+    def records(self, footer):
+        # STORE_FIELDS records of one segment; sealed segments are cached
+        if not footer["sealed"]:
+            return [self._decode(line) for line in self._lines(footer)]
+        key = (self.generation, footer["name"])
+        return self._rows.get(
+            key, lambda: [self._decode(line) for line in self._lines(footer)]
+        )
+
+    def read(self, start=None, end=None, devices=None, gateways=None, decode=None):
+        # Rows with start <= timestamp <= end, restricted to devices /
+        # gateways when given; whole segments are pruned by their footer.
+        # Yields STORE_FIELDS records, or decode(line) for each matching line.
+        if devices is not None:
+            devices = set(devices)
+        if gateways is not None:
+            gateways = set(gateways)
+
+        for footer in self.select(start, end, devices, gateways):
+            check_time = not _covers(footer, start, end)
+            if decode is None:
+                rows = ((r, r) for r in self.records(footer))
+            else:
+                rows = ((self._route(line), line) for line in self._lines(footer))
+
+            for r, row in rows:
+                if devices is not None and r.devEui not in devices:
+                    continue
+                if gateways is not None and r.gatewayId not in gateways:
+                    continue
+                if check_time:
+                    ts = parse_timestamp(r.timestamp)
+                    if ts == NAT or (start is not None and ts < start) or (end is not None and ts > end):
+                        continue
+                yield row if decode is None else decode(row)
+
+    def _lookback(self, start, devices=None):
+        # each device's last record before start, reading segments newest
+        # first and stopping once no older segment can hold a newer row
+        found = {}
+        found_ts = {}
+        candidates = [
+            f for f in self.segments.values()
+            if f["min_ts"] is not None and f["min_ts"] < start
+        ]
+        candidates.sort(key=lambda f: f["max_ts"], reverse=True)
+
+        for footer in candidates:
+            wanted = [
+                d for d, (_, lo, _) in footer["devices"].items()
+                if lo is not None and lo < start
+                and (devices is None or d in devices)
+                and found_ts.get(d, NAT) < min(footer["max_ts"], start)
+            ]
+            if not wanted:
+                continue
+            wanted = set(wanted)
+            for r in self.records(footer):
+                if r.devEui not in wanted:
+                    continue
+                ts = parse_timestamp(r.timestamp)
+                if ts != NAT and ts < start and ts > found_ts.get(r.devEui, NAT):
+                    found[r.devEui] = r
+                    found_ts[r.devEui] = ts
+        return list(found.values())
+
+    def store(self, start=None, end=None, devices=None, gateways=None, lookback=False):
+        # EventStore of the matching rows. lookback also adds each device's
+        # last row before start, so as-of state at start is complete.
+        store = EventStore()
+        if lookback and start is not None and gateways is None:
+            for r in self._lookback(start, set(devices) if devices is not None else None):
+                store.append_record(r)
+        for r in self.read(start, end, devices, gateways):
+            store.append_record(r)
+        return store
+
+    # -------------------------
+    # FOOTER-ONLY ANSWERS
+    # -------------------------
+
+    def device_rows(self, dev):
+        return sum(f["devices"][dev][0] for f in self.segments.values() if dev in f["devices"])
+
+    def device_max_ts(self, dev):
+        ts = [
+            f["devices"][dev][2] for f in self.segments.values()
+            if dev in f["devices"] and f["devices"][dev][2] is not None
+        ]
+        return max(ts) if ts else NAT
+
+    def time_range(self):
+        lo = [f["min_ts"] for f in self.segments.values() if f["min_ts"] is not None]
+        hi = [f["max_ts"] for f in self.segments.values() if f["max_ts"] is not None]
+        return (min(lo), max(hi)) if lo else (NAT, NAT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Partition enriched_events.jsonl into time-bucketed segments"
+    )
+    parser.add_argument("source", nargs="?", default="enriched_events.jsonl")
+    parser.add_argument("-o", "--out", default="enriched_events.segments")
+    parser.add_argument("--bucket-hours", type=int, default=24)
+    args = parser.parse_args()
+
+    log = SegmentLog(args.out, bucket_ns=args.bucket_hours * 3600 * 10**9)
+    n = log.sync(args.source)
+    sealed = sum(f["sealed"] for f in log.segments.values())
+    print(f"{args.out}: +{n} rows, {len(log)} total in {len(log.segments)} segments ({sealed} sealed)")
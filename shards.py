@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from accumulators import FleetStats
+from decode import Projection
+from metrics import DeviceMetrics
+from store import NAT, NO_CODE, STORE_FIELDS, EventStore
+
+# Sharded fleet analytics.
+#
+# Two passes over a process pool. First every event file is cut into
+# newline-aligned byte ranges, and each worker decodes only its range,
+# routing every line by a hash of its devEui into one EventStore per shard,
+# which it pickles to a scratch directory; only the file names and the
+# range's newest timestamp go back to the parent. Then each shard's stores
+# are loaded and joined in file order, giving the shard exactly the events
+# the serial path sees for its devices, and folded into partial
+# aggregates: per-device stats and metrics are complete within a shard,
+# per-gateway stats are partial (a gateway hears devices of every shard).
+# The parent merges the partials: device results are disjoint unions,
+# gateway stats merge with RunningStats.merge (Chan et al.), so the result
+# matches the serial path. Metric windows end at the newest event
+# fleet-wide, not per shard.
+
+DEV_KEY = b'"devEui"'
+RANGE_BYTES = 64 << 20     # at most this much of a file per first-pass task
+
+
+def shard_of(dev_eui, shards):
+    return zlib.crc32(dev_eui.encode()) % shards
+
+
+def _line_device(line, decode):
+    # devEui of an event line without decoding the whole event
+    i = line.find(DEV_KEY)
+    if i >= 0:
+        start = line.find(b'"', i + len(DEV_KEY) + 1)
+        end = line.find(b'"', start + 1)
+        # only a string value; null or a number is left to the decoder
+        value = line[i + len(DEV_KEY):start].strip()
+        if value == b":" and end >= 0 and b"\\" not in line[start:end]:
+            return line[start + 1:end].decode()
+    dev = decode(line).devEui
+    return dev if isinstance(dev, str) else None
+
+
+def _ranges(path, pieces):
+    # [(start, end)] byte ranges of path, each starting at a line start
+    size = os.path.getsize(path)
+    pieces = max(pieces, -(-size // RANGE_BYTES), 1)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, pieces):
+            at = size * i // pieces
+            if at <= bounds[-1]:
+                continue
+            f.seek(at - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+
+def _route(task):
+    # Pickle one EventStore per shard with the events of a byte range to
+    # directory; returns the file per shard (None when empty) and the
+    # newest timestamp in the range
+    path, start, end, shards, directory = task
+    decode = Projection(STORE_FIELDS)
+    probe = Projection(["devEui"])
+    stores = [EventStore() for _ in range(shards)]
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            dev = _line_device(line, probe)
+            if dev is not None:
+                stores[shard_of(dev, shards)].append_record(decode(line))
+
+    files = []
+    newest = NAT
+    for shard, store in enumerate(stores):
+        if not len(store):
+            files.append(None)
+            continue
+        newest = max(newest, int(store.column("timestamp").max()))
+        fd, name = tempfile.mkstemp(suffix=f".shard{shard}.pkl", dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+        files.append(name)
+    return files, newest
+
+
+def _map(pool, fn, tasks):
+    if pool is None:
+        return [fn(task) for task in tasks]
+    return list(pool.map(fn, tasks))
+
+
+def _partial(task):
+    files, now, window = task
+    store = EventStore()
+    for name in files:
+        with open(name, "rb") as f:
+            store.extend_store(pickle.load(f))
+
+    fleet = FleetStats()
+    fleet.update_store(store)
+    metrics = DeviceMetrics()
+    metrics.now = now
+    metrics.update_store(store)
+
+    # distinct (device, gateway) pairs
+    dev = store.column("device").astype(np.int64)
+    gw = store.column("gateway").astype(np.int64)
+    has_gw = gw != NO_CODE
+    pairs = np.unique(dev[has_gw] << 32 | gw[has_gw])
+    pair_dev, pair_gw = (pairs >> 32).tolist(), (pairs & 0xFFFFFFFF).tolist()
+
+    counts = np.bincount(dev, minlength=len(store.devices))
+    devices = {
+        d: {"events": int(counts[code]), "gateways": []}
+        for code, d in enumerate(store.devices)
+    }
+    gateway_devices = {g: [] for g in store.gateways}
+    for d, g in zip(pair_dev, pair_gw):
+        devices[store.devices[d]]["gateways"].append(store.gateways[g])
+        gateway_devices[store.gateways[g]].append(store.devices[d])
+    for d in devices.values():
+        d["gateways"].sort()
+    return {
+        "events": len(store),
+        "fleet": fleet,
+        "device_metrics": metrics.snapshot(window),
+        "devices": devices,
+        "gateway_devices": gateway_devices,
+    }
+
+
+def fleet_analytics(paths, workers=None, shards=None, window="all"):
+    # paths: one or more enriched event files. Returns
+    #   gateway_stats   same as analyze_gateways(build_gateway_index(...))
+    #   device_stats    the same summary per device
+    #   device_metrics  metrics.DeviceMetrics over window, per device
+    #   devices         {devEui: {"events", "gateways"}}
+    #   gateways        {gatewayId: {"events", "devices"}}
+    if isinstance(paths, str):
+        paths = [paths]
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers
+    directory = tempfile.mkdtemp(prefix="sentinelmesh-shards-")
+    ranges = [
+        (path, start, end, shards, directory)
+        for path in paths
+        for start, end in _ranges(path, workers)
+    ]
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        routed = _map(pool, _route, ranges)
+        now = max((newest for _, newest in routed), default=NAT)
+        tasks = [
+            ([files[shard] for files, _ in routed if files[shard] is not None], now, window)
+            for shard in range(shards)
+        ]
+        partials = _map(pool, _partial, tasks)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    fleet = FleetStats()
+    device_metrics = {}
+    devices = {}
+    gateway_devices = {}
+    for p in partials:
+        fleet.merge(p["fleet"])
+        device_metrics.update(p["device_metrics"])
+        devices.update(p["devices"])
+        for gw, devs in p["gateway_devices"].items():
+            gateway_devices.setdefault(gw, set()).update(devs)
+
+    gateway_stats = {gw: s.summary() for gw, s in sorted(fleet.gateways.items())}
+    return {
+        "events": sum(p["events"] for p in partials),
+        "gateway_stats": gateway_stats,
+        "device_stats": {dev: s.summary() for dev, s in sorted(fleet.devices.items())},
+        "device_metrics": dict(sorted(device_metrics.items())),
+        "devices": dict(sorted(devices.items())),
+        "gateways": {
+            gw: {"events": gateway_stats[gw]["event_count"], "devices": sorted(devs)}
+            for gw, devs in sorted(gateway_devices.items())
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fleet report computed in parallel over devEui shards"
+    )
+    parser.add_argument("paths", nargs="*", default=["enriched_events.jsonl"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shards", type=int, default=None)
+    parser.add_argument("--window", default="all")
+    parser.add_argument("-o", "--out", default=None, help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = fleet_analytics(args.paths, args.workers, args.shards, args.window)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f)
+    print(f"{report['events']} events, {len(report['devices'])} devices, "
+          f"{len(report['gateways'])} gateways")
+    for gw, s in report["gateway_stats"].items():
+        print(gw, s)
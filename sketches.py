@@ -0,0 +1,215 @@
+import hashlib
+import math
+
+import numpy as np
+
+# Fixed-size, mergeable summaries of value distributions and distinct
+# counts.
+#
+# QuantileSketch is a DDSketch (Masson et al.): values are counted in
+# logarithmic buckets, key ceil(log_gamma |x|), one dense array of counts
+# for positive and one for negative values, so any quantile comes back
+# within a relative error of ALPHA. Two sketches merge exactly by adding
+# counts: per-batch or per-shard sketches combine into the sketch of the
+# whole stream. Each array is capped at MAX_BINS buckets by folding the
+# smallest magnitudes together, which keeps a sketch under a few KB no
+# matter how many values it has seen.
+#
+# HyperLogLog counts distinct items (devEuis) in 2**HLL_P one-byte
+# registers, with a standard error of about 1.04 / sqrt(2**HLL_P) (3% for
+# the default 1 KB); merging is a register-wise max.
+
+ALPHA = 0.01
+MAX_BINS = 512
+MIN_VALUE = 1e-9           # |x| below this counts as zero
+HLL_P = 10
+
+_GAMMA = (1 + ALPHA) / (1 - ALPHA)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+def _keys(magnitudes):
+    return np.ceil(np.log(magnitudes) / _LOG_GAMMA).astype(np.int64)
+
+
+def _value(key):
+    # representative of bucket key: within ALPHA of every value in it
+    return 2 * _GAMMA ** key / (_GAMMA + 1)
+
+
+class _Bins:
+    # dense counts for keys offset .. offset + len(counts) - 1
+    __slots__ = ("offset", "counts")
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, keys, counts):
+        # keys ascending
+        if len(keys) == 0:
+            return
+        n = len(self.counts)
+        hi = int(keys[-1]) if n == 0 else max(int(keys[-1]), self.offset + n - 1)
+        lo = int(keys[0]) if n == 0 else min(int(keys[0]), self.offset)
+        lo = max(lo, hi - MAX_BINS + 1)
+        if n == 0 or lo != self.offset or hi != self.offset + n - 1:
+            grown = np.zeros(hi - lo + 1, dtype=np.int64)
+            if n:
+                old = np.arange(self.offset, self.offset + n)
+                np.add.at(grown, np.maximum(old, lo) - lo, self.counts)
+            self.offset, self.counts = lo, grown
+        if keys[0] >= lo:
+            self.counts[keys - lo] += counts
+        else:
+            np.add.at(self.counts, np.maximum(keys, lo) - lo, counts)
+
+    def add_one(self, key):
+        i = key - self.offset
+        if 0 <= i < len(self.counts):
+            self.counts[i] += 1
+        else:
+            self.add(np.array([key]), np.array([1]))
+
+    def merge(self, other):
+        if len(other.counts):
+            self.add(np.arange(other.offset, other.offset + len(other.counts)), other.counts)
+
+
+class QuantileSketch:
+    __slots__ = ("positive", "negative", "zeros", "count", "min", "max")
+
+    def __init__(self):
+        self.positive = _Bins()
+        self.negative = _Bins()
+        self.zeros = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, x):
+        if x is None or x != x:
+            return
+        self.count += 1
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        if x > MIN_VALUE:
+            self.positive.add_one(math.ceil(math.log(x) / _LOG_GAMMA))
+        elif x < -MIN_VALUE:
+            self.negative.add_one(math.ceil(math.log(-x) / _LOG_GAMMA))
+        else:
+            self.zeros += 1
+
+    def update_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        pos = values > MIN_VALUE
+        neg = values < -MIN_VALUE
+        self.zeros += int(len(values) - pos.sum() - neg.sum())
+        for bins, magnitudes in ((self.positive, values[pos]), (self.negative, -values[neg])):
+            if len(magnitudes):
+                keys = _keys(magnitudes)
+                lo = keys.min()
+                counts = np.bincount(keys - lo)
+                present = np.flatnonzero(counts)
+                bins.add(present + lo, counts[present])
+
+    def merge(self, other):
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        # q in [0, 1]; None for an empty sketch
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        # [quantile(q) for q in qs], walking the buckets once
+        if self.count == 0:
+            return [None] * len(qs)
+        # every bucket in value order: negatives (largest key first), zero,
+        # positives
+        neg, pos = self.negative, self.positive
+        values = np.concatenate((
+            -_value(neg.offset + np.arange(len(neg.counts) - 1, -1, -1)),
+            [0.0],
+            _value(pos.offset + np.arange(len(pos.counts))),
+        ))
+        cum = np.cumsum(np.concatenate((neg.counts[::-1], [self.zeros], pos.counts)))
+        ranks = np.asarray(qs, dtype=np.float64) * (self.count - 1)
+        i = np.minimum(np.searchsorted(cum, ranks, side="right"), len(cum) - 1)
+        return np.clip(values[i], self.min, self.max).tolist()
+
+    @property
+    def nbytes(self):
+        return self.positive.counts.nbytes + self.negative.counts.nbytes
+
+
+# -------------------------
+# DISTINCT COUNTS
+# -------------------------
+
+def hash64(items):
+    # stable 64-bit hashes of strings, as a uint64 array
+    return np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+            for s in items
+        ],
+        dtype=np.uint64,
+    )
+
+
+def _bit_length(x):
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= np.uint64(1 << shift)
+        n += np.where(big, shift, 0)
+        x = np.where(big, x >> np.uint64(shift), x)
+    return n + (x > 0)
+
+
+class HyperLogLog:
+    __slots__ = ("p", "registers")
+
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        width = 64 - self.p
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = hashes & np.uint64((1 << width) - 1)
+        rank = (width - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def add(self, items):
+        self.add_hashes(hash64(items))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        harmonic = float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / harmonic
+        empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and empty:
+            # small range: linear counting
+            estimate = m * math.log(m / empty)
+        return int(round(estimate))
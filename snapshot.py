@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from decode import Projection
+from store import COLUMNS, STORE_FIELDS, EventStore
+from tail import TailReader
+
+# Memory-mapped binary snapshot of an EventStore.
+#
+#   <dir>/header.json         schema version, row count, file names, source
+#                             checkpoint (path / offset / inode)
+#   <dir>/<column>.<gen>.bin  fixed-width column, one per store column
+#   <dir>/dictionary.<gen>.json
+#                             devices, gateways, locations, per-device info
+#   <dir>/{device,gateway}_{order,offsets}.<gen>.bin
+#                             rows grouped by entity, for zero-copy slices
+#
+# Columns are append-only: an incremental compile appends the rows parsed
+# from the JSONL tail to the existing column files. Every other file is
+# written under a new generation and header.json is swapped last, so a
+# reader always sees a consistent snapshot.
+
+SCHEMA_VERSION = 3
+HEADER = "header.json"
+
+
+def read_header(path):
+    try:
+        with open(os.path.join(path, HEADER)) as f:
+            header = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if header.get("schema_version") != SCHEMA_VERSION:
+        return None
+    return header
+
+
+def _map(path, name, dtype, n):
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=(n,))
+
+
+def _write_array(path, name, arr):
+    with open(os.path.join(path, name), "wb") as f:
+        f.write(np.ascontiguousarray(arr).tobytes())
+
+
+def _group(codes, n):
+    # rows ordered by entity code (row order kept within an entity), and
+    # offsets[i]:offsets[i + 1] delimiting entity i; NO_CODE rows are skipped
+    order = np.argsort(codes, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(codes[order], np.arange(n + 1), side="left")
+    return order, offsets.astype(np.int64)
+
+
+def open_snapshot(path):
+    # Returns (EventStore, header), or None when there is no usable snapshot.
+    # Columns and row groups are memory-mapped, not read.
+    header = read_header(path)
+    if header is None:
+        return None
+
+    n = header["rows"]
+    files = header["files"]
+    columns = {
+        name: _map(path, files[name], dtype, n)
+        for name, dtype in COLUMNS.items()
+    }
+
+    with open(os.path.join(path, files["dictionary"])) as f:
+        d = json.load(f)
+
+    groups = {}
+    for kind in ("device", "gateway"):
+        count = len(d[f"{kind}s"])
+        order = _map(path, files[f"{kind}_order"], np.int64, header[f"{kind}_rows"])
+        offsets = np.fromfile(os.path.join(path, files[f"{kind}_offsets"]), dtype=np.int64)
+        groups[kind] = [order[offsets[i]:offsets[i + 1]] for i in range(count)]
+
+    store = EventStore.restore(
+        columns,
+        d["devices"],
+        d["gateways"],
+        d["locations"],
+        d["device_info"],
+        d["device_metrics"],
+        groups["device"],
+        groups["gateway"],
+    )
+    return store, header
+
+
+def write_snapshot(store, path, source=None, append=False):
+    # append: store was opened from the snapshot at path and only had rows
+    # appended since, so the column files are extended instead of rewritten.
+    os.makedirs(path, exist_ok=True)
+    header = read_header(path)
+    gen = header["generation"] + 1 if header else 0
+    if not append:
+        header = None
+    n = len(store)
+    files = {}
+
+    for name in COLUMNS:
+        col = store.column(name)
+        if header is not None:
+            fname = header["files"][name]
+            start = header["rows"]
+            with open(os.path.join(path, fname), "r+b" if start else "wb") as f:
+                f.truncate(start * col.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(col[start:]).tobytes())
+        else:
+            fname = f"{name}.{gen}.bin"
+            _write_array(path, fname, col)
+        files[name] = fname
+
+    rows = {}
+    for kind, codes, table in (
+        ("device", store.column("device"), store.devices),
+        ("gateway", store.column("gateway"), store.gateways),
+    ):
+        order, offsets = _group(codes, len(table))
+        files[f"{kind}_order"] = f"{kind}_order.{gen}.bin"
+        files[f"{kind}_offsets"] = f"{kind}_offsets.{gen}.bin"
+        _write_array(path, files[f"{kind}_order"], order[offsets[0]:])
+        _write_array(path, files[f"{kind}_offsets"], offsets - offsets[0])
+        rows[f"{kind}_rows"] = int(offsets[-1] - offsets[0])
+
+    files["dictionary"] = f"dictionary.{gen}.json"
+    with open(os.path.join(path, files["dictionary"]), "w") as f:
+        json.dump({
+            "devices": store.devices.values,
+            "gateways": store.gateways.values,
+            "locations": store.locations.values,
+            "device_info": store.device_info,
+            "device_metrics": store.device_metrics,
+        }, f)
+
+    new_header = {
+        "schema_version": SCHEMA_VERSION,
+        "generation": gen,
+        "rows": n,
+        "columns": {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+        "files": files,
+        "source": source,
+        **rows,
+    }
+    tmp = os.path.join(path, HEADER + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(new_header, f)
+    os.replace(tmp, os.path.join(path, HEADER))
+
+    # drop files of older generations
+    keep = set(files.values()) | {HEADER}
+    for name in os.listdir(path):
+        if name not in keep:
+            os.remove(os.path.join(path, name))
+
+    return new_header
+
+
+def compile_snapshot(source="enriched_events.jsonl", path="enriched_events.snapshot"):
+    # Bring the snapshot at path up to date with source, parsing only the
+    # lines appended since the last compile. Returns the header.
+    opened = open_snapshot(path)
+    store, header = opened if opened is not None else (EventStore(), None)
+
+    reader = TailReader(
+        source,
+        header["source"] if header else None,
+        decode=Projection(STORE_FIELDS),
+    )
+    records, reset = reader.poll()
+    reader.close()
+
+    if reset:
+        # the file no longer matches the snapshot: rebuild from scratch
+        store = EventStore()
+    elif header is not None and not records:
+        return header
+
+    for r in records:
+        store.append_record(r)
+    return write_snapshot(
+        store,
+        path,
+        source=reader.checkpoint(),
+        append=header is not None and not reset,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile enriched_events.jsonl into a memory-mapped snapshot"
+    )
+    parser.add_argument("source", nargs="?", default="enriched_events.jsonl")
+    parser.add_argument("-o", "--out", default="enriched_events.snapshot")
+    args = parser.parse_args()
+
+    header = compile_snapshot(args.source, args.out)
+    print(f"{args.out}: {header['rows']} rows, generation {header['generation']}")
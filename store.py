@@ -0,0 +1,472 @@
+import json
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from decode import Projection
+
+# Columnar, interned event store.
+#
+# The hot fields of every event are kept in typed NumPy columns and the
+# repeated devEui / gatewayId strings are interned to small integer codes.
+# Per-device attributes (name, profile, device_metrics) are stored once per
+# device instead of once per event.
+
+NAT = np.iinfo(np.int64).min
+NO_CODE = -1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Projection decoded by load_store / LiveDataset, in EventStore._append order
+STORE_FIELDS = [
+    "timestamp",
+    "devEui",
+    "name",
+    "profile",
+    "gatewayId",
+    "rssi",
+    "snr",
+    "location",
+    "confidence_score",
+    "device_metrics",
+    "measurements",
+    "network.fCnt",
+    "network.adr",
+]
+
+COLUMNS = {
+    "timestamp": np.int64,          # ns since epoch, NAT when unparseable
+    "confidence_score": np.float64,
+    "rssi": np.float64,             # NaN when missing
+    "snr": np.float64,              # NaN when missing
+    "device": np.int32,             # code into EventStore.devices
+    "gateway": np.int32,            # code into EventStore.gateways, NO_CODE when missing
+    "location": np.int32,           # code into EventStore.locations, NO_CODE when missing
+    "completeness": np.float64,     # share of non-null measurements
+    "battery": np.int8,             # 1 when a battery reading is present
+    "fcnt": np.int64,               # LoRaWAN frame counter, NO_FCNT when missing
+    "adr": np.int8,                 # 1 / 0, -1 when missing
+}
+
+NO_FCNT = -1
+
+
+def parse_timestamp(text):
+    try:
+        dt = datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        return NAT
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def format_timestamp(ns):
+    if ns == NAT:
+        return None
+    ns = int(ns)
+    if ns % 1_000_000_000 == 0:
+        unit = "s"
+    elif ns % 1_000_000 == 0:
+        unit = "ms"
+    elif ns % 1_000 == 0:
+        unit = "us"
+    else:
+        unit = "ns"
+    return str(np.datetime_as_string(np.datetime64(ns, "ns"), unit=unit, timezone="UTC"))
+
+
+def _float(value):
+    return np.nan if value is None else value
+
+
+def _measurement_quality(measurements):
+    # (share of non-null measurements, battery reading present), as scored
+    # by enrich.py; no measurements at all counts as 0.0 / absent
+    if not isinstance(measurements, dict) or not measurements:
+        return 0.0, 0
+    present = sum(1 for v in measurements.values() if v is not None)
+    battery = any("bat" in k.lower() and v is not None for k, v in measurements.items())
+    return present / len(measurements), int(battery)
+
+
+class StringTable:
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def intern(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def code_of(self, value):
+        return self.codes.get(value, NO_CODE)
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class EventSlice:
+    # Row-index view over an EventStore. Behaves like the list of event
+    # dicts produced by build_device_index / build_gateway_index, and also
+    # exposes the underlying columns for vectorized consumers.
+    #
+    # base holds rows restored from a snapshot (a read-only array), rows
+    # the ones appended since.
+
+    def __init__(self, store, rows=None, base=None):
+        self.store = store
+        self._rows = rows if rows is not None else array("q")
+        self._base = base
+
+    def append(self, row):
+        self._rows.append(row)
+
+    @property
+    def rows(self):
+        tail = np.array(self._rows, dtype=np.int64)
+        if self._base is None:
+            return tail
+        return np.concatenate((self._base, tail))
+
+    def column(self, name):
+        return self.store.column(name)[self.rows]
+
+    def __len__(self):
+        base = len(self._base) if self._base is not None else 0
+        return base + len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.store[r] for r in self.rows[i]]
+        if self._base is None:
+            return self.store[self._rows[i]]
+        if i < 0:
+            i += len(self)
+        if i < len(self._base):
+            return self.store[int(self._base[i])]
+        return self.store[self._rows[i - len(self._base)]]
+
+    def __iter__(self):
+        if self._base is not None:
+            for r in self._base:
+                yield self.store[int(r)]
+        for r in self._rows:
+            yield self.store[r]
+
+
+class EventStore:
+    def __init__(self, capacity=1024):
+        self._n = 0
+        self._cols = {
+            name: np.empty(capacity, dtype=dtype)
+            for name, dtype in COLUMNS.items()
+        }
+
+        self.devices = StringTable()
+        self.gateways = StringTable()
+        self.locations = StringTable()
+        self.location_values = []
+
+        # per-device attributes, indexed by device code
+        self.device_info = []
+        self.device_metrics = []
+
+        self._device_rows = []
+        self._gateway_rows = []
+        self._device_base = []
+        self._gateway_base = []
+
+    @classmethod
+    def from_events(cls, events):
+        store = cls()
+        store.extend(events)
+        return store
+
+    @classmethod
+    def restore(cls, columns, devices, gateways, locations, device_info,
+                device_metrics, device_rows, gateway_rows):
+        # Rebuild a store around existing column arrays (e.g. memory-mapped
+        # snapshot files) without copying them. device_rows / gateway_rows
+        # hold each entity's row numbers, in row order.
+        store = cls(capacity=0)
+        store._n = len(columns["timestamp"])
+        store._cols = dict(columns)
+
+        for dev in devices:
+            store.devices.intern(dev)
+        for gw in gateways:
+            store.gateways.intern(gw)
+        for loc in locations:
+            store.locations.intern(loc)
+            store.location_values.append(json.loads(loc))
+
+        store.device_info = list(device_info)
+        store.device_metrics = list(device_metrics)
+        store._device_rows = [array("q") for _ in devices]
+        store._gateway_rows = [array("q") for _ in gateways]
+        store._device_base = list(device_rows)
+        store._gateway_base = list(gateway_rows)
+        return store
+
+    # -------------------------
+    # APPEND
+    # -------------------------
+
+    def _reserve(self, n):
+        capacity = len(self._cols["timestamp"])
+        if n <= capacity:
+            return
+        capacity = max(capacity, 1024)
+        while capacity < n:
+            capacity *= 2
+        for name, col in self._cols.items():
+            grown = np.empty(capacity, dtype=col.dtype)
+            grown[:self._n] = col[:self._n]
+            self._cols[name] = grown
+
+    def _intern_device(self, dev_eui, name, profile):
+        code = self.devices.intern(dev_eui)
+        if code == len(self.device_info):
+            self.device_info.append(
+                {"devEui": dev_eui, "name": name, "profile": profile}
+            )
+            self.device_metrics.append(None)
+            self._device_rows.append(array("q"))
+            self._device_base.append(None)
+        elif name and not self.device_info[code]["name"]:
+            self.device_info[code]["name"] = name
+        return code
+
+    def _intern_gateway(self, gw):
+        if not gw:
+            return NO_CODE
+        code = self.gateways.intern(gw)
+        if code == len(self._gateway_rows):
+            self._gateway_rows.append(array("q"))
+            self._gateway_base.append(None)
+        return code
+
+    def _intern_location(self, loc):
+        if not loc:
+            return NO_CODE
+        code = self.locations.intern(json.dumps(loc, sort_keys=True))
+        if code == len(self.location_values):
+            self.location_values.append(loc)
+        return code
+
+    def _append(self, timestamp, dev_eui, name, profile, gateway_id, rssi, snr,
+                location, confidence_score, metrics, measurements=None, fcnt=None,
+                adr=None):
+        row = self._n
+        self._reserve(row + 1)
+
+        dev = self._intern_device(dev_eui, name, profile)
+        gw = self._intern_gateway(gateway_id)
+
+        cols = self._cols
+        cols["timestamp"][row] = parse_timestamp(timestamp)
+        cols["confidence_score"][row] = confidence_score
+        cols["rssi"][row] = _float(rssi)
+        cols["snr"][row] = _float(snr)
+        cols["device"][row] = dev
+        cols["gateway"][row] = gw
+        cols["location"][row] = self._intern_location(location)
+        cols["completeness"][row], cols["battery"][row] = _measurement_quality(measurements)
+        cols["fcnt"][row] = NO_FCNT if fcnt is None else fcnt
+        cols["adr"][row] = -1 if adr is None else int(adr)
+
+        if self.device_metrics[dev] is None and metrics is not None:
+            self.device_metrics[dev] = metrics
+
+        self._device_rows[dev].append(row)
+        if gw != NO_CODE:
+            self._gateway_rows[gw].append(row)
+
+        self._n += 1
+        return row
+
+    def append(self, e):
+        device = e["device"]
+        rf = e["rf"]
+        network = e.get("network") or {}
+        return self._append(
+            e.get("timestamp"),
+            device["devEui"],
+            device.get("name"),
+            device.get("profile"),
+            rf.get("gatewayId"),
+            rf.get("rssi"),
+            rf.get("snr"),
+            rf.get("location"),
+            e["confidence"]["confidence_score"],
+            e.get("device_metrics"),
+            e.get("measurements"),
+            network.get("fCnt"),
+            network.get("adr"),
+        )
+
+    def append_record(self, r):
+        # r: a decode.Projection(STORE_FIELDS) record
+        return self._append(*r)
+
+    def extend(self, events):
+        for e in events:
+            self.append(e)
+
+    def extend_store(self, other):
+        # Append every row of another EventStore, as if its events had been
+        # appended one by one
+        start, n = self._n, len(other)
+        if n == 0:
+            return
+        self._reserve(start + n)
+
+        devices = np.array([
+            self._intern_device(info["devEui"], info["name"], info["profile"])
+            for info in other.device_info
+        ], dtype=np.int32)
+        for code, metrics in zip(devices.tolist(), other.device_metrics):
+            if self.device_metrics[code] is None and metrics is not None:
+                self.device_metrics[code] = metrics
+        gateways = np.array([self._intern_gateway(gw) for gw in other.gateways], dtype=np.int32)
+        locations = np.array(
+            [self._intern_location(loc) for loc in other.location_values], dtype=np.int32
+        )
+
+        for name, col in self._cols.items():
+            values = other.column(name)
+            if name == "device":
+                values = devices[values]
+            elif name in ("gateway", "location"):
+                table = gateways if name == "gateway" else locations
+                values = np.where(values != NO_CODE, table[np.maximum(values, 0)], NO_CODE)
+            col[start:start + n] = values
+
+        rows = np.arange(start, start + n)
+        for name, lists in (("device", self._device_rows), ("gateway", self._gateway_rows)):
+            codes = self._cols[name][start:start + n]
+            order = np.argsort(codes, kind="stable")
+            found, bounds = np.unique(codes[order], return_index=True)
+            for code, chunk in zip(found.tolist(), np.split(rows[order], bounds[1:])):
+                if code != NO_CODE:
+                    lists[code].frombytes(chunk.astype(np.int64).tobytes())
+        self._n += n
+
+    def clear(self):
+        # Drop every row but keep the interned devices, gateways and
+        # locations (and the per-device attributes), so codes stay valid
+        # across batches
+        self._n = 0
+        for rows in self._device_rows + self._gateway_rows:
+            del rows[:]
+        self._device_base = [None] * len(self._device_base)
+        self._gateway_base = [None] * len(self._gateway_base)
+
+    # -------------------------
+    # COLUMN ACCESS
+    # -------------------------
+
+    def column(self, name):
+        return self._cols[name][:self._n]
+
+    @property
+    def nbytes(self):
+        # memory held by the columns (at capacity) and the row lists
+        total = sum(col.nbytes for col in self._cols.values())
+        for rows in self._device_rows + self._gateway_rows:
+            total += rows.itemsize * len(rows)
+        for base in self._device_base + self._gateway_base:
+            if base is not None:
+                total += base.nbytes
+        return total
+
+    @property
+    def timestamps(self):
+        return self.column("timestamp").view("datetime64[ns]")
+
+    # Slices share the store's row lists, so they grow as events are
+    # appended.
+    def device_slice(self, code):
+        return EventSlice(self, self._device_rows[code], self._device_base[code])
+
+    def gateway_slice(self, code):
+        return EventSlice(self, self._gateway_rows[code], self._gateway_base[code])
+
+    def device_index(self):
+        return {
+            self.devices[code]: self.device_slice(code)
+            for code in range(len(self.devices))
+        }
+
+    def gateway_index(self):
+        return {
+            self.gateways[code]: self.gateway_slice(code)
+            for code in range(len(self.gateways))
+        }
+
+    # -------------------------
+    # DICT ADAPTER
+    # -------------------------
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self._n
+        if not 0 <= row < self._n:
+            raise IndexError(row)
+
+        cols = self._cols
+        dev = cols["device"][row]
+        gw = cols["gateway"][row]
+        loc = cols["location"][row]
+        rssi = cols["rssi"][row]
+        snr = cols["snr"][row]
+        fcnt = cols["fcnt"][row]
+        adr = cols["adr"][row]
+
+        return {
+            "timestamp": format_timestamp(cols["timestamp"][row]),
+            "device": self.device_info[dev],
+            "rf": {
+                "gatewayId": self.gateways[gw] if gw != NO_CODE else None,
+                "rssi": None if np.isnan(rssi) else float(rssi),
+                "snr": None if np.isnan(snr) else float(snr),
+                "location": self.location_values[loc] if loc != NO_CODE else None,
+            },
+            "confidence": {
+                "confidence_score": float(cols["confidence_score"][row]),
+            },
+            "network": {
+                "fCnt": None if fcnt == NO_FCNT else int(fcnt),
+                "adr": None if adr < 0 else bool(adr),
+            },
+            "device_metrics": self.device_metrics[dev],
+        }
+
+    def __iter__(self):
+        for row in range(self._n):
+            yield self[row]
+
+
+def load_store(path="enriched_events.jsonl"):
+    decode = Projection(STORE_FIELDS)
+    store = EventStore()
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                store.append_record(decode(line))
+    return store
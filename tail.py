@@ -0,0 +1,134 @@
+import json
+import os
+
+# Tail reader for enriched_events.jsonl.
+#
+# TailReader remembers the byte offset and inode it has consumed up to and
+# only parses complete lines appended since. Truncation and replacement are
+# reported as resets; a rotated file is drained before switching to the new
+# one.
+#
+# A checkpoint (path / offset / inode) only means something together with
+# the data parsed up to it, so it is persisted with that data: in the
+# snapshot header (snapshot.py) and the warm-start cache (warmstart.py),
+# which is how run.py --follow and the dashboard resume after a restart.
+
+
+def _parse_lines(data, decode):
+    return [decode(line) for line in data.splitlines() if line.strip()]
+
+
+class TailReader:
+    def __init__(self, path="enriched_events.jsonl", checkpoint=None, decode=json.loads,
+                 max_bytes=None):
+        # max_bytes: read at most about this much per poll (whole lines; a
+        # rotated file is still drained in one go)
+        self.path = path
+        self.decode = decode
+        self.max_bytes = max_bytes
+        self.offset = 0
+        self.inode = None
+        self.mtime_ns = None
+        self.size = None
+        self._fh = None
+
+        # A checkpoint is only trusted while the inode and size still match
+        # (see _open); otherwise reading restarts from zero as a reset.
+        if checkpoint:
+            self.offset = checkpoint["offset"]
+            self.inode = checkpoint["inode"]
+
+    def checkpoint(self):
+        return {"path": self.path, "offset": self.offset, "inode": self.inode}
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _open(self):
+        try:
+            fh = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+
+        st = os.fstat(fh.fileno())
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # first open, or a checkpoint that no longer matches the file
+            self.offset = 0
+        self.inode = st.st_ino
+        self._fh = fh
+        return True
+
+    def _renamed(self, inode):
+        # True when the file we were reading still exists under another name
+        # in the same directory (rotation), False when it was replaced
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            return any(entry.inode() == inode for entry in os.scandir(directory))
+        except OSError:
+            return False
+
+    def _drain(self, final=False):
+        self._fh.seek(self.offset)
+        if final or self.max_bytes is None:
+            data = self._fh.read()
+        else:
+            data = self._fh.read(self.max_bytes)
+            if len(data) == self.max_bytes and not data.endswith(b"\n"):
+                data += self._fh.readline()
+
+        if not final:
+            # leave a trailing partial line for the next poll
+            end = data.rfind(b"\n") + 1
+            data = data[:end]
+
+        self.offset += len(data)
+        st = os.fstat(self._fh.fileno())
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        return _parse_lines(data, self.decode)
+
+    def poll(self):
+        # Returns (events, reset). reset is True when the file was truncated
+        # or replaced, or the checkpoint no longer matches it, meaning
+        # previously returned events are no longer part of the file.
+        if self._fh is None:
+            offset = self.offset
+            if not self._open():
+                return [], False
+            reset = offset != self.offset
+            return self._drain(), reset
+
+        events = []
+        reset = False
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # rotated away and not recreated yet
+            return self._drain(), False
+
+        if st.st_ino != self.inode:
+            if not self._renamed(self.inode):
+                # replaced (e.g. rewritten by enrich.py): start over
+                self.close()
+                self.offset = 0
+                self.inode = None
+                if not self._open():
+                    return [], True
+                return self._drain(), True
+
+            # rotated: finish the old file, then start the new one from zero
+            events = self._drain(final=True)
+            self.close()
+            self.offset = 0
+            self.inode = None
+            if not self._open():
+                return events, False
+        elif st.st_size < self.offset:
+            self.offset = 0
+            reset = True
+
+        events.extend(self._drain())
+        return events, reset
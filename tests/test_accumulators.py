@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from accumulators import FleetStats
+from engine import analyze_gateways
+from store import EventStore
+
+
+def _event(dev_eui, gw="GW1"):
+    return {
+        "timestamp": "2025-01-01T00:00:00Z",
+        "device": {"devEui": dev_eui, "name": None, "profile": None},
+        "rf": {"gatewayId": gw, "rssi": -90, "snr": 5.0},
+        "confidence": {"confidence_score": 90},
+    }
+
+
+def test_null_dev_eui_is_not_counted_as_heard():
+    events = [_event("A1"), _event(None), _event("A2")]
+    store = EventStore.from_events(events)
+
+    fleet = FleetStats()
+    fleet.update_store(store)
+    assert fleet.gateways["GW1"].event_count == 3
+    assert fleet.gateways["GW1"].summary()["distinct_devices"] == 2
+
+    per_event = FleetStats()
+    for e in events:
+        per_event.update(e)
+    assert per_event.gateways["GW1"].summary()["distinct_devices"] == 2
+
+    assert analyze_gateways(store.gateway_index())["GW1"]["distinct_devices"] == 2
@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import EntityMatcher
+
+
+def test_add_prefix_of_existing_name():
+    m = EntityMatcher({"door sensor 10": "D10", "sensor 10": "S10"})
+    m.find_all("warm up the links")
+    m.add("sensor 1", "S1")
+    assert m.find_all("where is door sensor 1") == [(14, 22, "S1")]
+    assert m.find_all("where is door sensor 10") == [(9, 23, "D10")]
+
+
+def test_incremental_matches_fresh_build():
+    names = {"temp sensor 1": 1, "temp sensor 10": 10, "sensor 1": 2, "gateway 3": 3}
+    m = EntityMatcher()
+    for name, value in names.items():
+        m.add(name, value)
+        m.find_all(name)
+    text = "compare temp sensor 1, sensor 1 and gateway 3 with temp sensor 10"
+    assert m.find_all(text) == EntityMatcher(names).find_all(text)
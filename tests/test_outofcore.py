@@ -0,0 +1,62 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import WINDOWS, DeviceMetrics
+from outofcore import ExternalMetrics
+from store import EventStore
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _event(dev_eui, minutes, score):
+    ts = START + timedelta(minutes=minutes)
+    return {
+        "timestamp": ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "device": {"devEui": dev_eui, "name": None, "profile": None},
+        "rf": {"gatewayId": "GW1", "rssi": -70 - score % 30, "snr": 5.0},
+        "confidence": {"confidence_score": score},
+        "measurements": {"battery": 3.6 if score % 3 else None, "temp": 20},
+    }
+
+
+def _events():
+    events = [_event("A1", i * 53, 40 + (i * 7) % 60) for i in range(80)]
+    events += [_event("B2", i * 71, 50 + (i * 11) % 50) for i in range(50)]
+    events.sort(key=lambda e: e["timestamp"])
+    return events
+
+
+def _fold(events, batch):
+    # as OutOfCoreDataset does: one scratch store, cleared between batches
+    metrics = ExternalMetrics(run_rows=3, merge_rows=4)
+    store = EventStore()
+    for i in range(0, len(events), batch):
+        store.clear()
+        store.extend(events[i:i + batch])
+        metrics.update_store(store)
+        metrics.finish()
+    return metrics
+
+
+def test_incremental_metrics_match_one_pass():
+    events = _events()
+    # a late B2 event: older than B2's newest when it arrives
+    late = next(i for i, e in enumerate(events) if e["device"]["devEui"] == "B2")
+    events.append(events.pop(late))
+
+    whole = _fold(events, len(events))
+    polled = _fold(events, 7)
+    for window in WINDOWS:
+        assert polled.snapshot(window) == whole.snapshot(window)
+
+
+def test_metrics_match_in_memory_metrics():
+    events = _events()
+    memory = DeviceMetrics()
+    memory.update_store(EventStore.from_events(events))
+    polled = _fold(events, 5)
+    for window in WINDOWS:
+        assert polled.snapshot(window) == memory.snapshot(window)
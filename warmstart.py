@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+from snapshot import open_snapshot, write_snapshot
+
+# Warm-start cache of a LiveDataset across process restarts.
+#
+#   <dir>/store/                the EventStore, as a snapshot.py snapshot
+#   <dir>/analytics.<gen>.<rows>.pkl
+#                               derived state (device metrics, rollups,
+#                               fleet stats, query index, name maps) as of
+#                               the first <rows> store rows
+#   <dir>/meta.json             code version, store generation, the rows
+#                               the analytics cover and the source
+#                               checkpoint with a content hash of the
+#                               consumed prefix; written last
+#
+# The cache is used when it was written by the same code (CODE_VERSION
+# hashes the modules the state is derived with) and the first `offset`
+# bytes of the event file still hash to the recorded value. When the file
+# is unchanged since the save (same inode, size and mtime) the hash is not
+# recomputed. Lines appended after the save are then folded in by the
+# normal tail-follow path and saved again, appending to the store files.
+#
+# The analytics are pickled whole, so periodic saves only append the store
+# and re-pickle them once the store has grown ANALYTICS_GROWTH-fold since
+# they were written; a forced save (shutdown, registry eviction) always
+# writes them. Loading folds the store rows past the analytics back in.
+
+META = "meta.json"
+STORE = "store"
+SAVE_INTERVAL = 10.0       # seconds between saves while following
+ANALYTICS_GROWTH = 2       # store growth between periodic analytics saves
+
+CODE_FILES = (
+    "accumulators.py",
+    "decode.py",
+    "follow.py",
+    "matcher.py",
+    "metrics.py",
+    "query_engine.py",
+    "rollups.py",
+    "rules.py",
+    "sketches.py",
+    "snapshot.py",
+    "store.py",
+    "warmstart.py",
+)
+
+# LiveDataset attributes kept in the cache; everything else is rebuilt
+# from the store
+STATE = (
+    "metrics",
+    "rollups",
+    "fleet",
+    "gateway_stats",
+    "device_name_map",
+    "gateway_name_map",
+    "query_index",
+)
+
+
+def code_version():
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{sys.version_info[:2]} numpy {np.__version__}".encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        h.update(name.encode())
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+CODE_VERSION = code_version()
+
+
+def _hash_range(f, hasher, start, end, chunk=1 << 20):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = f.read(min(chunk, remaining))
+        if not data:
+            return False
+        hasher.update(data)
+        remaining -= len(data)
+    return True
+
+
+class WarmCache:
+    def __init__(self, path, source, save_interval=SAVE_INTERVAL):
+        self.path = path
+        self.source = source
+        self.save_interval = save_interval
+        self.disabled = False
+        self._last_save = None
+        self._generation = None     # LiveDataset.generation the store files follow
+        self._rows = None           # rows in the store files
+        self._hasher = None         # content hash of source[:_hashed]
+        self._hashed = 0
+        self._inode = None
+        self._saved = None          # (generation, offset) of the last save
+        self._analytics = None      # (file, rows) of the saved analytics
+
+    def _meta(self):
+        try:
+            with open(os.path.join(self.path, META)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _prefix_hash(self, offset):
+        # hash of source[:offset], or None when the file is shorter
+        hasher = hashlib.blake2b()
+        try:
+            with open(self.source, "rb") as f:
+                if not _hash_range(f, hasher, 0, offset):
+                    return None
+        except FileNotFoundError:
+            return None
+        self._hasher, self._hashed = hasher, offset
+        return hasher.hexdigest()
+
+    def load(self):
+        # Returns (store, state, rows, checkpoint), state being the
+        # analytics of the first rows store rows, or None when there is no
+        # usable cache for the source
+        meta = self._meta()
+        if meta is None or meta.get("code_version") != CODE_VERSION:
+            return None
+        src = meta["source"]
+        try:
+            st = os.stat(self.source)
+        except FileNotFoundError:
+            return None
+
+        unchanged = (
+            st.st_ino == src["inode"]
+            and st.st_size == src["size"]
+            and st.st_mtime_ns == src["mtime_ns"]
+        )
+        if not unchanged and self._prefix_hash(src["offset"]) != src["content_hash"]:
+            return None
+
+        opened = open_snapshot(os.path.join(self.path, STORE))
+        if opened is None:
+            return None
+        store, header = opened
+        if header["generation"] != meta["store_generation"] or header["rows"] != meta["rows"]:
+            return None
+        try:
+            with open(os.path.join(self.path, meta["analytics"]), "rb") as f:
+                state = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            return None
+
+        self._rows = len(store)
+        self._inode = st.st_ino
+        self._generation = 0
+        self._saved = (0, src["offset"])
+        self._analytics = (meta["analytics"], meta["analytics_rows"])
+        checkpoint = {"path": self.source, "offset": src["offset"], "inode": st.st_ino}
+        return store, state, meta["analytics_rows"], checkpoint
+
+    def save(self, data, force=False):
+        # Write data (a LiveDataset) to the cache. Outside force, at most
+        # once per save_interval.
+        now = time.monotonic()
+        if self.disabled:
+            return False
+        if not force and self._last_save is not None and now - self._last_save < self.save_interval:
+            return False
+
+        reader = data.reader
+        if self._saved == (data.generation, reader.offset) and not (
+            force and self._analytics[1] < self._rows
+        ):
+            return False
+        if data.generation != self._generation:
+            # first save, or the file was reset: rewrite everything
+            self._rows = None
+            self._hasher = None
+            self._analytics = None
+            self._generation = data.generation
+        elif self._inode is not None and reader.inode != self._inode:
+            # rotated: the store now spans two files and no longer matches a
+            # prefix of the current one
+            self.invalidate()
+            self.disabled = True
+            return False
+
+        with open(self.source, "rb") as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != reader.inode:
+                return False
+            if self._hasher is None or self._hashed > reader.offset:
+                self._hasher, self._hashed = hashlib.blake2b(), 0
+            if not _hash_range(f, self._hasher, self._hashed, reader.offset):
+                return False
+            self._hashed = reader.offset
+        self._inode = reader.inode
+
+        os.makedirs(self.path, exist_ok=True)
+        store = data.store
+        header = write_snapshot(
+            store,
+            os.path.join(self.path, STORE),
+            source=reader.checkpoint(),
+            append=self._rows is not None,
+        )
+        self._rows = len(store)
+
+        if (
+            force
+            or self._analytics is None
+            or self._rows >= ANALYTICS_GROWTH * self._analytics[1]
+        ):
+            analytics = f"analytics.{header['generation']}.{self._rows}.pkl"
+            state = {name: getattr(data, name) for name in STATE}
+            tmp = os.path.join(self.path, analytics + ".tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, os.path.join(self.path, analytics))
+            self._analytics = (analytics, self._rows)
+        analytics, analytics_rows = self._analytics
+
+        meta = {
+            "code_version": CODE_VERSION,
+            "store_generation": header["generation"],
+            "rows": header["rows"],
+            "analytics": analytics,
+            "analytics_rows": analytics_rows,
+            "source": {
+                "offset": reader.offset,
+                "inode": st.st_ino,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "content_hash": self._hasher.hexdigest(),
+            },
+        }
+        tmp = os.path.join(self.path, META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, META))
+
+        for name in os.listdir(self.path):
+            if name.startswith("analytics.") and name != analytics:
+                os.remove(os.path.join(self.path, name))
+        self._last_save = now
+        self._saved = (data.generation, reader.offset)
+        return True
+
+    def invalidate(self):
+        try:
+            os.remove(os.path.join(self.path, META))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,206 @@
+import argparse
+import json
+import random
+from datetime import timedelta
+
+from enrich import WEIGHTS, score_events
+from store import EPOCH, parse_timestamp
+
+# Deterministic synthetic LoRaWAN workload in the enriched event schema.
+#
+# Every device uplinks once per interval at a fixed phase, so events come
+# out in timestamp order without sorting and any scale can be streamed.
+# An uplink is heard by the device's home gateway and, with probability
+# multi_gateway, by each of its neighbour gateways; the best reception is
+# kept, as enrich.normalize does. Lost uplinks still advance the frame
+# counter, degrading devices lose RSSI linearly over the run, and events
+# are scored with enrich.score_events. The same parameters and seed always
+# produce the same bytes.
+
+START = "2025-01-01T00:00:00Z"
+
+SENSORS = [
+    # (sensor, name prefix, profile, measurement fields)
+    ("temp", "Temp Sensor", "rbs301-temp", ("temperature", "humidity", "battery")),
+    ("door", "Door Sensor", "rbs301-door", ("open", "battery")),
+    ("co2", "CO2 Sensor", "am319", ("co2", "temperature", "battery")),
+    ("leak", "Leak Sensor", "rbs301-wat", ("leak", "battery")),
+]
+
+CHANNELS = [868_100_000, 868_300_000, 868_500_000, 867_100_000,
+            867_300_000, 867_500_000, 867_700_000, 867_900_000]
+
+NEIGHBOURS = 2         # gateways besides the home one that may hear a device
+RSSI_NOISE = 4.0       # dB, per uplink
+MISSING_FIELD = 0.02   # probability a measurement field is null
+MISSING_BATTERY = 0.05 # probability the battery field is absent
+ADR_OFF = 0.05         # fraction of devices with ADR disabled
+
+
+def _devices(rng, n, gateways, degrading):
+    devices = []
+    for i in range(n):
+        sensor, prefix, profile, fields = SENSORS[i % len(SENSORS)]
+        home = rng.randrange(gateways)
+        others = [g for g in range(gateways) if g != home]
+        neighbours = rng.sample(others, min(NEIGHBOURS, len(others)))
+        base = rng.uniform(-108, -70)
+        devices.append({
+            "devEui": f"A84041{i:010X}",
+            "name": f"{prefix} {i + 1:02d}",
+            "profile": profile,
+            "sensor": sensor,
+            "fields": fields,
+            "devAddr": f"{rng.getrandbits(32):08X}",
+            "adr": rng.random() >= ADR_OFF,
+            "degrading": rng.random() < degrading,
+            # (gateway, mean RSSI); neighbours hear the device weaker
+            "links": [(home, base)] + [(g, base - rng.uniform(5, 25)) for g in neighbours],
+            "fcnt": rng.randrange(1000),
+        })
+    return devices
+
+
+def _gateways(rng, n):
+    return [
+        {
+            "id": f"00800000A0{g:06X}",
+            "location": {
+                "latitude": round(45.0 + rng.uniform(-0.2, 0.2), 6),
+                "longitude": round(-75.0 + rng.uniform(-0.2, 0.2), 6),
+                "altitude": rng.randrange(50, 120),
+            },
+        }
+        for g in range(n)
+    ]
+
+
+def _measurements(rng, d):
+    m = {}
+    for field in d["fields"]:
+        if field == "battery":
+            if rng.random() < MISSING_BATTERY:
+                continue
+            value = rng.randrange(60, 101)
+        elif field == "temperature":
+            value = round(rng.gauss(21, 3), 1)
+        elif field == "humidity":
+            value = round(rng.uniform(30, 70), 1)
+        elif field == "co2":
+            value = rng.randrange(400, 1500)
+        else:
+            value = rng.random() < 0.1
+        m[field] = None if rng.random() < MISSING_FIELD else value
+    return m
+
+
+def events(devices=100, gateways=8, days=7, count=None, interval=600, loss=0.02,
+           multi_gateway=0.3, degrading=0.1, degrade_db=25.0, seed=0, start=START):
+    # Yields enriched event dicts in timestamp order. count (if given) stops
+    # after that many events, extending past days when needed.
+    rng = random.Random(seed)
+    gws = _gateways(rng, gateways)
+    devs = _devices(rng, devices, gateways, degrading)
+    t0 = parse_timestamp(start) // 1000                   # µs
+    step = interval * 1_000_000
+    span = days * 86_400 * 1_000_000
+    prev_fcnt = [None] * devices
+
+    emitted = 0
+    tick = 0
+    while (count is None and tick * step < span) or (count is not None and emitted < count):
+        progress = min(1.0, tick * step / span) if span else 1.0
+        for i, d in enumerate(devs):
+            fcnt = d["fcnt"]
+            d["fcnt"] = fcnt + 1
+            if rng.random() < loss:
+                continue
+
+            fade = degrade_db * progress if d["degrading"] else 0.0
+            heard = [
+                (round(mean - fade + rng.gauss(0, RSSI_NOISE)), g)
+                for k, (g, mean) in enumerate(d["links"])
+                if k == 0 or rng.random() < multi_gateway
+            ]
+            rssi, g = max(heard)
+            snr = round(max(-20.0, min(12.0, (rssi + 112) / 3 + rng.gauss(0, 1.5))), 1)
+            sf = 7 if rssi > -90 else 9 if rssi > -105 else 12
+
+            us = t0 + tick * step + i * step // devices
+            e = {
+                "timestamp": (EPOCH + timedelta(microseconds=us)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "device": {
+                    "devEui": d["devEui"],
+                    "name": d["name"],
+                    "profile": d["profile"],
+                    "sensor": d["sensor"],
+                },
+                "measurements": _measurements(rng, d),
+                "rf": {
+                    "gatewayId": gws[g]["id"],
+                    "rssi": rssi,
+                    "snr": snr,
+                    "location": gws[g]["location"],
+                    "frequency": CHANNELS[fcnt % len(CHANNELS)],
+                    "spreadingFactor": sf,
+                },
+                "network": {
+                    "fCnt": fcnt,
+                    "fPort": 85,
+                    "devAddr": d["devAddr"],
+                    "adr": d["adr"],
+                },
+            }
+            prev_fcnt[i] = score_events([e], WEIGHTS, prev_fcnt[i])
+            yield e
+
+            emitted += 1
+            if count is not None and emitted >= count:
+                return
+        tick += 1
+
+
+def generate(out, **params):
+    # Writes events(**params) as JSONL; returns the number of events
+    n = 0
+    with open(out, "w") as f:
+        for e in events(**params):
+            f.write(json.dumps(e) + "\n")
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic enriched LoRaWAN events")
+    parser.add_argument("-o", "--out", default="enriched_events.jsonl")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--gateways", type=int, default=8)
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--events", type=int, default=None,
+                        help="stop after this many events instead of after --days")
+    parser.add_argument("--interval", type=int, default=600, help="seconds between uplinks")
+    parser.add_argument("--loss", type=float, default=0.02)
+    parser.add_argument("--multi-gateway", type=float, default=0.3,
+                        help="probability a neighbour gateway also hears an uplink")
+    parser.add_argument("--degrading", type=float, default=0.1,
+                        help="fraction of devices whose RF degrades")
+    parser.add_argument("--degrade-db", type=float, default=25.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", default=START)
+    args = parser.parse_args()
+
+    n = generate(
+        args.out,
+        devices=args.devices,
+        gateways=args.gateways,
+        days=args.days,
+        count=args.events,
+        interval=args.interval,
+        loss=args.loss,
+        multi_gateway=args.multi_gateway,
+        degrading=args.degrading,
+        degrade_db=args.degrade_db,
+        seed=args.seed,
+        start=args.start,
+    )
+    print(f"Wrote {n} events to {args.out}")